@@ -0,0 +1,260 @@
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import TYPE_CHECKING, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from analysis.blocks import BLOCK_THREADS, block_rows, process_blocks
+from analysis.clustering import to_features
+from analysis.components import ComponentMethod, Moments, fit
+from lib import HsImage
+from loaders.abstract import ProgressCallback
+from tracing import span, traced
+
+if TYPE_CHECKING:
+    from analysis.processes import ProcessBackend
+
+REGULARISATION = 1e-6
+"""Fraction of the mean variance added to all bands, keeps covariance invertible"""
+LOCAL_WINDOW = 15
+"""Side of the square window local statistics are computed in"""
+GUARD_WINDOW = 5
+"""Side of the square around the tested pixel excluded from its window, so that anomalies larger than a pixel aren't part of their own background"""
+LOCAL_COMPONENTS = 10
+"""Local statistics are computed for this many principal components, covariance of whole spectra is too costly to invert for every pixel"""
+THRESHOLD_SAMPLE_PIXELS = 1 << 20
+"""Maximum number of scores used to find thresholds"""
+DISPLAY_FRACTION = 1e-3
+"""Fraction of the most anomalous pixels shown with full brightness"""
+
+
+class AnomalyMethod(Enum):
+    """Defines the background pixels are compared with by the Reed-Xiaoli (RX) detector.
+
+    The following values are available:
+    - `GLOBAL`
+    - `LOCAL`
+    """
+
+    GLOBAL = 0
+    """Mean and covariance of the whole image"""
+    LOCAL = 1
+    """Mean and covariance of a window around every pixel, without its guard window"""
+
+
+@dataclass
+class AnomalyScores:
+    """RX scores of all pixels, the squared Mahalanobis distance from the background."""
+
+    method: AnomalyMethod
+    scores: npt.NDArray[np.float32]
+    """[height, width] scores, NaN for pixels with missing values"""
+    sample: npt.NDArray[np.float32] = field(init=False, repr=False)
+    """Sorted finite scores of randomly chosen pixels, used to find thresholds"""
+
+    def __post_init__(self):
+        scores = self.scores.reshape(-1)
+        if len(scores) > THRESHOLD_SAMPLE_PIXELS:
+            rng = np.random.default_rng(0)
+            scores = scores[rng.choice(len(scores), THRESHOLD_SAMPLE_PIXELS)]
+        self.sample = np.sort(scores[np.isfinite(scores)])
+
+    def threshold(self, fraction: float) -> float:
+        """Returns the score exceeded by about `fraction` of pixels."""
+        if len(self.sample) == 0:
+            return np.inf
+        idx = int((1 - fraction) * (len(self.sample) - 1))
+        return float(self.sample[min(max(idx, 0), len(self.sample) - 1)])
+
+    def mask(self, fraction: float) -> npt.NDArray[np.bool_]:
+        """Returns the mask of about `fraction` of the most anomalous pixels."""
+        return self.scores > self.threshold(fraction)
+
+    def normalised(self) -> npt.NDArray[np.float32]:
+        """Returns scores mapped to [0, 1], `DISPLAY_FRACTION` of pixels are saturated."""
+        high = max(self.threshold(DISPLAY_FRACTION), 1e-30)
+        values = self.scores / np.float32(high)
+        np.nan_to_num(values, copy=False, nan=0.0)
+        return np.clip(values, 0, 1, out=values)
+
+
+@traced("global_rx")
+def global_rx(
+    image: HsImage,
+    progress: ProgressCallback,
+    threads: int = BLOCK_THREADS,
+    backend: Optional["ProcessBackend"] = None,
+) -> AnomalyScores:
+    """Scores pixels against the mean and covariance of the whole image.
+    Statistics come from a single pass over blocks of rows (by worker processes of `backend` if it's set),
+    then scores of blocks are computed in a thread pool.
+    """
+    from scipy.linalg import cholesky, solve_triangular
+
+    h, w, b = image.data.shape
+    if backend is None:
+        moments = Moments(b)
+        rows = block_rows(w * b * 8)
+        for y in range(0, h, rows):
+            progress(0.5 * y / h, "Estimating covariance")
+            moments.add(image.get_rows(y, y + rows).astype(np.float64).reshape(-1, b))
+    else:
+
+        def moments_progress(fraction: float, stage: str):
+            progress(0.5 * fraction, stage)
+
+        moments = backend.moments(image, moments_progress)
+    covariance = moments.covariance()
+    covariance += np.eye(b) * (REGULARISATION * np.trace(covariance) / b + 1e-300)
+    mean = moments.mean().astype(np.float32)
+
+    with span("cholesky", bands=b):
+        lower = cholesky(covariance, lower=True)
+        # `(x - mean) @ whitening` is `L⁻¹ (x - mean)`, its squared length is the Mahalanobis distance
+        whitening = solve_triangular(lower, np.eye(b), lower=True).T.astype(np.float32)
+
+    scores = np.empty((h, w), dtype=np.float32)
+
+    def score_block(y: int):
+        block = image.get_rows(y, y + rows)
+        # Centred before the product, so that offsets of the data don't cancel out precision
+        centred = block.reshape(-1, b).astype(np.float32) - mean
+        whitened = centred @ whitening
+        scores[y : y + len(block)] = np.einsum("ij,ij->i", whitened, whitened).reshape(
+            len(block), w
+        )
+
+    rows = block_rows(w * b * 4)
+    score_block = traced("rx_block")(score_block)
+    process_blocks(score_block, h, rows, progress, "Scoring pixels", 0.5, threads)
+    return AnomalyScores(AnomalyMethod.GLOBAL, scores)
+
+
+def box_sums(column_sums: npt.NDArray[np.float64], radius: int) -> npt.NDArray:
+    """Returns sums of `column_sums` over `[x - radius, x + radius]` of every `x`, clipped at the edges."""
+    w = len(column_sums)
+    cumulative = np.zeros((w + 1,) + column_sums.shape[1:])
+    np.cumsum(column_sums, axis=0, out=cumulative[1:])
+    xs = np.arange(w)
+    return (
+        cumulative[np.minimum(xs + radius + 1, w)]
+        - cumulative[np.maximum(xs - radius, 0)]
+    )
+
+
+@traced("local_rx")
+def local_rx(
+    image: HsImage,
+    progress: ProgressCallback,
+    threads: int = BLOCK_THREADS,
+    window: int = LOCAL_WINDOW,
+    guard: int = GUARD_WINDOW,
+) -> AnomalyScores:
+    """Scores pixels against the mean and covariance of principal components in a window around them.
+    Features are extended with a constant 1, so the sum of their outer products holds the count, sums and products of
+    a window at once. Sums of window columns are updated incrementally while moving down by a row and windows are box
+    sums of columns. Strips of rows are processed in a thread pool, each starts with a full window above its first row.
+    """
+
+    def fit_progress(fraction: float, stage: str):
+        progress(0.1 * fraction, stage)
+
+    transform = fit(image, ComponentMethod.PCA, fit_progress, LOCAL_COMPONENTS)
+    h, w, b = image.data.shape
+    k = len(transform.variances)
+    outer_radius = window // 2
+    guard_radius = guard // 2
+    regularisation = np.eye(k) * (
+        REGULARISATION * max(float(transform.variances.mean()), 1e-300)
+    )
+    scores = np.empty((h, w), dtype=np.float32)
+    rows = max(4 * window, block_rows(w * b * 4))
+
+    def outer_products(z: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+        return z[:, :, np.newaxis] * z[:, np.newaxis, :]
+
+    def score_strip(y0: int):
+        y1 = min(h, y0 + rows)
+        # The row above the first window is added, then removed when moving to the first row
+        low = max(0, y0 - outer_radius - 1)
+        high = min(h, y1 + outer_radius)
+        block = image.get_rows(low, high)
+        features = to_features(block.reshape(-1, b), transform).reshape(
+            high - low, w, k
+        )
+        # Pixels with missing values are zero, so they don't count to any window
+        z = np.zeros((high - low, w, k + 1))
+        finite = np.isfinite(features).all(axis=2)
+        z[finite, 0] = 1
+        z[finite, 1:] = features[finite]
+
+        def row(y: int) -> npt.NDArray[np.float64]:
+            return z[y - low]
+
+        # Column sums of rows in the outer and guard windows of the previous row
+        outer_columns = np.zeros((w, k + 1, k + 1))
+        guard_columns = np.zeros((w, k + 1, k + 1))
+        for y in range(max(0, y0 - outer_radius - 1), min(h, y0 + outer_radius)):
+            outer_columns += outer_products(row(y))
+        for y in range(max(0, y0 - guard_radius - 1), min(h, y0 + guard_radius)):
+            guard_columns += outer_products(row(y))
+
+        for y in range(y0, y1):
+            for columns, radius in (
+                (outer_columns, outer_radius),
+                (guard_columns, guard_radius),
+            ):
+                if y + radius < h:
+                    columns += outer_products(row(y + radius))
+                if y - radius - 1 >= 0:
+                    columns -= outer_products(row(y - radius - 1))
+            sums = box_sums(outer_columns, outer_radius) - box_sums(
+                guard_columns, guard_radius
+            )
+            counts = sums[:, 0, 0]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                means = sums[:, 0, 1:] / counts[:, np.newaxis]
+                covariances = sums[:, 1:, 1:] / counts[:, np.newaxis, np.newaxis]
+            covariances -= means[:, :, np.newaxis] * means[:, np.newaxis, :]
+            covariances += regularisation
+            # Windows with fewer pixels than features have no usable covariance
+            usable = (counts > k) & (row(y)[:, 0] > 0)
+            deviations = row(y)[:, 1:] - means
+            line = np.full(w, np.nan, dtype=np.float32)
+            if usable.any():
+                solved = np.linalg.solve(
+                    covariances[usable], deviations[usable][:, :, np.newaxis]
+                )[:, :, 0]
+                line[usable] = np.einsum("ij,ij->i", deviations[usable], solved)
+            scores[y] = line
+
+    score_strip = traced("local_rx_strip")(score_strip)
+    process_blocks(score_strip, h, rows, progress, "Scoring pixels", 0.1, threads)
+    return AnomalyScores(AnomalyMethod.LOCAL, scores)
+
+
+class AnomalyDetection:
+    """RX anomaly scores of an image, cached for every method, so switching back to a method is immediate."""
+
+    def __init__(self, image: HsImage) -> None:
+        self.image = image
+        self.results: dict[AnomalyMethod, AnomalyScores] = {}
+
+    def is_ready(self, method: AnomalyMethod) -> bool:
+        return method in self.results
+
+    def scores(
+        self,
+        method: AnomalyMethod,
+        progress: ProgressCallback,
+        backend: Optional["ProcessBackend"] = None,
+    ) -> AnomalyScores:
+        result = self.results.get(method)
+        if result is None:
+            if method == AnomalyMethod.GLOBAL:
+                result = global_rx(self.image, progress, backend=backend)
+            else:
+                result = local_rx(self.image, progress)
+            self.results[method] = result
+        return result
@@ -0,0 +1,318 @@
+import ast
+import re
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from math import inf
+from typing import TYPE_CHECKING, Optional, TypeAlias
+
+import numpy as np
+import numpy.typing as npt
+
+from lib import HsImage, LabelType
+from loaders.abstract import ProgressCallback
+from tracing import span
+
+if TYPE_CHECKING:
+    from analysis.processes import ProcessBackend
+
+CHUNK_PIXELS = 1 << 16
+"""Number of pixels evaluated at once, buffers of a chunk should fit in CPU cache"""
+CACHE_BYTES = 256 << 20
+"""Memory used for recent results (virtual bands) of a single image"""
+
+BAND_NAME = re.compile(r"([RB])(\d+)(?:_(\d+))?")
+"""`R<wavelength>` refers to the band closest to a wavelength (`R532_5` is 532.5 nm), `B<index>` to a band index"""
+
+UNARY_OPERATORS: dict[type, np.ufunc] = {ast.USub: np.negative}
+BINARY_OPERATORS: dict[type, np.ufunc] = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.divide,
+    ast.Pow: np.power,
+}
+FUNCTIONS: dict[str, np.ufunc] = {
+    "abs": np.absolute,
+    "sqrt": np.sqrt,
+    "log": np.log,
+    "exp": np.exp,
+    "min": np.minimum,
+    "max": np.maximum,
+}
+
+Node: TypeAlias = tuple
+"""Node of a compiled expression: `("band", index)`, `("const", value)` or `(ufunc, *arguments)`.
+Equal subexpressions are equal tuples, so they are evaluated only once.
+"""
+Operand: TypeAlias = int | float
+"""Index of a buffer (`int`) or a constant (`float`)"""
+
+
+@dataclass
+class Program:
+    """An expression compiled to a sequence of NumPy ufunc calls on buffers holding a chunk of rows."""
+
+    bands: list[int]
+    """Band loaded into each of the first buffers"""
+    instructions: list[tuple[np.ufunc, tuple[Operand, ...], int]]
+    """Ufunc, arguments and output buffer of each step"""
+    buffers: int
+    """Number of buffers, intermediate results reuse buffers which are no longer needed"""
+    result: int
+    """Buffer with the result"""
+
+
+@dataclass
+class VirtualBand:
+    """Result of an expression, displayed like a band of the image."""
+
+    expression: str
+    values: npt.NDArray[np.float32]
+    """[height, width] values, non-finite where the expression is undefined (e.g. division by 0)"""
+    low: float
+    """Minimum of finite values"""
+    high: float
+    """Maximum of finite values"""
+
+    def normalised(self) -> npt.NDArray[np.float32]:
+        """Returns values scaled from [`low`, `high`] to [0, 1], non-finite values are 0."""
+        scale = self.high - self.low
+        scaled = (self.values - self.low) / (scale if scale > 0 else 1)
+        return np.nan_to_num(scaled, nan=0.0, posinf=0.0, neginf=0.0, copy=False)
+
+
+class BandMath:
+    """Evaluates expressions on bands of an image, e.g. `(R800 - R670) / (R800 + R670)`.
+    Only bands used by an expression are read, in chunks of rows, so that intermediate results stay small.
+    Recent results are kept as virtual bands.
+    """
+
+    def __init__(self, image: HsImage, max_bytes: int = CACHE_BYTES) -> None:
+        self.image = image
+        self.max_bytes = max_bytes
+        self._wavelengths: Optional[npt.NDArray[np.float64]] = None
+        if image.labels_type == LabelType.WAVELENGTH:
+            self._wavelengths = np.array([float(l) for l in image.labels])
+        self._cache: OrderedDict[Node, VirtualBand] = OrderedDict()
+
+    def band_index(self, name: str) -> int:
+        """Returns the index of a band referred to as `R<wavelength>` or `B<index>`."""
+        match = BAND_NAME.fullmatch(name)
+        if match is None:
+            raise ValueError(
+                f'Unknown name "{name}", use R<wavelength> or B<index> to refer to bands.'
+            )
+        kind, integer, fraction = match.groups()
+        if kind == "B":
+            if fraction is not None:
+                raise ValueError(f'Band index "{name}" must be an integer.')
+            idx = int(integer)
+            if idx >= self.image.bands:
+                raise ValueError(
+                    f"Band {idx} doesn't exist, the image has {self.image.bands} bands."
+                )
+            return idx
+
+        wavelengths = self._wavelengths
+        if wavelengths is None:
+            raise ValueError(
+                f'"{name}" refers to a wavelength, but the image has no wavelength labels, use B<index> instead.'
+            )
+        wavelength = float(f"{integer}.{fraction or 0}")
+        distances = np.abs(wavelengths - wavelength)
+        idx = int(np.argmin(distances))
+        # Wavelengths outside of the image are accepted only within the spacing of bands
+        spacing = (
+            float(np.median(np.abs(np.diff(wavelengths))))
+            if len(wavelengths) > 1
+            else 0
+        )
+        if distances[idx] > spacing:
+            raise ValueError(
+                f"No band close to {wavelength:g} nm, the image has bands from "
+                f"{wavelengths.min():g} to {wavelengths.max():g} nm."
+            )
+        return idx
+
+    def parse(self, expression: str) -> Node:
+        """Parses `expression` into a tree of nodes, constant subexpressions are computed immediately."""
+        try:
+            tree = ast.parse(expression.strip(), mode="eval")
+        except SyntaxError as err:
+            raise ValueError(err.msg[:1].upper() + err.msg[1:] + ".") from None
+        node = self._node(tree.body)
+        if node[0] == "const":
+            raise ValueError("Expression doesn't use any band.")
+        return node
+
+    def _node(self, tree: ast.expr) -> Node:
+        if isinstance(tree, ast.Constant):
+            if isinstance(tree.value, bool) or not isinstance(tree.value, (int, float)):
+                raise ValueError(f"Unsupported constant {tree.value!r}.")
+            return ("const", float(tree.value))
+        if isinstance(tree, ast.Name):
+            return ("band", self.band_index(tree.id))
+        if isinstance(tree, ast.UnaryOp):
+            if isinstance(tree.op, ast.UAdd):
+                return self._node(tree.operand)
+            if type(tree.op) in UNARY_OPERATORS:
+                return self._apply(UNARY_OPERATORS[type(tree.op)], [tree.operand])
+        if isinstance(tree, ast.BinOp) and type(tree.op) in BINARY_OPERATORS:
+            return self._apply(BINARY_OPERATORS[type(tree.op)], [tree.left, tree.right])
+        if isinstance(tree, ast.Call):
+            if not isinstance(tree.func, ast.Name) or tree.func.id not in FUNCTIONS:
+                raise ValueError(
+                    f"Unknown function, available functions: {', '.join(FUNCTIONS)}."
+                )
+            ufunc = FUNCTIONS[tree.func.id]
+            if tree.keywords or len(tree.args) != ufunc.nin:
+                raise ValueError(
+                    f"{tree.func.id}() takes {ufunc.nin} argument{'s' if ufunc.nin > 1 else ''}."
+                )
+            return self._apply(ufunc, tree.args)
+        raise ValueError(f'Unsupported expression "{ast.unparse(tree)}".')
+
+    def _apply(self, ufunc: np.ufunc, arguments: list[ast.expr]) -> Node:
+        nodes = [self._node(argument) for argument in arguments]
+        if all(node[0] == "const" for node in nodes):
+            with np.errstate(all="ignore"):
+                return ("const", float(ufunc(*(node[1] for node in nodes))))
+        return (ufunc, *nodes)
+
+    @staticmethod
+    def compile(root: Node) -> Program:
+        """Orders operations of a parsed expression and assigns buffers to their results."""
+        # Count uses of every distinct subexpression to know when its buffer can be reused
+        uses: Counter[Node] = Counter()
+        visited: set[Node] = set()
+
+        def count(node: Node):
+            if node in visited:
+                return
+            visited.add(node)
+            if node[0] not in ("band", "const"):
+                for child in node[1:]:
+                    if child[0] != "const":
+                        uses[child] += 1
+                    count(child)
+
+        count(root)
+
+        # Bands are loaded into the first buffers at the start of each chunk
+        bands = sorted({node[1] for node in visited if node[0] == "band"})
+        operands: dict[Node, int] = {("band", band): i for i, band in enumerate(bands)}
+        buffers = len(bands)
+        free: list[int] = []
+        instructions: list[tuple[np.ufunc, tuple[Operand, ...], int]] = []
+
+        def emit(node: Node) -> Operand:
+            nonlocal buffers
+            if node[0] == "const":
+                return node[1]
+            if node in operands:
+                return operands[node]
+            arguments = tuple(emit(child) for child in node[1:])
+            for child in node[1:]:
+                if child[0] != "const":
+                    uses[child] -= 1
+                    if uses[child] == 0:
+                        free.append(operands[child])
+            # Ufuncs work elementwise, so the output may be one of the arguments
+            if free:
+                out = free.pop()
+            else:
+                out = buffers
+                buffers += 1
+            instructions.append((node[0], arguments, out))
+            operands[node] = out
+            return out
+
+        result = emit(root)
+        assert isinstance(result, int)
+        return Program(bands, instructions, buffers, result)
+
+    def evaluate(
+        self,
+        expression: str,
+        progress: Optional[ProgressCallback] = None,
+        backend: Optional["ProcessBackend"] = None,
+    ) -> VirtualBand:
+        """Returns the result of `expression`, raises `ValueError` if it's invalid.
+        Chunks are evaluated by worker processes of `backend` if it's set, which report to `progress`.
+        """
+        root = self.parse(expression)
+        # Different expressions using the same bands, e.g. R800 and R801, share the result
+        band = self._cache.get(root)
+        if band is not None:
+            self._cache.move_to_end(root)
+            return band
+
+        program = BandMath.compile(root)
+        with span("band_math", expression=expression, bands=len(program.bands)):
+            if backend is None:
+                values, low, high = self.run(program)
+            else:
+                values, low, high = backend.band_math(
+                    self.image, program, progress or (lambda fraction, stage: None)
+                )
+        band = VirtualBand(expression, values, low, high)
+        self._cache[root] = band
+        while (
+            len(self._cache) > 1
+            and sum(b.values.nbytes for b in self._cache.values()) > self.max_bytes
+        ):
+            self._cache.popitem(last=False)
+        return band
+
+    def run(
+        self, program: Program, chunk_pixels: int = CHUNK_PIXELS
+    ) -> tuple[npt.NDArray[np.float32], float, float]:
+        """Evaluates `program` on chunks of rows. Returns values and their finite minimum and maximum."""
+        h, w, _ = self.image.data.shape
+        values = np.empty((h, w), dtype=np.float32)
+        low, high = self.run_rows(program, 0, h, values, chunk_pixels)
+        if low > high:
+            # No finite values
+            low = high = 0.0
+        return values, low, high
+
+    def run_rows(
+        self,
+        program: Program,
+        start: int,
+        stop: int,
+        values: npt.NDArray[np.float32],
+        chunk_pixels: int = CHUNK_PIXELS,
+    ) -> tuple[float, float]:
+        """Evaluates `program` on rows [`start`, `stop`) into `values`, which has `stop - start` rows.
+        Returns the finite minimum and maximum, `(inf, -inf)` if there are no finite values.
+        """
+        w = self.image.data.shape[1]
+        rows = max(1, min(chunk_pixels // w, stop - start))
+        # Allocated once and reused by every chunk
+        buffers = [
+            np.empty((rows, w), dtype=np.float32) for _ in range(program.buffers)
+        ]
+        low = inf
+        high = -inf
+        with np.errstate(all="ignore"):
+            for y in range(start, stop, rows):
+                n = min(rows, stop - y)
+                chunk = [buffer[:n] for buffer in buffers]
+                for i, band in enumerate(program.bands):
+                    np.copyto(
+                        chunk[i],
+                        self.image.get_band_rows(band, y, y + n),
+                        casting="unsafe",
+                    )
+                for ufunc, arguments, out in program.instructions:
+                    ufunc(
+                        *(chunk[a] if isinstance(a, int) else a for a in arguments),
+                        out=chunk[out],
+                    )
+                result = chunk[program.result]
+                values[y - start : y - start + n] = result
+                finite = np.isfinite(result)
+                low = min(low, float(np.amin(result, initial=inf, where=finite)))
+                high = max(high, float(np.amax(result, initial=-inf, where=finite)))
+        return low, high
@@ -0,0 +1,58 @@
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+import numpy as np
+import numpy.typing as npt
+
+from loaders.abstract import ProgressCallback
+from utils import complete_all
+
+T = TypeVar("T")
+
+BLOCK_BYTES = 32 << 20
+"""Size of floating point blocks of rows processed at once, limits memory used for temporary arrays"""
+BLOCK_THREADS = os.cpu_count() or 1
+"""Number of threads processing blocks, NumPy releases the GIL for most of the work"""
+
+
+def block_rows(row_bytes: int) -> int:
+    """Returns the number of rows of `row_bytes` bytes in a block of `BLOCK_BYTES`."""
+    return max(1, BLOCK_BYTES // max(1, row_bytes))
+
+
+def process_blocks(
+    process: Callable[[int], T],
+    h: int,
+    rows: int,
+    progress: ProgressCallback,
+    stage: str,
+    start: float = 0,
+    threads: int = BLOCK_THREADS,
+) -> list[T]:
+    """Calls `process` with the first row of every block of `rows` rows of `h` in a thread pool.
+    Progress from `start` to 1 is reported from the calling thread, so cancelling stops blocks which haven't started.
+    Returns results of blocks in row order.
+    """
+    done = 0
+    with ThreadPoolExecutor(threads) as executor:
+        futures = {executor.submit(process, y): y for y in range(0, h, rows)}
+
+        def block_done(future: Future[T]):
+            nonlocal done
+            future.result()
+            done += min(rows, h - futures[future])
+            progress(start + (1 - start) * done / h, stage)
+
+        complete_all(futures, block_done)
+    return [future.result() for future in futures]
+
+
+def random_pixels(
+    h: int, w: int, n: int, rng: np.random.Generator
+) -> tuple[npt.NDArray[np.intp], npt.NDArray[np.intp]]:
+    """Returns rows and columns of `n` distinct random pixels of a `h` x `w` image (all of them if it's smaller).
+    Pixels are sorted by position, so that memory mapped data is read in file order.
+    """
+    positions = np.sort(rng.choice(h * w, min(n, h * w), replace=False))
+    return np.divmod(positions, w)
@@ -0,0 +1,237 @@
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from analysis.blocks import BLOCK_THREADS, block_rows, process_blocks, random_pixels
+from analysis.components import ComponentMethod, Transform, fit
+from lib import HsImage
+from loaders.abstract import ProgressCallback
+from tracing import span, traced
+
+if TYPE_CHECKING:
+    from analysis.processes import ProcessBackend
+
+MAX_CLASSES = 64
+SAMPLE_PIXELS = 1 << 17
+"""Number of randomly chosen pixels batches are drawn from"""
+BATCH_PIXELS = 1 << 12
+MAX_ITERATIONS = 300
+TOLERANCE = 1e-3
+"""Iterations stop once no centre moves by more than this fraction of the spread of the data"""
+SEED_PIXELS = 1 << 13
+"""Number of pixels initial centres are chosen from with k-means++"""
+CLASS_SAMPLE_PIXELS = 1 << 16
+"""Maximum number of spectra used for statistics of a class"""
+NO_CLASS = 255
+"""Class of pixels with missing (non-finite) values"""
+
+
+@dataclass
+class Clustering:
+    """Result of classifying all pixels of an image."""
+
+    classes: npt.NDArray[np.uint8]
+    """[height, width] class of every pixel, `NO_CLASS` for pixels which can't be classified"""
+    counts: npt.NDArray[np.int64]
+    """Number of pixels in every class"""
+    centres: npt.NDArray[np.float32]
+    """[classes, features] centres of classes"""
+    transform: Optional[Transform]
+    """Principal components used as features or `None` if spectra are used directly"""
+
+    def class_spectra(
+        self, image: HsImage, idx: int, n: int = CLASS_SAMPLE_PIXELS, seed: int = 0
+    ) -> npt.NDArray:
+        """Returns [pixels, bands] spectra of up to `n` randomly selected pixels of class `idx`."""
+        h, w = self.classes.shape
+        positions = np.flatnonzero(self.classes == idx)
+        if len(positions) > n:
+            rng = np.random.default_rng(seed)
+            positions = np.sort(rng.choice(positions, n, replace=False))
+        ys, xs = np.divmod(positions, w)
+        return image.get_pixels(xs, ys)
+
+
+def to_features(
+    spectra: npt.NDArray, transform: Optional[Transform]
+) -> npt.NDArray[np.float32]:
+    """Converts [pixels, bands] spectra to [pixels, features] used for clustering."""
+    spectra = spectra.astype(np.float32, copy=False)
+    if transform is None:
+        return spectra
+    components = transform.components.astype(np.float32)
+    features = spectra @ components.T
+    features -= (transform.mean @ transform.components.T).astype(np.float32)
+    return features
+
+
+def nearest_centres(
+    features: npt.NDArray[np.float32], centres: npt.NDArray[np.float32]
+) -> npt.NDArray[np.intp]:
+    """Returns the index of the nearest centre of every row of `features`.
+    `|x - c|² = |x|² - 2 x·c + |c|²` and `|x|²` doesn't change the order, so a single matrix product is enough.
+    """
+    distances = features @ (centres.T * -2)
+    distances += np.einsum("ij,ij->i", centres, centres)
+    return np.argmin(distances, axis=1)
+
+
+def sample_features(
+    image: HsImage,
+    transform: Optional[Transform],
+    n: int,
+    rng: np.random.Generator,
+) -> npt.NDArray[np.float32]:
+    h, w, _ = image.data.shape
+    ys, xs = random_pixels(h, w, n, rng)
+    features = to_features(image.get_pixels(xs, ys), transform)
+    return features[np.isfinite(features).all(axis=1)]
+
+
+def seed_centres(
+    features: npt.NDArray[np.float32], k: int, rng: np.random.Generator
+) -> npt.NDArray[np.float32]:
+    """Chooses initial centres with k-means++, each next one far from the ones already chosen."""
+    # Features are in row order, candidates have to be chosen randomly to cover the whole image
+    candidates = features[
+        rng.choice(len(features), min(len(features), SEED_PIXELS), replace=False)
+    ]
+    centres = np.empty((k, features.shape[1]), dtype=np.float32)
+    centres[0] = candidates[rng.integers(len(candidates))]
+    distances = np.sum((candidates - centres[0]) ** 2, axis=1, dtype=np.float64)
+    for i in range(1, k):
+        total = distances.sum()
+        if total > 0:
+            idx = rng.choice(len(candidates), p=distances / total)
+        else:
+            # Fewer distinct spectra than classes
+            idx = rng.integers(len(candidates))
+        centres[i] = candidates[idx]
+        distances = np.minimum(
+            distances,
+            np.sum((candidates - centres[i]) ** 2, axis=1, dtype=np.float64),
+        )
+    return centres
+
+
+@traced("kmeans")
+def mini_batch_kmeans(
+    features: npt.NDArray[np.float32],
+    k: int,
+    rng: np.random.Generator,
+    progress: ProgressCallback,
+) -> tuple[npt.NDArray[np.float32], npt.NDArray[np.int64]]:
+    """Mini-batch k-means (Sculley, 2010) on sampled features.
+    Every centre moves towards the mean of its pixels in a batch with a rate decreasing with the number of pixels it has seen.
+    Returns centres and the number of pixels assigned to each.
+    """
+    centres = seed_centres(features, k, rng)
+    counts = np.zeros(k, dtype=np.int64)
+    spread = float(np.sqrt(np.mean(np.var(features, axis=0))))
+    for iteration in range(MAX_ITERATIONS):
+        progress(0.1 + 0.3 * iteration / MAX_ITERATIONS, "Finding classes")
+        batch = features[rng.integers(0, len(features), BATCH_PIXELS)]
+        nearest = nearest_centres(batch, centres)
+        batch_counts = np.bincount(nearest, minlength=k)
+        # Sums of pixels of each centre as a product with a one-hot matrix
+        one_hot = np.zeros((k, len(batch)), dtype=np.float32)
+        one_hot[nearest, np.arange(len(batch))] = 1
+        sums = one_hot @ batch
+
+        counts += batch_counts
+        seen = batch_counts > 0
+        step = (sums[seen] - batch_counts[seen, None] * centres[seen]) / counts[
+            seen, None
+        ]
+        centres[seen] += step
+        if np.max(np.abs(step), initial=0) <= TOLERANCE * spread and iteration >= 10:
+            break
+    return centres, counts
+
+
+def label_rows(
+    image: HsImage,
+    centres: npt.NDArray[np.float32],
+    transform: Optional[Transform],
+    start: int,
+    stop: int,
+    classes: npt.NDArray[np.uint8],
+) -> npt.NDArray[np.int64]:
+    """Writes classes of rows [`start`, `stop`) to the first rows of `classes`, returns the number of pixels in every class."""
+    block = image.get_rows(start, stop)
+    features = to_features(block.reshape(-1, image.bands), transform)
+    labels = nearest_centres(features, centres).astype(np.uint8)
+    if image.dtype.kind == "f":
+        labels[~np.isfinite(features).all(axis=1)] = NO_CLASS
+    classes[: len(block)] = labels.reshape(len(block), -1)
+    return np.bincount(labels, minlength=NO_CLASS + 1)
+
+
+@traced("label_pixels")
+def label_pixels(
+    image: HsImage,
+    centres: npt.NDArray[np.float32],
+    transform: Optional[Transform],
+    progress: ProgressCallback,
+    threads: int = BLOCK_THREADS,
+) -> tuple[npt.NDArray[np.uint8], npt.NDArray[np.int64]]:
+    """Assigns every pixel to the nearest centre in blocks of rows processed by a thread pool."""
+    h, w, b = image.data.shape
+    classes = np.empty((h, w), dtype=np.uint8)
+    rows = block_rows(w * b * 4)
+
+    def label_block(y: int) -> npt.NDArray[np.int64]:
+        return label_rows(image, centres, transform, y, min(h, y + rows), classes[y:])
+
+    label_block = traced("label_block")(label_block)
+    block_counts = process_blocks(
+        label_block, h, rows, progress, "Classifying pixels", 0.4, threads
+    )
+    counts = np.sum(block_counts, axis=0)
+    return classes, counts[: len(centres)]
+
+
+def cluster(
+    image: HsImage,
+    n_classes: int,
+    n_components: Optional[int],
+    progress: ProgressCallback,
+    seed: int = 0,
+    backend: Optional["ProcessBackend"] = None,
+) -> Clustering:
+    """Splits pixels of `image` into `n_classes` classes with mini-batch k-means.
+    If `n_components` is set, spectra are reduced to that many principal components first, which makes it faster.
+    Pixels are labelled by worker processes of `backend` if it's set.
+    """
+    if not 2 <= n_classes <= MAX_CLASSES:
+        raise ValueError(f"Number of classes must be between 2 and {MAX_CLASSES}.")
+    rng = np.random.default_rng(seed)
+    transform = None
+    if n_components is not None:
+
+        def fit_progress(fraction: float, stage: str):
+            progress(0.05 * fraction, stage)
+
+        transform = fit(image, ComponentMethod.PCA, fit_progress, n_components)
+
+    progress(0.05, "Sampling pixels")
+    with span("sample_features"):
+        features = sample_features(image, transform, SAMPLE_PIXELS, rng)
+    if len(features) < n_classes:
+        raise ValueError("The image has fewer pixels with finite values than classes.")
+    centres, sample_counts = mini_batch_kmeans(features, n_classes, rng, progress)
+    # Largest classes first, so that colours are stable between runs on similar images
+    centres = centres[np.argsort(-sample_counts, kind="stable")]
+    if backend is None:
+        classes, counts = label_pixels(image, centres, transform, progress)
+    else:
+
+        def label_progress(fraction: float, stage: str):
+            progress(0.4 + 0.6 * fraction, stage)
+
+        classes, counts = backend.label_pixels(
+            image, centres, transform, label_progress
+        )
+    return Clustering(classes, counts, centres, transform)
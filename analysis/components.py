@@ -0,0 +1,262 @@
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from analysis.blocks import BLOCK_THREADS, block_rows, process_blocks, random_pixels
+from lib import HsImage
+from loaders.abstract import ProgressCallback
+from tracing import span, traced
+
+SAMPLE_PIXELS = 1 << 18
+"""Number of randomly chosen pixels used to estimate covariance, smaller images are read whole"""
+STRETCH_SIGMA = 2.5
+"""Components are shown from -`STRETCH_SIGMA` to +`STRETCH_SIGMA` standard deviations"""
+NOISE_REGULARISATION = 1e-6
+"""Fraction of the mean noise variance added to all bands, keeps noise covariance invertible"""
+COMPOSITE_COMPONENTS = 3
+
+
+class ComponentMethod(Enum):
+    """Defines how components of an image are computed.
+
+    The following values are available:
+    - `PCA`
+    - `MNF`
+    """
+
+    PCA = 0
+    """Principal components ordered by variance"""
+    MNF = 1
+    """Minimum noise fraction, components ordered by signal to noise ratio, noise is estimated from differences of horizontally neighbouring pixels"""
+
+
+@dataclass
+class Transform:
+    """Linear transform of spectra into components: `components @ (spectrum - mean)`"""
+
+    method: ComponentMethod
+    mean: npt.NDArray[np.float64]
+    """Mean spectrum"""
+    components: npt.NDArray[np.float64]
+    """[components, bands] matrix"""
+    variances: npt.NDArray[np.float64]
+    """Variance of every component, for MNF in units of noise variance (signal to noise ratio)"""
+    total_variance: float
+    """Sum of variances of all bands"""
+
+    def describe(self) -> str:
+        """Returns a short description of the first components, e.g. for the status bar."""
+        if self.method == ComponentMethod.PCA:
+            explained = self.variances.sum() / max(self.total_variance, 1e-300)
+            return f"PCA: first {len(self.variances)} components explain {explained:.1%} of variance"
+        ratios = ", ".join(f"{v:.3g}" for v in self.variances)
+        return f"MNF: signal to noise ratio of components {ratios}"
+
+
+class Moments:
+    """Accumulates the mean and covariance of spectra added in blocks.
+    Values are shifted by the mean of the first block, so that data far from 0 doesn't lose precision.
+    """
+
+    def __init__(
+        self, bands: int, shift: Optional[npt.NDArray[np.float64]] = None
+    ) -> None:
+        self.count = 0
+        self.shift = shift
+        """Subtracted from all spectra, moments accumulated separately can only be merged with the same shift"""
+        self.sum = np.zeros(bands)
+        self.gram = np.zeros((bands, bands))
+
+    def add(self, spectra: npt.NDArray[np.float64]) -> None:
+        """Adds [pixels, bands] spectra, pixels with non-finite values are skipped."""
+        spectra = spectra[np.isfinite(spectra).all(axis=1)]
+        if len(spectra) == 0:
+            return
+        if self.shift is None:
+            self.shift = spectra.mean(axis=0)
+        centred = spectra - self.shift
+        self.count += len(centred)
+        self.sum += centred.sum(axis=0)
+        self.gram += centred.T @ centred
+
+    def merge(self, other: "Moments") -> None:
+        """Adds moments of spectra accumulated by `other` with the same shift."""
+        if other.count == 0:
+            return
+        if self.shift is None:
+            self.shift = other.shift
+        assert other.shift is not None and np.array_equal(self.shift, other.shift)
+        self.count += other.count
+        self.sum += other.sum
+        self.gram += other.gram
+
+    def mean(self) -> npt.NDArray[np.float64]:
+        assert self.shift is not None
+        return self.shift + self.sum / self.count
+
+    def covariance(self) -> npt.NDArray[np.float64]:
+        if self.count == 0:
+            raise ValueError("The image has no pixels with finite values.")
+        shifted_mean = self.sum / self.count
+        return self.gram / self.count - np.outer(shifted_mean, shifted_mean)
+
+
+@traced("estimate_moments")
+def estimate_moments(
+    image: HsImage,
+    noise: bool,
+    sample_pixels: int,
+    progress: ProgressCallback,
+) -> tuple[Moments, Optional[Moments]]:
+    """Returns moments of spectra and, if `noise` is set, of differences of horizontally neighbouring pixels.
+    Images with more than `sample_pixels` pixels are sampled randomly (but reproducibly), others are read whole.
+    """
+    h, w, b = image.data.shape
+    if noise and w < 2:
+        raise ValueError("Estimating noise requires an image at least 2 pixels wide.")
+    signal_moments = Moments(b)
+    noise_moments = Moments(b) if noise else None
+
+    if h * w <= sample_pixels:
+        rows = block_rows(w * b * 8)
+        for y in range(0, h, rows):
+            progress(0.5 * y / h, "Estimating covariance")
+            block = image.get_rows(y, y + rows).astype(np.float64)
+            signal_moments.add(block.reshape(-1, b))
+            if noise_moments is not None:
+                noise_moments.add((block[:, 1:] - block[:, :-1]).reshape(-1, b))
+        return signal_moments, noise_moments
+
+    # Pixels with a right neighbour are sampled, so that the same pixels give noise estimates
+    columns = w - 1 if noise else w
+    ys, xs = random_pixels(h, columns, sample_pixels, np.random.default_rng(0))
+    pixels = block_rows(b * 8)
+    for start in range(0, len(xs), pixels):
+        progress(0.5 * start / len(xs), "Sampling pixels")
+        block_xs = xs[start : start + pixels]
+        block_ys = ys[start : start + pixels]
+        spectra = image.get_pixels(block_xs, block_ys).astype(np.float64)
+        signal_moments.add(spectra)
+        if noise_moments is not None:
+            neighbours = image.get_pixels(block_xs + 1, block_ys).astype(np.float64)
+            noise_moments.add(neighbours - spectra)
+    return signal_moments, noise_moments
+
+
+def fit(
+    image: HsImage,
+    method: ComponentMethod,
+    progress: ProgressCallback,
+    n_components: int = COMPOSITE_COMPONENTS,
+    sample_pixels: int = SAMPLE_PIXELS,
+) -> Transform:
+    """Computes the transform of `image` into its first `n_components` components."""
+    from scipy.linalg import cholesky, eigh, solve_triangular
+
+    signal, noise = estimate_moments(
+        image, method == ComponentMethod.MNF, sample_pixels, progress
+    )
+    covariance = signal.covariance()
+    b = covariance.shape[0]
+    n_components = min(n_components, b)
+    # Only the largest eigenvalues are computed
+    subset = (b - n_components, b - 1)
+
+    with span("eigendecomposition", bands=b, method=method.name):
+        if noise is None:
+            variances, vectors = eigh(covariance, subset_by_index=subset)
+        else:
+            # Differences of neighbours have twice the noise variance
+            noise_covariance = noise.covariance() / 2
+            noise_covariance += np.eye(b) * (
+                NOISE_REGULARISATION * np.trace(noise_covariance) / b
+            )
+            # Whiten noise, then the principal components of whitened data are the MNF components
+            lower = cholesky(noise_covariance, lower=True)
+            whitened = solve_triangular(
+                lower, solve_triangular(lower, covariance, lower=True).T, lower=True
+            )
+            variances, vectors = eigh(whitened, subset_by_index=subset)
+            vectors = solve_triangular(lower, vectors, lower=True, trans="T")
+
+    # Eigenvalues are ascending
+    components = vectors[:, ::-1].T
+    variances = np.maximum(variances[::-1], 0)
+    # Signs of eigenvectors are arbitrary, make them reproducible
+    signs = np.sign(components.sum(axis=1))
+    signs[signs == 0] = 1
+    components *= signs[:, None]
+    return Transform(
+        method, signal.mean(), components, variances, float(np.trace(covariance))
+    )
+
+
+@traced("project_components")
+def composite(
+    image: HsImage,
+    transform: Transform,
+    progress: ProgressCallback,
+    threads: int = BLOCK_THREADS,
+) -> npt.NDArray[np.uint8]:
+    """Projects the image onto the first 3 components, returns [height, width, 3] pixels.
+    Blocks of rows are projected in a thread pool, only the result and one block per thread are kept in memory.
+    """
+    h, w, b = image.data.shape
+    components = transform.components[:COMPOSITE_COMPONENTS]
+    deviations = np.sqrt(transform.variances[:COMPOSITE_COMPONENTS])
+    scale = 255 / (2 * STRETCH_SIGMA * np.maximum(deviations, 1e-300))
+    # Stretch and centring are folded into the matrix, so a block needs a single matrix product
+    matrix = (components.T * scale).astype(np.float32)
+    # The mean is mid-grey, values are truncated when converted to integers, 0.5 makes it rounding
+    offset = (128.0 + 0.5 - (transform.mean @ components.T) * scale).astype(np.float32)
+    pixels = np.empty((h, w, len(components)), dtype=np.uint8)
+
+    def project(y: int):
+        block = image.get_rows(y, y + rows)
+        values = block.reshape(-1, b).astype(np.float32, copy=False) @ matrix
+        values += offset
+        # Pixels with missing values are black
+        np.nan_to_num(values, copy=False, nan=0.0)
+        np.clip(values, 0, 255, out=values)
+        pixels[y : y + len(block)] = values.reshape(len(block), w, -1)
+
+    rows = block_rows(w * b * 4)
+    project = traced("project_block")(project)
+    process_blocks(project, h, rows, progress, "Projecting pixels", 0.5, threads)
+    return pixels
+
+
+class ComponentAnalysis:
+    """Components of an image shown as an RGB composite of the first three.
+    Transforms and composites are cached, so switching back to a method is immediate.
+    """
+
+    def __init__(self, image: HsImage) -> None:
+        self.image = image
+        self.transforms: dict[ComponentMethod, Transform] = {}
+        self.composites: dict[ComponentMethod, npt.NDArray[np.uint8]] = {}
+
+    def is_ready(self, method: ComponentMethod) -> bool:
+        return method in self.composites
+
+    def transform(
+        self, method: ComponentMethod, progress: ProgressCallback
+    ) -> Transform:
+        transform = self.transforms.get(method)
+        if transform is None:
+            transform = self.transforms[method] = fit(self.image, method, progress)
+        return transform
+
+    def composite(
+        self, method: ComponentMethod, progress: ProgressCallback
+    ) -> npt.NDArray[np.uint8]:
+        pixels = self.composites.get(method)
+        if pixels is None:
+            transform = self.transform(method, progress)
+            pixels = self.composites[method] = composite(
+                self.image, transform, progress
+            )
+        return pixels
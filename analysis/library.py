@@ -0,0 +1,356 @@
+import csv
+import os
+from dataclasses import dataclass
+from enum import Enum
+from math import pi
+from string import whitespace
+
+import numpy as np
+import numpy.typing as npt
+
+from analysis.blocks import BLOCK_THREADS, block_rows, process_blocks
+from lib import HsImage, LabelType
+from loaders.abstract import ProgressCallback
+from tracing import traced
+
+NO_MATCH = np.iinfo(np.uint16).max
+"""Best match of pixels with missing (non-finite) values"""
+MISSING_VALUE = -1e30
+"""Values below are missing, e.g. deleted channels stored as -1.23e34 in USGS libraries"""
+ENVI_DATA_TYPES = {
+    1: np.uint8,
+    2: np.int16,
+    3: np.int32,
+    4: np.float32,
+    5: np.float64,
+    12: np.uint16,
+    13: np.uint32,
+    14: np.int64,
+    15: np.uint64,
+}
+"""NumPy types of ENVI `data type` codes"""
+
+
+class MatchMethod(Enum):
+    """Defines how similarity of a pixel and a reference spectrum is measured.
+
+    The following values are available:
+    - `SAM`
+    - `CORRELATION`
+    """
+
+    SAM = 0
+    """Spectral angle mapper, the angle between spectra in radians, smaller is more similar, doesn't depend on brightness"""
+    CORRELATION = 1
+    """Pearson correlation of values in all bands, larger is more similar, doesn't depend on brightness nor offset"""
+
+
+@dataclass
+class SpectralLibrary:
+    """Reference spectra, e.g. of minerals or vegetation."""
+
+    names: list[str]
+    wavelengths: npt.NDArray[np.float64]
+    """Ascending wavelengths in nm or band numbers if the library has no wavelengths"""
+    spectra: npt.NDArray[np.float64]
+    """[spectra, wavelengths] values, missing values are NaN"""
+
+    @staticmethod
+    def read(path: str) -> "SpectralLibrary":
+        """Reads a CSV file (wavelengths in the first column, a spectrum in every other one) or an ENVI spectral library."""
+        _, extension = os.path.splitext(path)
+        if extension.lower() in (".sli", ".hdr"):
+            library = SpectralLibrary.read_envi(path)
+        else:
+            library = SpectralLibrary.read_csv(path)
+        if len(library.names) == 0:
+            raise ValueError("The library has no spectra.")
+        if len(library.names) >= NO_MATCH:
+            raise ValueError(f"Libraries can have at most {NO_MATCH - 1} spectra.")
+        return library.sorted()
+
+    @staticmethod
+    def read_csv(path: str) -> "SpectralLibrary":
+        with open(path, newline="", encoding="utf-8-sig") as file:
+            sample = file.read(1 << 16)
+            file.seek(0)
+            try:
+                dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+            except csv.Error:
+                dialect = csv.excel
+            rows = [row for row in csv.reader(file, dialect) if row]
+        if len(rows) < 2:
+            raise ValueError("The library must have at least 2 wavelengths.")
+
+        try:
+            float(rows[0][0])
+            names = [f"Spectrum {i + 1}" for i in range(len(rows[0]) - 1)]
+        except ValueError:
+            # Header with names of spectra
+            names = [name.strip() for name in rows[0][1:]]
+            rows = rows[1:]
+
+        values = np.full((len(rows), len(names) + 1), np.nan)
+        for i, row in enumerate(rows):
+            for j, value in enumerate(row[: len(names) + 1]):
+                try:
+                    values[i, j] = float(value)
+                except ValueError:
+                    # Empty or invalid values are missing
+                    pass
+        wavelengths = values[:, 0]
+        if not np.isfinite(wavelengths).all():
+            raise ValueError("Every row must start with a wavelength.")
+        return SpectralLibrary(names, to_nanometres(wavelengths), values[:, 1:].T)
+
+    @staticmethod
+    def read_envi(path: str) -> "SpectralLibrary":
+        base, extension = os.path.splitext(path)
+        if extension.lower() == ".hdr":
+            header_path = path
+            candidates = [base + ".sli", base]
+        else:
+            header_path = next(
+                (p for p in (base + ".hdr", path + ".hdr") if os.path.exists(p)),
+                base + ".hdr",
+            )
+            candidates = [path]
+        data_path = next((p for p in candidates if os.path.exists(p)), candidates[0])
+
+        header = read_envi_header(header_path)
+        try:
+            samples = int(header["samples"])
+            lines = int(header["lines"])
+            dtype = np.dtype(ENVI_DATA_TYPES[int(header.get("data type", "4"))])
+        except (KeyError, ValueError) as err:
+            raise ValueError(f"Invalid ENVI header {header_path}: {err}") from None
+        if int(header.get("bands", "1")) != 1:
+            raise ValueError("ENVI spectral libraries must have a single band.")
+        if header.get("byte order", "0").strip() == "1":
+            dtype = dtype.newbyteorder(">")
+        offset = int(header.get("header offset", "0"))
+
+        data = np.fromfile(data_path, dtype=dtype, count=samples * lines, offset=offset)
+        if data.size != samples * lines:
+            raise ValueError(f"{data_path} is shorter than described by its header.")
+        spectra = data.reshape(lines, samples).astype(np.float64)
+        scale = float(header.get("reflectance scale factor", "1") or 1)
+        spectra /= scale
+
+        if "wavelength" in header:
+            wavelengths = np.array(envi_list(header["wavelength"]), dtype=np.float64)
+            if header.get("wavelength units", "").lower().startswith("micro"):
+                wavelengths *= 1000
+            wavelengths = to_nanometres(wavelengths)
+        else:
+            wavelengths = np.arange(samples, dtype=np.float64)
+        if len(wavelengths) != samples:
+            raise ValueError("Number of wavelengths differs from number of samples.")
+        names = envi_list(header.get("spectra names", ""))
+        if len(names) != lines:
+            names = [f"Spectrum {i + 1}" for i in range(lines)]
+        return SpectralLibrary(names, wavelengths, spectra)
+
+    def sorted(self) -> "SpectralLibrary":
+        """Returns the library with ascending wavelengths and missing values replaced by NaN."""
+        order = np.argsort(self.wavelengths, kind="stable")
+        spectra = self.spectra[:, order]
+        spectra[~(spectra > MISSING_VALUE)] = np.nan
+        return SpectralLibrary(self.names, self.wavelengths[order], spectra)
+
+    def resample(
+        self, image: HsImage
+    ) -> tuple[npt.NDArray[np.float64], npt.NDArray[np.bool_]]:
+        """Returns [spectra, bands] values at bands of `image` and a mask of bands where all spectra have values.
+        Each value is the mean of the library spectrum over the width of the band (the spacing of neighbouring bands),
+        so that finely sampled libraries aren't aliased.
+        """
+        if image.labels_type == LabelType.WAVELENGTH:
+            targets = np.array([float(l) for l in image.labels])
+            order = np.argsort(targets)
+            widths = np.empty_like(targets)
+            widths[order] = np.gradient(targets[order]) if len(targets) > 1 else 0
+            resampled = np.array(
+                [
+                    band_means(self.wavelengths, spectrum, targets, widths)
+                    for spectrum in self.spectra
+                ]
+            )
+        elif self.spectra.shape[1] == image.bands:
+            # Without wavelengths, bands are matched by their order
+            resampled = self.spectra.copy()
+        else:
+            raise ValueError(
+                f"The image has no wavelength labels and the library has {self.spectra.shape[1]} "
+                f"values instead of {image.bands}, so they can't be compared."
+            )
+        bands = np.isfinite(resampled).all(axis=0)
+        if np.count_nonzero(bands) < 2:
+            raise ValueError("The library doesn't cover wavelengths of the image.")
+        return resampled, bands
+
+
+def to_nanometres(wavelengths: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    """Converts wavelengths in micrometres, which are common in libraries, to nanometres used by images."""
+    if len(wavelengths) and np.nanmax(wavelengths) < 100:
+        return wavelengths * 1000
+    return wavelengths
+
+
+def read_envi_header(path: str) -> dict[str, str]:
+    """Returns lowercase keys and raw values of an ENVI header, values in braces can span lines."""
+    with open(path, encoding="utf-8", errors="replace") as file:
+        text = file.read()
+    if not text.startswith("ENVI"):
+        raise ValueError(f"{path} is not an ENVI header.")
+    header: dict[str, str] = {}
+    lines = iter(text.splitlines()[1:])
+    for line in lines:
+        if "=" not in line:
+            continue
+        key, value = line.split("=", 1)
+        value = value.strip()
+        if value.startswith("{"):
+            while "}" not in value:
+                value += "\n" + next(lines, "}")
+        header[key.strip().lower()] = value
+    return header
+
+
+def envi_list(value: str) -> list[str]:
+    """Splits an ENVI header value `{a, b, c}` into items."""
+    return [
+        item.strip()
+        for item in value.strip(whitespace + "{}").split(",")
+        if item.strip()
+    ]
+
+
+def band_means(
+    wavelengths: npt.NDArray[np.float64],
+    values: npt.NDArray[np.float64],
+    targets: npt.NDArray[np.float64],
+    widths: npt.NDArray[np.float64],
+) -> npt.NDArray[np.float64]:
+    """Returns means of the piecewise linear spectrum over [target - width / 2, target + width / 2] of every target.
+    Targets outside of the spectrum are NaN.
+    """
+    valid = np.isfinite(values)
+    wavelengths = wavelengths[valid]
+    values = values[valid]
+    result = np.full(len(targets), np.nan)
+    if len(wavelengths) < 2:
+        return result
+    # Integral of the spectrum from its first wavelength, means are differences of integrals
+    integral = np.concatenate(
+        ([0], np.cumsum((values[1:] + values[:-1]) / 2 * np.diff(wavelengths)))
+    )
+    first, last = wavelengths[0], wavelengths[-1]
+    low = np.clip(targets - widths / 2, first, last)
+    high = np.clip(targets + widths / 2, first, last)
+    span = high - low
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = (
+            np.interp(high, wavelengths, integral)
+            - np.interp(low, wavelengths, integral)
+        ) / span
+    # Bands narrower than the sampling of the library
+    narrow = ~(span > 0)
+    means[narrow] = np.interp(targets[narrow], wavelengths, values)
+    inside = (targets >= first) & (targets <= last)
+    result[inside] = means[inside]
+    return result
+
+
+@dataclass
+class LibraryMatch:
+    """The most similar library spectrum of every pixel."""
+
+    method: MatchMethod
+    names: list[str]
+    best: npt.NDArray[np.uint16]
+    """[height, width] index of the most similar spectrum, `NO_MATCH` for pixels with missing values"""
+    scores: npt.NDArray[np.float32]
+    """[height, width] similarity to the best match, angle in radians for `MatchMethod.SAM`, correlation otherwise"""
+
+    def similarity(self) -> npt.NDArray[np.float32]:
+        """Returns scores mapped to [0, 1], 1 means identical shape."""
+        if self.method == MatchMethod.SAM:
+            similarity = 1 - self.scores * np.float32(2 / pi)
+        else:
+            similarity = self.scores.copy()
+        np.nan_to_num(similarity, copy=False, nan=0.0)
+        return np.clip(similarity, 0, 1, out=similarity)
+
+    def describe(self, x: int, y: int) -> str:
+        """Describes the best match of a pixel, e.g. for the status bar."""
+        idx = int(self.best[y, x])
+        if idx == NO_MATCH:
+            return "No match, the pixel has missing values"
+        score = float(self.scores[y, x])
+        if self.method == MatchMethod.SAM:
+            return f"Best match: {self.names[idx]}, spectral angle {score:.4f} rad"
+        return f"Best match: {self.names[idx]}, correlation {score:.4f}"
+
+
+@traced("match_library")
+def match_library(
+    image: HsImage,
+    library: SpectralLibrary,
+    method: MatchMethod,
+    progress: ProgressCallback,
+    threads: int = BLOCK_THREADS,
+) -> LibraryMatch:
+    """Finds the most similar library spectrum of every pixel.
+    Similarities of a block of rows to all spectra are a single matrix product, blocks are processed by a thread pool.
+    """
+    progress(0, "Resampling library")
+    references, bands = library.resample(image)
+    references = references[:, bands]
+    all_bands = bool(bands.all())
+    n_bands = references.shape[1]
+
+    if method == MatchMethod.CORRELATION:
+        # Correlation is the cosine of centred spectra
+        references = references - references.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(references, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    # References with unit length, so that products are cosines once divided by the pixel norm
+    matrix = (references / norms).T.astype(np.float32)
+
+    h, w, _ = image.data.shape
+    best = np.empty((h, w), dtype=np.uint16)
+    scores = np.empty((h, w), dtype=np.float32)
+    rows = block_rows(w * 4 * (n_bands + len(library.names)))
+
+    def match_block(y: int):
+        block = image.get_rows(y, y + rows)
+        n_rows = len(block)
+        pixels = block.reshape(-1, block.shape[2])
+        if not all_bands:
+            pixels = pixels[:, bands]
+        pixels = pixels.astype(np.float32, copy=False)
+        if method == MatchMethod.CORRELATION:
+            # Centred before the products, subtracting the squared mean afterwards cancels out precision of spectra
+            # with a large offset. The mean stays in float64 until the difference is rounded.
+            mean = pixels.mean(axis=1, keepdims=True, dtype=np.float64)
+            pixels = np.subtract(
+                pixels, mean, out=np.empty_like(pixels), casting="same_kind"
+            )
+        products = pixels @ matrix
+        squares = np.einsum("ij,ij->i", pixels, pixels)
+        idx = np.argmax(products, axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            cosines = products[np.arange(len(idx)), idx] / np.sqrt(squares)
+        np.clip(cosines, -1, 1, out=cosines)
+        missing = ~np.isfinite(cosines)
+        if method == MatchMethod.SAM:
+            cosines = np.arccos(cosines)
+        idx = idx.astype(np.uint16)
+        idx[missing] = NO_MATCH
+        best[y : y + n_rows] = idx.reshape(n_rows, w)
+        scores[y : y + n_rows] = cosines.reshape(n_rows, w)
+
+    match_block = traced("match_block")(match_block)
+    process_blocks(match_block, h, rows, progress, "Matching pixels", 0, threads)
+    return LibraryMatch(method, library.names, best, scores)
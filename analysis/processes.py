@@ -0,0 +1,560 @@
+import mmap
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from itertools import count
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from analysis.band_math import BandMath, Program
+from analysis.blocks import block_rows
+from analysis.clustering import NO_CLASS, label_rows
+from analysis.components import Moments, Transform
+from lib import (
+    SIMILAR_CHUNK_PIXELS,
+    Coordinates,
+    DualLayout,
+    HsImage,
+    ImageStatistics,
+    LabelType,
+    NormalisationMethod,
+    Quantisation,
+)
+from loaders.abstract import ProgressCallback
+from tracing import span
+from utils import complete_all
+
+PROCESS_WORKERS = os.cpu_count() or 1
+COPY_BYTES = 64 << 20
+"""Size of chunks copied to shared memory at once, limits temporary arrays of lazily loaded data"""
+CANCEL_SLOTS = 256
+"""Number of jobs which can be cancelled independently"""
+FORGET_TIMEOUT = 60.0
+"""Seconds a worker waits for the others to drop a forgotten image, they may be finishing blocks of a running job"""
+
+
+@dataclass(frozen=True)
+class SharedArray:
+    """Describes an array other processes can map without copying it: a block of shared memory or a region of a file."""
+
+    shape: tuple[int, ...]
+    dtype: str
+    strides: tuple[int, ...]
+    offset: int
+    """Offset of the first element in the shared memory block or the mapped region of the file"""
+    memory: Optional[str] = None
+    """Name of the shared memory block"""
+    path: Optional[str] = None
+    """Path of the memory mapped file"""
+    file_offset: int = 0
+    """Start of the mapped region of the file"""
+    length: int = 0
+    """Length of the mapped region of the file"""
+
+    @staticmethod
+    def of_memmap(array: npt.NDArray) -> Optional["SharedArray"]:
+        """Describes a view of a memory mapped file, e.g. an image restored from the cache, or returns `None`."""
+        root = array
+        while root is not None and not isinstance(root.base, mmap.mmap):
+            root = root.base if isinstance(root.base, np.ndarray) else None
+        if (
+            not isinstance(root, np.memmap)
+            or root.filename is None
+            or any(stride < 0 for stride in array.strides)
+        ):
+            return None
+        offset = (
+            array.__array_interface__["data"][0] - root.__array_interface__["data"][0]
+        )
+        return SharedArray(
+            array.shape,
+            array.dtype.str,
+            array.strides,
+            offset,
+            path=root.filename,
+            file_offset=root.offset,
+            length=root.nbytes,
+        )
+
+    def open(self) -> tuple[npt.NDArray, Any]:
+        """Maps the array, returns it and the handle which has to be kept while the array is used."""
+        handle: Any
+        if self.memory is not None:
+            handle = SharedMemory(self.memory)
+            buffer = handle.buf
+        else:
+            assert self.path is not None
+            handle = buffer = np.memmap(
+                self.path, np.uint8, "r", self.file_offset, (self.length,)
+            )
+        array = np.ndarray(
+            self.shape, np.dtype(self.dtype), buffer, self.offset, self.strides
+        )
+        return array, handle
+
+
+class SharedBuffer:
+    """An array in shared memory created by this process, other processes map it using `shared`."""
+
+    def __init__(self, shape: tuple[int, ...], dtype: npt.DTypeLike) -> None:
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        self.memory = SharedMemory(create=True, size=max(1, size))
+        self.array: npt.NDArray = np.ndarray(shape, dtype, self.memory.buf)
+        self.shared = SharedArray(
+            tuple(shape), dtype.str, self.array.strides, 0, memory=self.memory.name
+        )
+
+    @staticmethod
+    def copy_of(array: npt.NDArray) -> "SharedBuffer":
+        """Copies `array` to shared memory in chunks of rows."""
+        buffer = SharedBuffer(array.shape, array.dtype)
+        rows = max(1, COPY_BYTES // max(1, array[0].nbytes))
+        for y in range(0, len(array), rows):
+            buffer.array[y : y + rows] = array[y : y + rows]
+        return buffer
+
+    def release(self) -> None:
+        # The array exports the buffer, so it must be gone before closing
+        del self.array
+        self.memory.close()
+        self.memory.unlink()
+
+
+@dataclass
+class SharedImage:
+    """Everything worker processes need to use an `HsImage` without copying its data."""
+
+    key: int
+    """Unique for every image shared by a backend, workers keep the latest image mapped"""
+    data: SharedArray
+    pos_mask: Optional[SharedArray]
+    """Mask of non-negative values, only needed for normalising floating point data"""
+    bpp: Optional[int]
+    normalisation: Optional[NormalisationMethod]
+    norm_min: Optional[npt.NDArray[np.floating] | float]
+    norm_div: Optional[npt.NDArray[np.floating] | float]
+    quantisation: Optional[Quantisation]
+    labels: list[str]
+    labels_type: LabelType
+
+
+@dataclass
+class SharedEntry:
+    """An image shared with workers and the number of jobs using it."""
+
+    image: HsImage
+    shared: SharedImage
+    buffers: list[SharedBuffer]
+    jobs: int = 0
+    forgotten: bool = False
+    """Set once the image isn't used anymore, it's released even if it's the latest image"""
+
+
+# ****** State of worker processes ******
+
+_cancel_flags: Optional[npt.NDArray[np.uint8]] = None
+_cancel_handle: Any = None
+_barrier: Any = None
+_image: Optional[tuple[int, HsImage, list[Any]]] = None
+"""Key, image and handles of its mapped arrays, only the latest image stays mapped"""
+
+
+def _init_worker(cancel_flags: SharedArray, barrier: Any) -> None:
+    global _cancel_flags, _cancel_handle, _barrier
+    _cancel_flags, _cancel_handle = cancel_flags.open()
+    _barrier = barrier
+
+
+def _cancelled(slot: int) -> bool:
+    return _cancel_flags is not None and bool(_cancel_flags[slot])
+
+
+def _open_image(shared: SharedImage) -> HsImage:
+    global _image
+    if _image is not None and _image[0] == shared.key:
+        return _image[1]
+    _image = None
+    data, data_handle = shared.data.open()
+    handles = [data_handle]
+    if shared.pos_mask is not None:
+        pos_mask, mask_handle = shared.pos_mask.open()
+        handles.append(mask_handle)
+    else:
+        # Integer data isn't normalised, so the mask isn't used
+        pos_mask = np.broadcast_to(np.True_, data.shape)
+    image = HsImage(
+        data,
+        bpp=shared.bpp,
+        normalisation=shared.normalisation,
+        labels=shared.labels,
+        labels_type=shared.labels_type,
+        statistics=ImageStatistics(pos_mask, shared.norm_min, shared.norm_div),
+        dual_layout=DualLayout.OFF,
+        quantisation=shared.quantisation,
+    )
+    _image = (shared.key, image, handles)
+    return image
+
+
+def _forget_image(key: int) -> None:
+    """Drops the mapping of the image with `key`, then waits for the other workers,
+    so that every worker runs one of the tasks submitted for all of them.
+    """
+    global _image
+    if _image is not None and _image[0] == key:
+        _image = None
+    try:
+        _barrier.wait(FORGET_TIMEOUT)
+    except threading.BrokenBarrierError:
+        pass
+
+
+def _write(out: SharedArray, start: int, values: npt.NDArray) -> None:
+    """Copies `values` to rows of the output buffer starting at `start`."""
+    array, handle = out.open()
+    try:
+        array[start : start + len(values)] = values
+    finally:
+        # The array exports the buffer, so it must be gone before closing
+        del array
+        handle.close()
+
+
+def _similar_kernel(
+    slot: int,
+    shared: SharedImage,
+    start: int,
+    stop: int,
+    base: npt.NDArray[np.floating],
+    threshold: float,
+    out: SharedArray,
+) -> int:
+    image = _open_image(shared)
+    rows = max(1, SIMILAR_CHUNK_PIXELS // image.data.shape[1])
+    for y in range(start, stop, rows):
+        if _cancelled(slot):
+            break
+        _write(out, y, image.similar_rows(base, threshold, y, min(stop, y + rows)))
+    return stop - start
+
+
+def _moments_kernel(
+    slot: int,
+    shared: SharedImage,
+    start: int,
+    stop: int,
+    shift: npt.NDArray[np.float64],
+) -> Moments:
+    image = _open_image(shared)
+    moments = Moments(image.bands, shift)
+    if not _cancelled(slot):
+        block = image.get_rows(start, stop).astype(np.float64)
+        moments.add(block.reshape(-1, image.bands))
+    return moments
+
+
+def _band_math_kernel(
+    slot: int,
+    shared: SharedImage,
+    start: int,
+    stop: int,
+    program: Program,
+    out: SharedArray,
+) -> tuple[float, float]:
+    if _cancelled(slot):
+        return np.inf, -np.inf
+    image = _open_image(shared)
+    values = np.empty((stop - start, image.data.shape[1]), dtype=np.float32)
+    low, high = BandMath(image).run_rows(program, start, stop, values)
+    _write(out, start, values)
+    return low, high
+
+
+def _label_kernel(
+    slot: int,
+    shared: SharedImage,
+    start: int,
+    stop: int,
+    centres: npt.NDArray[np.float32],
+    transform: Optional[Transform],
+    out: SharedArray,
+) -> npt.NDArray[np.int64]:
+    if _cancelled(slot):
+        return np.zeros(NO_CLASS + 1, dtype=np.int64)
+    image = _open_image(shared)
+    classes = np.empty((stop - start, image.data.shape[1]), dtype=np.uint8)
+    counts = label_rows(image, centres, transform, start, stop, classes)
+    _write(out, start, classes)
+    return counts
+
+
+class ProcessBackend:
+    """A persistent pool of worker processes for heavy analysis, which doesn't compete with the GUI for the GIL.
+    The image is shared with workers once, memory mapped files (e.g. cached images) are mapped by path, other data is
+    copied to shared memory. Kernels process blocks of rows and write results to shared output buffers.
+    Jobs are cancelled by raising from their progress callback, workers skip the remaining blocks.
+    """
+
+    def __init__(self, workers: int = PROCESS_WORKERS) -> None:
+        self.workers = workers
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.cancel_flags = SharedBuffer((CANCEL_SLOTS,), np.uint8)
+        self.cancel_flags.array[:] = 0
+        self.barrier = get_context("spawn").Barrier(workers)
+        """Makes every worker run one of the tasks dropping a forgotten image"""
+        self.jobs = count()
+        self.keys = count()
+        self.entries: list[SharedEntry] = []
+        """Shared images, the last one is the current image"""
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            # Forking a process with GUI threads isn't safe, workers start fresh and import only analysis modules
+            self.executor = ProcessPoolExecutor(
+                self.workers,
+                mp_context=get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.cancel_flags.shared, self.barrier),
+            )
+        return self.executor
+
+    @staticmethod
+    def share_array(array: npt.NDArray) -> tuple[SharedArray, Optional[SharedBuffer]]:
+        shared = SharedArray.of_memmap(array)
+        if shared is not None:
+            return shared, None
+        buffer = SharedBuffer.copy_of(array)
+        return buffer.shared, buffer
+
+    def _acquire(self, image: HsImage) -> SharedEntry:
+        with self.lock:
+            entry = next((e for e in self.entries if e.image is image), None)
+            if entry is None:
+                with span("share_image"):
+                    buffers = []
+                    data, buffer = ProcessBackend.share_array(image.data)
+                    if buffer is not None:
+                        buffers.append(buffer)
+                    pos_mask = None
+                    if image.normalisation is not None:
+                        pos_mask, buffer = ProcessBackend.share_array(image.pos_mask)
+                        if buffer is not None:
+                            buffers.append(buffer)
+                shared = SharedImage(
+                    next(self.keys),
+                    data,
+                    pos_mask,
+                    image.bpp,
+                    image.normalisation,
+                    image.norm_min,
+                    image.norm_div,
+                    image.quantisation,
+                    image.labels,
+                    image.labels_type,
+                )
+                entry = SharedEntry(image, shared, buffers)
+            else:
+                self.entries.remove(entry)
+            self.entries.append(entry)
+            entry.jobs += 1
+            return entry
+
+    def _release_unused(self) -> None:
+        """Releases older and forgotten images once no job uses them, has to be called with the lock."""
+        current = self.entries[-1] if self.entries else None
+        for entry in list(self.entries):
+            if entry.jobs == 0 and (entry is not current or entry.forgotten):
+                for buffer in entry.buffers:
+                    buffer.release()
+                self.entries.remove(entry)
+
+    def _release(self, entry: SharedEntry) -> None:
+        with self.lock:
+            entry.jobs -= 1
+            self._release_unused()
+
+    def forget(self, image: HsImage) -> None:
+        """Releases `image` once no job uses it and makes workers drop their mapping of it,
+        e.g. when another image is loaded, so that its memory isn't kept until the next job.
+        """
+        with self.lock:
+            entry = next((e for e in self.entries if e.image is image), None)
+            if entry is None:
+                return
+            entry.forgotten = True
+            self._release_unused()
+        if self.executor is None:
+            return
+        if self.barrier.broken:
+            self.barrier.reset()
+        # Tasks are queued after blocks of running jobs, workers wait for each other, so each drops the image
+        for _ in range(self.workers):
+            self.executor.submit(_forget_image, entry.shared.key)
+
+    def run(
+        self,
+        kernel: Callable[..., Any],
+        image: HsImage,
+        rows: int,
+        progress: ProgressCallback,
+        stage: str,
+        *args: Any,
+    ) -> list[Any]:
+        """Runs `kernel(slot, shared_image, start, stop, *args)` for every block of `rows` rows, returns results in order."""
+        h = image.data.shape[0]
+        entry = self._acquire(image)
+        slot = next(self.jobs) % CANCEL_SLOTS
+        self.cancel_flags.array[slot] = 0
+        try:
+            executor = self._executor()
+            futures: dict[Future, int] = {
+                executor.submit(
+                    kernel, slot, entry.shared, y, min(h, y + rows), *args
+                ): y
+                for y in range(0, h, rows)
+            }
+            done = 0
+
+            def block_done(future: Future):
+                nonlocal done
+                future.result()
+                done += min(rows, h - futures[future])
+                progress(done / h, stage)
+
+            try:
+                complete_all(futures, block_done)
+            except BaseException:
+                # Blocks already sent to workers check the flag, so they finish almost immediately
+                self.cancel_flags.array[slot] = 1
+                # Output buffers are released by the caller, no worker may use them afterwards
+                wait(futures)
+                raise
+            return [future.result() for future in futures]
+        finally:
+            self._release(entry)
+
+    def block_rows(self, image: HsImage) -> int:
+        h, w, b = image.data.shape
+        rows = block_rows(w * b * 4)
+        # At least a few blocks per worker, so that they finish at about the same time
+        return max(1, min(rows, -(-h // (4 * self.workers))))
+
+    def similar(
+        self,
+        image: HsImage,
+        base_coordinates: Coordinates,
+        threshold_percent: float,
+        progress: ProgressCallback,
+    ) -> npt.NDArray[np.bool_]:
+        """Same as `HsImage.get_similar`."""
+        base, threshold = image.similarity_base(base_coordinates, threshold_percent)
+        out = SharedBuffer(image.data.shape[:2], np.bool_)
+        try:
+            self.run(
+                _similar_kernel,
+                image,
+                self.block_rows(image),
+                progress,
+                "Comparing pixels",
+                base,
+                threshold,
+                out.shared,
+            )
+            return out.array.copy()
+        finally:
+            out.release()
+
+    def moments(self, image: HsImage, progress: ProgressCallback) -> Moments:
+        """Returns moments of all spectra of `image`."""
+        # Blocks are merged, so they must share the shift, mean of the first row is close enough to the mean
+        first = image.get_rows(0, 1)[0].astype(np.float64)
+        first = first[np.isfinite(first).all(axis=1)]
+        shift = first.mean(axis=0) if len(first) else np.zeros(image.bands)
+        moments = Moments(image.bands, shift)
+        for block in self.run(
+            _moments_kernel,
+            image,
+            self.block_rows(image),
+            progress,
+            "Estimating covariance",
+            shift,
+        ):
+            moments.merge(block)
+        return moments
+
+    def band_math(
+        self, image: HsImage, program: Program, progress: ProgressCallback
+    ) -> tuple[npt.NDArray[np.float32], float, float]:
+        """Same as `BandMath.run`."""
+        out = SharedBuffer(image.data.shape[:2], np.float32)
+        try:
+            ranges = self.run(
+                _band_math_kernel,
+                image,
+                self.block_rows(image),
+                progress,
+                "Evaluating expression",
+                program,
+                out.shared,
+            )
+            values = out.array.copy()
+        finally:
+            out.release()
+        low = min(low for low, _ in ranges)
+        high = max(high for _, high in ranges)
+        if low > high:
+            # No finite values
+            low = high = 0.0
+        return values, low, high
+
+    def label_pixels(
+        self,
+        image: HsImage,
+        centres: npt.NDArray[np.float32],
+        transform: Optional[Transform],
+        progress: ProgressCallback,
+    ) -> tuple[npt.NDArray[np.uint8], npt.NDArray[np.int64]]:
+        """Same as `clustering.label_pixels`."""
+        out = SharedBuffer(image.data.shape[:2], np.uint8)
+        try:
+            counts = sum(
+                self.run(
+                    _label_kernel,
+                    image,
+                    self.block_rows(image),
+                    progress,
+                    "Classifying pixels",
+                    centres,
+                    transform,
+                    out.shared,
+                )
+            )
+            classes = out.array.copy()
+        finally:
+            out.release()
+        return classes, counts[: len(centres)]
+
+    def close(self) -> None:
+        """Stops workers and frees shared memory, the backend can't be used afterwards."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.executor is not None:
+            # Workers waiting for the others to drop an image return immediately
+            self.barrier.abort()
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+        with self.lock:
+            for entry in self.entries:
+                for buffer in entry.buffers:
+                    buffer.release()
+            self.entries.clear()
+        self.cancel_flags.release()
@@ -0,0 +1,181 @@
+"""Checks that `kernels` give the same results as NumPy code of `HsImage` and compares their speed,
+run with `python -m benchmarks.kernels`. Without Numba kernels run as Python functions, so use a small size.
+"""
+
+import argparse
+import sys
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Callable
+
+import numpy as np
+import numpy.typing as npt
+
+import kernels
+from benchmarks.synthetic import INT_BPP, CubeSpec, make_cube
+from lib import HsImage, NormalisationMethod
+
+SIMILAR_PERCENTS = [0.01, 0.1, 1.0]
+SIMILAR_TOLERANCE = 1e-4
+"""Relative distance from the threshold of MSE of pixels which may be classified differently, NumPy computes in f32"""
+
+
+@dataclass
+class Result:
+    name: str
+    mismatches: int
+    numpy_time: float
+    kernels_time: float
+
+
+def timed(func: Callable[[], npt.NDArray], repeat: int) -> tuple[npt.NDArray, float]:
+    """Returns the result of `func` and the best time of `repeat` calls."""
+    best = np.inf
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func()
+        best = min(best, perf_counter() - start)
+    return result, best
+
+
+def compare(
+    name: str,
+    func: Callable[[], npt.NDArray],
+    mismatches: Callable[[npt.NDArray, npt.NDArray], int],
+    repeat: int,
+) -> Result:
+    """Runs `func` with NumPy code and with kernels, `mismatches` counts unacceptable differences of their results."""
+    enabled = kernels.enabled
+    try:
+        kernels.enabled = False
+        expected, numpy_time = timed(func, repeat)
+        kernels.enabled = True
+        actual, kernels_time = timed(func, repeat)
+    finally:
+        kernels.enabled = enabled
+    if expected.shape != actual.shape or expected.dtype != actual.dtype:
+        return Result(name, expected.size, numpy_time, kernels_time)
+    return Result(name, mismatches(expected, actual), numpy_time, kernels_time)
+
+
+def exact(expected: npt.NDArray, actual: npt.NDArray) -> int:
+    return int(np.count_nonzero(expected != actual))
+
+
+def make_images(size: tuple[int, int, int]) -> list[tuple[str, HsImage]]:
+    h, w, b = size
+    cube = make_cube(CubeSpec(h, w, b, "float32", "bip"))
+    # Negative values are masked out by normalisation
+    cube[:: max(1, h // 7), :: max(1, w // 5), ::3] = -1
+    images = []
+    for bpp in (INT_BPP, 16):
+        data = make_cube(CubeSpec(h, w, b, "uint16", "bip")) << (bpp - INT_BPP)
+        # Saturated values check that rounding to 8 bits doesn't overflow
+        data[0] = (1 << bpp) - 1
+        images.append((f"uint16 {bpp} bpp", HsImage(data, bpp=bpp)))
+    for method in NormalisationMethod:
+        images.append(
+            (f"float32 {method.name.lower()}", HsImage(cube, normalisation=method))
+        )
+    float_image = HsImage(cube, normalisation=NormalisationMethod.GLOBAL)
+    quantised, quantisation, _ = HsImage.quantise(cube)
+    images.append(
+        (
+            "quantised",
+            HsImage(
+                quantised,
+                normalisation=NormalisationMethod.GLOBAL,
+                statistics=float_image.statistics(),
+                quantisation=quantisation,
+            ),
+        )
+    )
+    return images
+
+
+def check_image(name: str, image: HsImage, repeat: int) -> list[Result]:
+    h, w, _ = image.data.shape
+    results = []
+    integer = image.data.dtype.kind in "iu" and image.quantisation is None
+    if integer:
+        band = image.get_band(0)
+        rgb = image.get_RGB_bands(0, 1, 2)
+        results.append(
+            compare(f"{name} as_8bpp band", lambda: image.as_8bpp(band), exact, repeat)
+        )
+        results.append(
+            compare(f"{name} as_8bpp RGB", lambda: image.as_8bpp(rgb), exact, repeat)
+        )
+    else:
+        results.append(compare(f"{name} normalised", image.normalised, exact, repeat))
+
+    # Reference MSE of all pixels in f64 decides which differences are borderline
+    kernels.enabled, enabled = False, kernels.enabled
+    try:
+        normalised = image.normalised().astype(np.float64)
+    finally:
+        kernels.enabled = enabled
+    coordinates = (w // 3, h // 2)
+    x, y = coordinates
+    mse = np.square(normalised - normalised[y, x]).mean(axis=2)
+    for percent in SIMILAR_PERCENTS:
+        _, threshold = image.similarity_base(coordinates, percent)
+
+        def mismatches(expected: npt.NDArray, actual: npt.NDArray) -> int:
+            borderline = np.abs(mse - threshold) <= SIMILAR_TOLERANCE * threshold
+            return int(np.count_nonzero((expected != actual) & ~borderline))
+
+        results.append(
+            compare(
+                f"{name} get_similar {percent}%",
+                lambda: image.get_similar(coordinates, percent),
+                mismatches,
+                repeat,
+            )
+        )
+    return results
+
+
+def parse_args(args: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.kernels",
+        description="Check compiled kernels against NumPy code and compare their speed.",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        nargs=3,
+        metavar=("HEIGHT", "WIDTH", "BANDS"),
+        help="size of synthetic images, small by default without Numba",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="timed repetitions of each operation"
+    )
+    return parser.parse_args(args)
+
+
+def main(args: list[str]) -> int:
+    parsed = parse_args(args)
+    if kernels.numba is None:
+        print("Numba isn't installed, kernels run as Python functions")
+        size = parsed.size or (24, 32, 8)
+    else:
+        size = parsed.size or (512, 512, 64)
+        print(f"Numba {kernels.numba.__version__}")
+    failed = 0
+    for name, image in make_images(size):
+        for result in check_image(name, image, parsed.repeat):
+            status = "ok" if result.mismatches == 0 else f"{result.mismatches} differ"
+            print(
+                f"{result.name:32} {status:>12}  NumPy {result.numpy_time * 1000:9.2f} ms"
+                f"  kernels {result.kernels_time * 1000:9.2f} ms"
+            )
+            failed += result.mismatches > 0
+    if failed:
+        print(f"{failed} checks failed")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
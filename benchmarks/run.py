@@ -0,0 +1,314 @@
+"""Benchmarks of loading, rendering and analysing images, run with `python -m benchmarks.run`."""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from dataclasses import dataclass
+from datetime import datetime
+from time import perf_counter
+from typing import Any, Callable, Optional
+
+# Widgets are rendered offscreen, unless a platform is chosen explicitly
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import numpy as np
+from PyQt6.QtWidgets import QApplication
+
+from benchmarks.synthetic import INT_BPP, CubeSpec, make_cube, write_envi, write_mat
+from lib import DualLayout, HsImage
+from loaders.abstract import LoadOptions, ignore_progress
+from loaders.loader import Loader
+from ui.image_preview import ImagePreview
+from ui.spectral_viewer import AreaPlotMode, SpectralViewer
+
+PRESETS: dict[str, list[tuple[int, int, int]]] = {
+    "quick": [(256, 256, 64)],
+    "default": [(512, 512, 128), (1024, 1024, 64)],
+    "large": [(2048, 2048, 128), (1024, 1024, 448)],
+}
+"""Image sizes (height, width, bands) of each preset"""
+DTYPES = ["uint16", "float32"]
+LAYOUTS = ["bip", "bsq"]
+FORMATS = ["envi", "mat"]
+
+
+@dataclass
+class Measurement:
+    case: str
+    operation: str
+    times: list[float]
+    """Wall time of each repetition in seconds"""
+    n_bytes: int
+    """Bytes of image data processed by a single repetition"""
+    peak_bytes: int
+    """Peak of memory allocated by Python and NumPy during a single repetition"""
+
+    def to_json(self) -> dict[str, Any]:
+        median = statistics.median(self.times)
+        return {
+            "case": self.case,
+            "operation": self.operation,
+            "median_s": median,
+            "min_s": min(self.times),
+            "times_s": self.times,
+            "bytes": self.n_bytes,
+            "throughput_mib_s": self.n_bytes / max(median, 1e-9) / (1 << 20),
+            "peak_mib": self.peak_bytes / (1 << 20),
+        }
+
+
+def measure(
+    case: str, operation: str, func: Callable[[], Any], n_bytes: int, repeat: int
+) -> Measurement:
+    """Times `func` after a warm-up call, then measures its peak memory in a separate call.
+    Tracing allocations slows Python code down, so it's never enabled while timing.
+    """
+    func()
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    measurement = Measurement(case, operation, times, n_bytes, peak)
+    result = measurement.to_json()
+    print(
+        f"{case:<32} {operation:<26} {result['median_s'] * 1000:>10.2f} ms",
+        f"{result['throughput_mib_s']:>10.0f} MiB/s {result['peak_mib']:>9.1f} MiB",
+    )
+    return measurement
+
+
+def write_file(cube: np.ndarray, spec: CubeSpec, file_format: str, directory: str):
+    if file_format == "envi":
+        return write_envi(cube, spec, directory)
+    return write_mat(cube, spec, directory)
+
+
+def benchmark_image(
+    case: str,
+    image: HsImage,
+    preview: ImagePreview,
+    viewer: SpectralViewer,
+    repeat: int,
+) -> list[Measurement]:
+    """Measures operations of the main window on a loaded image."""
+    h, w, b = image.data.shape
+    itemsize = image.data.dtype.itemsize
+    band_bytes = h * w * itemsize
+    rgb = image.closest_rgb_idx() or (0, 1, 2)
+    results = []
+
+    def run(operation: str, func: Callable[[], Any], n_bytes: int):
+        results.append(measure(case, operation, func, n_bytes, repeat))
+
+    # Same steps as `MainWindow.render_bands`
+    if image.dtype.kind == "f":
+        run(
+            "render_mono",
+            lambda: preview.render_single_f(image.get_band_normalised(0)),
+            band_bytes,
+        )
+        run(
+            "render_rgb",
+            lambda: preview.render_rgb_f(image.get_RGB_bands_normalised(*rgb)),
+            3 * band_bytes,
+        )
+        run("normalised", image.normalised, image.data.nbytes)
+    else:
+        run(
+            "render_mono",
+            lambda: preview.render_single(image.as_8bpp(image.get_band(0))),
+            band_bytes,
+        )
+        run(
+            "render_rgb",
+            lambda: preview.render_rgb(image.as_8bpp(image.get_RGB_bands(*rgb))),
+            3 * band_bytes,
+        )
+        rgb_bands = image.get_RGB_bands(*rgb)
+        run("as_8bpp", lambda: image.as_8bpp(rgb_bands), rgb_bands.nbytes)
+    run(
+        "get_RGB_bands_normalised",
+        lambda: image.get_RGB_bands_normalised(*rgb),
+        3 * band_bytes,
+    )
+    run(
+        "get_similar",
+        lambda: image.get_similar((w // 2, h // 2), 1.0),
+        image.data.nbytes,
+    )
+
+    # A quarter of the image, as if selected with "Select area"
+    p1 = (w // 4, h // 4)
+    p2 = (w // 4 + w // 2 - 1, h // 4 + h // 2 - 1)
+    area_bytes = (h // 2) * (w // 2) * b * itemsize
+    viewer.update_labels(image.labels, image.labels_type)
+    for mode in (AreaPlotMode.SUMMARY, AreaPlotMode.DENSITY):
+        viewer.area_mode = mode
+        run(
+            f"from_area_{mode.name.lower()}",
+            lambda: viewer.from_area(image.get_area(p1, p2)),
+            area_bytes,
+        )
+    return results
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(args: argparse.Namespace) -> dict[str, Any]:
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": sys.version,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "preset": args.preset,
+        "repeat": args.repeat,
+        "dual_layout": args.dual_layout,
+    }
+
+
+def compare(results: list[dict[str, Any]], baseline_path: str) -> None:
+    """Prints the ratio of median times of operations present in both runs."""
+    with open(baseline_path, encoding="utf-8") as baseline_file:
+        baseline = json.load(baseline_file)
+    baseline_times = {
+        (r["case"], r["operation"]): r["median_s"] for r in baseline["results"]
+    }
+    print(f"\ncompared with {baseline_path} ({baseline['metadata']['revision']})")
+    print("ratio > 1 means slower than the baseline")
+    for r in results:
+        key = (r["case"], r["operation"])
+        if key in baseline_times:
+            ratio = r["median_s"] / max(baseline_times[key], 1e-9)
+            print(f"{r['case']:<32} {r['operation']:<26} {ratio:>6.2f}x")
+
+
+def parse_args(args: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.run",
+        description="Benchmark loading, rendering and analysis of synthetic images.",
+    )
+    parser.add_argument("--preset", choices=list(PRESETS), default="default")
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="timed repetitions of each operation"
+    )
+    parser.add_argument("--dtypes", nargs="+", choices=DTYPES, default=DTYPES)
+    parser.add_argument("--layouts", nargs="+", choices=LAYOUTS, default=LAYOUTS)
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=FORMATS)
+    parser.add_argument(
+        "--dual-layout",
+        choices=[layout.name.lower() for layout in DualLayout],
+        default=DualLayout.OFF.name.lower(),
+        help="dual layout option used when loading (default: off, so results don't depend on free memory)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="JSON file for results, by default benchmark_results/<date>.json",
+    )
+    parser.add_argument(
+        "--compare", help="JSON results of a previous run to compare with"
+    )
+    return parser.parse_args(args)
+
+
+def main(args: list[str]) -> int:
+    parsed = parse_args(args)
+    app = QApplication(sys.argv[:1])
+    preview = ImagePreview(None)
+    viewer = SpectralViewer()
+    measurements: list[Measurement] = []
+
+    print(
+        f"{'case':<32} {'operation':<26} {'median':>13} {'throughput':>15} {'peak':>13}"
+    )
+    with tempfile.TemporaryDirectory(prefix="whaaale-bench-") as directory:
+        for height, width, bands in PRESETS[parsed.preset]:
+            for dtype in parsed.dtypes:
+                for layout in parsed.layouts:
+                    spec = CubeSpec(height, width, bands, dtype, layout)
+                    cube = make_cube(spec)
+                    for file_format in parsed.formats:
+                        case = f"{spec.name} {file_format}"
+                        try:
+                            path = write_file(cube, spec, file_format, directory)
+                            file_loader = Loader.find_file_loader(path)
+                        except ImportError as err:
+                            print(f"{case:<32} skipped, {err}")
+                            continue
+                        options = LoadOptions(
+                            bpp=INT_BPP if dtype == "uint16" else None,
+                            array_order=spec.array_order
+                            if file_format == "mat"
+                            else (0, 1, 2),
+                            dual_layout=DualLayout[parsed.dual_layout.upper()],
+                        )
+                        image = None
+
+                        # Files are read from the page cache after the warm-up
+                        def load():
+                            nonlocal image
+                            image = file_loader.load_file(
+                                path, options, ignore_progress
+                            )
+                            image.build_layout(ignore_progress)
+
+                        measurements.append(
+                            measure(case, "load", load, cube.nbytes, parsed.repeat)
+                        )
+                        assert image is not None
+                        measurements += benchmark_image(
+                            case, image, preview, viewer, parsed.repeat
+                        )
+                        del image
+                        for file in file_loader.source_files(path):
+                            os.remove(file)
+    app.quit()
+
+    results = [m.to_json() for m in measurements]
+    output = parsed.output
+    if output is None:
+        os.makedirs("benchmark_results", exist_ok=True)
+        output = os.path.join(
+            "benchmark_results", datetime.now().strftime("%Y%m%d-%H%M%S") + ".json"
+        )
+    with open(output, "w", encoding="utf-8") as output_file:
+        json.dump(
+            {"metadata": metadata(parsed), "results": results}, output_file, indent=1
+        )
+    print("results saved to", output)
+
+    if parsed.compare is not None:
+        compare(results, parsed.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
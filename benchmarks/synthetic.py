@@ -0,0 +1,130 @@
+import os
+from dataclasses import dataclass
+
+import numpy as np
+import numpy.typing as npt
+
+from loaders.abstract import ArrayOrder
+
+
+@dataclass(frozen=True)
+class CubeSpec:
+    """Shape, type and file layout of a synthetic image."""
+
+    height: int
+    width: int
+    bands: int
+    dtype: str
+    """`uint16` (12 bits per pixel) or `float32` (reflectance in [0, 1])"""
+    layout: str
+    """`bip` (bands interleaved by pixel) or `bsq` (band sequential)"""
+
+    @property
+    def name(self) -> str:
+        return f"{self.dtype} {self.height}x{self.width}x{self.bands} {self.layout}"
+
+    @property
+    def array_order(self) -> ArrayOrder:
+        """Order of axes in files written by `write_mat`."""
+        return (0, 1, 2) if self.layout == "bip" else (1, 2, 0)
+
+
+FIRST_WAVELENGTH = 400.0
+LAST_WAVELENGTH = 1000.0
+INT_BPP = 12
+
+
+def wavelengths(bands: int) -> npt.NDArray[np.float64]:
+    return np.linspace(FIRST_WAVELENGTH, LAST_WAVELENGTH, bands)
+
+
+def make_cube(spec: CubeSpec, seed: int = 0) -> npt.NDArray:
+    """Returns a deterministic [height, width, bands] cube of smooth spectra with noise.
+    Pixels are mixtures of a few materials, so that similarity and statistics have realistic structure.
+    """
+    rng = np.random.default_rng(seed)
+    x = wavelengths(spec.bands)
+    materials = 6
+    # Gaussian absorption features over a sloped continuum
+    centres = rng.uniform(FIRST_WAVELENGTH, LAST_WAVELENGTH, (materials, 3))
+    widths = rng.uniform(20, 120, (materials, 3))
+    depths = rng.uniform(0.1, 0.5, (materials, 3))
+    continuum = rng.uniform(0.3, 0.8, (materials, 1)) + rng.uniform(
+        -0.2, 0.2, (materials, 1)
+    ) * (x - FIRST_WAVELENGTH) / (LAST_WAVELENGTH - FIRST_WAVELENGTH)
+    features = depths[..., None] * np.exp(
+        -(((x - centres[..., None]) / widths[..., None]) ** 2)
+    )
+    spectra = np.clip(continuum - features.sum(axis=1), 0.01, 1).astype(np.float32)
+
+    # Smooth abundance maps from a coarse random grid
+    grid = rng.random((materials, 9, 9)).astype(np.float32)
+    ys = np.linspace(0, 8, spec.height).astype(np.intp)
+    xs = np.linspace(0, 8, spec.width).astype(np.intp)
+    abundances = grid[:, ys][:, :, xs]
+    abundances /= abundances.sum(axis=0)
+
+    cube = np.empty((spec.height, spec.width, spec.bands), dtype=np.float32)
+    # Rows at a time to keep temporary arrays small
+    rows = max(1, (1 << 20) // max(1, spec.width * materials))
+    for y in range(0, spec.height, rows):
+        mixed = np.tensordot(abundances[:, y : y + rows], spectra, axes=(0, 0))
+        mixed += rng.normal(0, 0.005, mixed.shape).astype(np.float32)
+        cube[y : y + rows] = mixed
+
+    if spec.dtype == "float32":
+        return cube
+    max_value = (1 << INT_BPP) - 1
+    return np.clip(cube * max_value, 0, max_value).astype(np.uint16)
+
+
+def file_order(cube: npt.NDArray, spec: CubeSpec) -> npt.NDArray:
+    """Returns the cube in the order of axes used in files."""
+    if spec.layout == "bsq":
+        return np.ascontiguousarray(cube.transpose(2, 0, 1))
+    return cube
+
+
+ENVI_DATA_TYPES = {"uint16": 12, "float32": 4}
+
+
+def write_envi(cube: npt.NDArray, spec: CubeSpec, directory: str) -> str:
+    """Writes a raw file with an ENVI header, returns the path of the header."""
+    path = os.path.join(directory, spec.name.replace(" ", "_"))
+    file_order(cube, spec).tofile(path)
+    labels = ", ".join(f"{w:.2f}" for w in wavelengths(spec.bands))
+    header = "\n".join(
+        [
+            "ENVI",
+            f"samples = {spec.width}",
+            f"lines = {spec.height}",
+            f"bands = {spec.bands}",
+            "header offset = 0",
+            "file type = ENVI Standard",
+            f"data type = {ENVI_DATA_TYPES[spec.dtype]}",
+            f"interleave = {spec.layout}",
+            "byte order = 0",
+            "wavelength units = Nanometers",
+            f"wavelength = {{{labels}}}",
+            "",
+        ]
+    )
+    with open(path + ".hdr", "w", encoding="ascii") as header_file:
+        header_file.write(header)
+    return path + ".hdr"
+
+
+def write_mat(cube: npt.NDArray, spec: CubeSpec, directory: str) -> str:
+    """Writes a Matlab 7.3 (HDF5) file with a single chunked variable, returns its path."""
+    import h5py
+
+    from loaders.matlab import MatlabLoader
+
+    path = os.path.join(directory, spec.name.replace(" ", "_") + ".mat")
+    data = file_order(cube, spec)
+    # Matlab 7.3 files are HDF5 files with a 512 byte user block starting with the header
+    with h5py.File(path, "w", userblock_size=512) as file:
+        file.create_dataset("img", data=data, chunks=True)
+    with open(path, "r+b") as file:
+        file.write(MatlabLoader.HDF5_HEADER.ljust(128, b" "))
+    return path
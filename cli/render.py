@@ -0,0 +1,326 @@
+import argparse
+import os
+from collections import Counter
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field, replace
+from enum import Enum
+from time import perf_counter
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+from PyQt6.QtGui import QImage
+
+from lib import DualLayout, HsImage, LabelType, NormalisationMethod
+from loaders.abstract import ArrayOrder, FileHeader, LoadOptions, ignore_progress
+from loaders.loader import Loader
+
+
+class RenderMode(Enum):
+    """Defines which bands are rendered.
+
+    The following values are available:
+    - `MONO`
+    - `RGB`
+    - `AUTO`
+    """
+
+    MONO = 0
+    """A single band in grayscale"""
+    RGB = 1
+    """Three bands as red, green and blue"""
+    AUTO = 2
+    """Bands closest to red, green and blue wavelengths if known, the first band otherwise, same as the main window"""
+
+
+ARRAY_ORDERS: dict[str, ArrayOrder] = {
+    "hwb": (0, 1, 2),
+    "whb": (1, 0, 2),
+    "bhw": (1, 2, 0),
+    "bwh": (2, 1, 0),
+}
+"""Array orders by the order of [height, width, bands] axes in the file"""
+
+
+@dataclass
+class RenderOptions:
+    mode: RenderMode = RenderMode.AUTO
+    band: int = 0
+    """Band rendered in `RenderMode.MONO`"""
+    rgb: Optional[tuple[int, int, int]] = None
+    """Bands rendered in `RenderMode.RGB`"""
+    load: LoadOptions = field(default_factory=LoadOptions)
+    """Options which the main window asks for in dialogs"""
+
+
+def render_mono(image: HsImage, band: int) -> npt.NDArray[np.uint8]:
+    """Renders a band the same way as the main window, returns [height, width] pixels."""
+    if image.dtype.kind == "f":
+        return HsImage.normalised_as_8bpp(image.get_band_normalised(band))
+    return image.as_8bpp(image.get_band(band))
+
+
+def render_rgb(image: HsImage, bands: tuple[int, int, int]) -> npt.NDArray[np.uint8]:
+    """Renders 3 bands the same way as the main window, returns [height, width, 3] pixels."""
+    if image.dtype.kind == "f":
+        return HsImage.normalised_as_8bpp(image.get_RGB_bands_normalised(*bands))
+    return image.as_8bpp(image.get_RGB_bands(*bands))
+
+
+def save_png(pixels: npt.NDArray[np.uint8], path: str) -> None:
+    pixels = np.ascontiguousarray(pixels)
+    h, w = pixels.shape[:2]
+    if pixels.ndim == 2:
+        image_format = QImage.Format.Format_Grayscale8
+    else:
+        image_format = QImage.Format.Format_RGB888
+    image = QImage(pixels.data, w, h, pixels.strides[0], image_format)
+    if not image.save(path, "PNG"):
+        raise OSError(f"Writing {path} failed.")
+
+
+def check_band(bands: int, band: int) -> None:
+    if band < 0 or band >= bands:
+        raise ValueError(f"Band {band} doesn't exist, the image has {bands} bands.")
+
+
+def choose_bands(
+    options: RenderOptions,
+    bands: int,
+    labels: Optional[list[str]],
+    labels_type: Optional[LabelType],
+) -> tuple[RenderMode, list[int]]:
+    """Returns `RenderMode.MONO` or `RenderMode.RGB` and the rendered bands of an image with `bands` bands.
+    Raises `ValueError` if a band doesn't exist.
+    """
+    mode = options.mode
+    rgb = options.rgb
+    if mode == RenderMode.AUTO:
+        rgb = None
+        if labels is not None and labels_type is not None:
+            rgb = HsImage.find_rgb_idx(labels, labels_type)
+        mode = RenderMode.MONO if rgb is None else RenderMode.RGB
+    if mode == RenderMode.RGB:
+        assert rgb is not None
+        rendered = list(rgb)
+    else:
+        rendered = [options.band]
+    for band in rendered:
+        check_band(bands, band)
+    return mode, rendered
+
+
+def reads_subset(header: FileHeader, options: LoadOptions) -> bool:
+    """Returns whether loading only the rendered bands gives the same pixels as loading all of them.
+    Global normalisation and bits per pixel detected from data depend on values of all bands.
+    """
+    if header.dtype.kind == "f":
+        return options.normalisation == NormalisationMethod.BAND
+    return options.bpp is not None
+
+
+def band_subset(rendered: list[int], bands: int) -> list[int]:
+    """Returns sorted `rendered` bands with the first bands of the file added up to the 3 bands an image needs."""
+    subset = set(rendered)
+    for band in range(bands):
+        if len(subset) >= 3:
+            break
+        subset.add(band)
+    return sorted(subset)
+
+
+def render_file(path: str, output: str, options: RenderOptions) -> float:
+    """Loads an image and saves it as a PNG file. Returns the time it took in seconds.
+    Runs in worker processes, so everything needed is passed in arguments.
+    """
+    start = perf_counter()
+    file_loader = Loader.find_file_loader(path)
+    load = options.load
+    header = file_loader.read_header(path, load)
+    if header is not None and reads_subset(header, load):
+        # Bands are chosen from headers, only the rendered ones are read
+        mode, rendered = choose_bands(
+            options, header.bands, header.labels, header.labels_type
+        )
+        subset = band_subset(rendered, header.bands)
+        image = file_loader.load_file(
+            path, replace(load, bands=subset), ignore_progress
+        )
+        rendered = [subset.index(band) for band in rendered]
+    else:
+        image = file_loader.load_file(path, load, ignore_progress)
+        mode, rendered = choose_bands(
+            options, image.bands, image.labels, image.labels_type
+        )
+
+    if mode == RenderMode.RGB:
+        r, g, b = rendered
+        pixels = render_rgb(image, (r, g, b))
+    else:
+        pixels = render_mono(image, rendered[0])
+
+    save_png(pixels, output)
+    return perf_counter() - start
+
+
+def output_path(path: str, output_dir: Optional[str], keep_extension: bool) -> str:
+    base = path if keep_extension else os.path.splitext(path)[0]
+    if output_dir is not None:
+        base = os.path.join(output_dir, os.path.basename(base))
+    return base + ".png"
+
+
+def output_paths(paths: list[str], output_dir: Optional[str]) -> list[str]:
+    """Returns PNG paths for all images. Images whose names would be the same, e.g. `x.hdr` and `x.mat`,
+    keep their extension in the name (`x.hdr.png`). Raises `ValueError` if names are still the same,
+    e.g. `a/x.hdr` and `b/x.hdr` saved to one output directory.
+    """
+
+    def key(output: str) -> str:
+        return os.path.normcase(os.path.abspath(output))
+
+    outputs = [output_path(path, output_dir, False) for path in paths]
+    counts = Counter(key(output) for output in outputs)
+    outputs = [
+        output_path(path, output_dir, True) if counts[key(output)] > 1 else output
+        for path, output in zip(paths, outputs)
+    ]
+    used: dict[str, str] = {}
+    for path, output in zip(paths, outputs):
+        other = used.setdefault(key(output), path)
+        if other != path:
+            raise ValueError(
+                f"{other} and {path} would both be saved as {output}, save them to different directories."
+            )
+    return outputs
+
+
+def add_load_arguments(parser: argparse.ArgumentParser) -> None:
+    """Adds arguments for options which the main window asks for when opening a file."""
+    parser.add_argument(
+        "--normalisation",
+        choices=[method.name.lower() for method in NormalisationMethod],
+        default=NormalisationMethod.GLOBAL.name.lower(),
+        help="normalisation of floating point data (default: global)",
+    )
+    parser.add_argument(
+        "--bpp",
+        type=int,
+        help="bits per pixel of integer data, detected from data by default",
+    )
+    parser.add_argument(
+        "--array-order",
+        choices=list(ARRAY_ORDERS),
+        default="hwb",
+        help="order of height, width and bands in Matlab files (default: hwb)",
+    )
+    parser.add_argument(
+        "--var",
+        help="Matlab variable with the image, required if the file has more 3D arrays",
+    )
+
+
+def load_options(parsed: argparse.Namespace, dual_layout: DualLayout) -> LoadOptions:
+    """Returns options of arguments added by `add_load_arguments`."""
+    return LoadOptions(
+        normalisation=NormalisationMethod[parsed.normalisation.upper()],
+        bpp=parsed.bpp,
+        array_order=ARRAY_ORDERS[parsed.array_order],
+        var_name=parsed.var,
+        dual_layout=dual_layout,
+    )
+
+
+def parse_args(args: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="whaaale.py render",
+        description="Render hyperspectral images to PNG files without opening the main window.",
+    )
+    parser.add_argument("files", nargs="+", help="ENVI .hdr or Matlab .mat files")
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        help="directory for PNG files, by default they are saved next to the images",
+    )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        choices=[mode.name.lower() for mode in RenderMode],
+        default=RenderMode.AUTO.name.lower(),
+        help="mono renders --band, rgb renders --rgb bands, auto picks RGB wavelengths if available (default)",
+    )
+    parser.add_argument(
+        "-b", "--band", type=int, default=0, help="band index for mono mode"
+    )
+    parser.add_argument(
+        "--rgb",
+        type=int,
+        nargs=3,
+        metavar=("R", "G", "B"),
+        help="band indexes for rgb mode",
+    )
+    add_load_arguments(parser)
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of files processed in parallel (default: number of CPUs)",
+    )
+    parsed = parser.parse_args(args)
+    if parsed.mode == RenderMode.RGB.name.lower() and parsed.rgb is None:
+        parser.error("--rgb is required in rgb mode")
+    if parsed.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return parsed
+
+
+def main(args: list[str]) -> int:
+    """Renders all files given in command line arguments. Returns the exit code."""
+    parsed = parse_args(args)
+    options = RenderOptions(
+        mode=RenderMode[parsed.mode.upper()],
+        band=parsed.band,
+        rgb=tuple(parsed.rgb) if parsed.rgb is not None else None,
+        # Every image is rendered once, a second layout would only take time and memory
+        load=load_options(parsed, DualLayout.OFF),
+    )
+    # Files given more than once are rendered once
+    unique: dict[str, str] = {}
+    for path in parsed.files:
+        unique.setdefault(os.path.normcase(os.path.abspath(path)), path)
+    files = list(unique.values())
+    try:
+        outputs = output_paths(files, parsed.output_dir)
+    except ValueError as err:
+        print(err)
+        return 2
+    if parsed.output_dir is not None:
+        os.makedirs(parsed.output_dir, exist_ok=True)
+
+    start = perf_counter()
+    failed = 0
+    jobs = min(parsed.jobs, len(files))
+    # Each worker loads whole images, so files are processed in parallel rather than parts of one file
+    with ProcessPoolExecutor(jobs) as executor:
+        futures: dict[Future[float], tuple[str, str]] = {}
+        for path, output in zip(files, outputs):
+            futures[executor.submit(render_file, path, output, options)] = (
+                path,
+                output,
+            )
+        for future in as_completed(futures):
+            path, output = futures[future]
+            try:
+                elapsed = future.result()
+                print(f"{path} -> {output} in {elapsed:.2f} s")
+            except Exception as err:
+                # One line per file, batches can have thousands of them
+                failed += 1
+                print(f"rendering {path} failed: {type(err).__name__}: {err}")
+
+    print(
+        f"rendered {len(files) - failed} of {len(files)} files",
+        f"in {perf_counter() - start:.2f} s using {jobs} processes",
+    )
+    return 1 if failed else 0
@@ -0,0 +1,586 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from enum import Enum
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Any, Callable, Generic, Hashable, Optional, TypeVar
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import numpy.typing as npt
+
+from analysis.band_math import BandMath
+from cli.render import (
+    add_load_arguments,
+    check_band,
+    load_options,
+    render_mono,
+    render_rgb,
+)
+from lib import DualLayout, HsImage
+from loaders.loader import Loader
+
+HOST = "127.0.0.1"
+"""Tiles are served only to this machine, other machines can reach them e.g. through an SSH tunnel"""
+DEFAULT_PORT = 8800
+TILE_SIZE = 256
+OVERZOOM_LEVELS = 3
+"""Number of zoom levels beyond one image pixel per tile pixel"""
+SERVE_THREADS = max(4, os.cpu_count() or 1)
+TILE_CACHE_BYTES = 64 << 20
+"""Maximum size of encoded tiles kept in memory"""
+LAYER_CACHE_BYTES = 256 << 20
+"""Maximum size of rendered layers (whole images in 8 bits) kept in memory"""
+MAX_AREA_PIXELS = 1 << 22
+"""Larger rectangles are refused, their statistics would keep a thread busy for too long"""
+PNG_COMPRESSION = 1
+"""zlib level of tiles, the fastest one, tiles are cached and served locally"""
+
+T = TypeVar("T")
+
+
+class LayerKind(Enum):
+    """Defines what tiles show.
+
+    The following values are available:
+    - `BAND`
+    - `RGB`
+    - `MATH`
+    """
+
+    BAND = 0
+    """A single band in grayscale"""
+    RGB = 1
+    """Three bands as red, green and blue"""
+    MATH = 2
+    """Result of a band math expression in grayscale"""
+
+
+@dataclass(frozen=True)
+class Layer:
+    kind: LayerKind
+    bands: tuple[int, ...] = ()
+    expression: str = ""
+
+    @property
+    def key(self) -> str:
+        """Canonical description of the layer, used in cache keys and ETags."""
+        if self.kind == LayerKind.MATH:
+            return f"math:{self.expression}"
+        return f"{self.kind.name.lower()}:{','.join(map(str, self.bands))}"
+
+
+class LruCache(Generic[T]):
+    """Values created on first request and kept until their total size exceeds `max_bytes`, least recently used are
+    dropped first. Concurrent requests for a value which is being created wait for it instead of creating it again.
+    """
+
+    def __init__(self, max_bytes: int, size: Callable[[T], int]) -> None:
+        self.max_bytes = max_bytes
+        self.size = size
+        self.bytes = 0
+        self._entries: OrderedDict[Hashable, Future[T]] = OrderedDict()
+        self._sizes: dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, create: Callable[[], T]) -> T:
+        with self._lock:
+            future = self._entries.get(key)
+            if future is not None:
+                self._entries.move_to_end(key)
+                owner = False
+            else:
+                future = self._entries[key] = Future()
+                owner = True
+        if not owner:
+            return future.result()
+
+        try:
+            value = create()
+        except BaseException as err:
+            with self._lock:
+                self._entries.pop(key, None)
+            future.set_exception(err)
+            raise
+        future.set_result(value)
+        with self._lock:
+            if key in self._entries:
+                self._sizes[key] = self.size(value)
+                self.bytes += self._sizes[key]
+            # Values which are still being created have no size yet and aren't dropped
+            for old in list(self._entries):
+                if self.bytes <= self.max_bytes or len(self._sizes) <= 1:
+                    break
+                if old in self._sizes and old != key:
+                    del self._entries[old]
+                    self.bytes -= self._sizes.pop(old)
+        return value
+
+
+def encode_png(pixels: npt.NDArray[np.uint8]) -> bytes:
+    """Returns [height, width, channels] pixels (grayscale and alpha or RGBA) as a PNG file.
+    Encoded without Qt, so that tiles can be encoded in any thread, zlib doesn't hold the GIL while compressing.
+    """
+    h, w, channels = pixels.shape
+    colour_type = {2: 4, 4: 6}[channels]
+    # Every row starts with its filter type, 0 means no filter
+    rows = np.zeros((h, 1 + w * channels), dtype=np.uint8)
+    rows[:, 1:] = pixels.reshape(h, -1)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data))
+        )
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, colour_type, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows.tobytes(), PNG_COMPRESSION))
+        + chunk(b"IEND", b"")
+    )
+
+
+def json_values(values: npt.NDArray) -> list[Optional[float]]:
+    """Returns values as a list for JSON, which has no NaN nor infinity, they're `null`."""
+    return [v if math.isfinite(v) else None for v in values.astype(np.float64).tolist()]
+
+
+class TileService:
+    """Renders tiles and spectra of an image loaded once. Methods can be called from several threads at once."""
+
+    def __init__(self, image: HsImage, identity: str) -> None:
+        self.image = image
+        self.identity = identity
+        """Description of the image file and options it was loaded with, tiles of the same image have the same ETags"""
+        h, w, _ = image.data.shape
+        self.native_zoom = max(0, math.ceil(math.log2(max(h, w) / TILE_SIZE)))
+        """Zoom level with one image pixel per tile pixel, the whole image fits into a single tile at level 0"""
+        self.max_zoom = self.native_zoom + OVERZOOM_LEVELS
+        self.tiles: LruCache[bytes] = LruCache(TILE_CACHE_BYTES, len)
+        self.layers: LruCache[npt.NDArray[np.uint8]] = LruCache(
+            LAYER_CACHE_BYTES, lambda pixels: pixels.nbytes
+        )
+        self.band_math = BandMath(image)
+        self._band_math_lock = threading.Lock()
+
+    def etag(self, request: str) -> str:
+        """Returns the ETag of a canonical `request`, which describes the response completely."""
+        digest = hashlib.sha1(f"{self.identity}\n{request}".encode()).hexdigest()
+        return f'"{digest[:32]}"'
+
+    def info(self) -> dict[str, Any]:
+        h, w, b = self.image.data.shape
+        return {
+            "width": w,
+            "height": h,
+            "bands": b,
+            "labels": self.image.labels,
+            "labels_type": self.image.labels_type.name.lower(),
+            "tile_size": TILE_SIZE,
+            "native_zoom": self.native_zoom,
+            "max_zoom": self.max_zoom,
+            "rgb": self.image.closest_rgb_idx(),
+        }
+
+    def layer(self, query: dict[str, str]) -> Layer:
+        """Returns the layer chosen by `band`, `rgb` or `expression` of `query`, raises `ValueError` if it's invalid.
+        Without them, bands closest to RGB wavelengths are shown if known, the first band otherwise.
+        """
+        if "expression" in query:
+            expression = query["expression"].strip()
+            with self._band_math_lock:
+                self.band_math.parse(expression)
+            return Layer(LayerKind.MATH, expression=expression)
+        if "rgb" in query:
+            bands = tuple(int(band) for band in query["rgb"].split(","))
+            if len(bands) != 3:
+                raise ValueError("rgb has to be 3 band indexes separated by commas.")
+            for band in bands:
+                check_band(self.image.bands, band)
+            return Layer(LayerKind.RGB, bands)
+        if "band" in query:
+            band = int(query["band"])
+            check_band(self.image.bands, band)
+            return Layer(LayerKind.BAND, (band,))
+        rgb = self.image.closest_rgb_idx()
+        if rgb is None:
+            return Layer(LayerKind.BAND, (0,))
+        return Layer(LayerKind.RGB, rgb)
+
+    def render_layer(self, layer: Layer) -> npt.NDArray[np.uint8]:
+        """Returns the whole image of `layer` as [height, width, 1 or 3] pixels, the same as the main window shows."""
+        match layer.kind:
+            case LayerKind.BAND:
+                pixels = render_mono(self.image, layer.bands[0])
+            case LayerKind.RGB:
+                r, g, b = layer.bands
+                pixels = render_rgb(self.image, (r, g, b))
+            case LayerKind.MATH:
+                with self._band_math_lock:
+                    band = self.band_math.evaluate(layer.expression)
+                pixels = HsImage.normalised_as_8bpp(band.normalised())
+        return pixels.reshape(pixels.shape[0], pixels.shape[1], -1)
+
+    def has_tile(self, z: int, x: int, y: int) -> bool:
+        """Returns whether the tile at zoom level `z` and position (`x`, `y`) shows a part of the image."""
+        h, w, _ = self.image.data.shape
+        if z < 0 or z > self.max_zoom:
+            return False
+        scale = 2.0 ** (self.native_zoom - z)
+        return (
+            0 <= x
+            and 0 <= y
+            and x * TILE_SIZE * scale < w
+            and y * TILE_SIZE * scale < h
+        )
+
+    def tile(self, layer: Layer, z: int, x: int, y: int) -> Optional[bytes]:
+        """Returns the PNG tile of `layer` at zoom level `z` and position (`x`, `y`), `None` if it's outside the image.
+        Pixels beyond the image are transparent. Tiles zoomed out use every n-th pixel, zoomed in repeat pixels.
+        """
+        if not self.has_tile(z, x, y):
+            return None
+        h, w, _ = self.image.data.shape
+        # Image pixels per tile pixel
+        scale = 2.0 ** (self.native_zoom - z)
+
+        def create() -> bytes:
+            pixels = self.layers.get(layer.key, lambda: self.render_layer(layer))
+            offsets = np.arange(TILE_SIZE)
+            xs = ((x * TILE_SIZE + offsets) * scale).astype(np.intp)
+            ys = ((y * TILE_SIZE + offsets) * scale).astype(np.intp)
+            xs = xs[xs < w]
+            ys = ys[ys < h]
+            channels = pixels.shape[2]
+            tile = np.zeros((TILE_SIZE, TILE_SIZE, channels + 1), dtype=np.uint8)
+            tile[: len(ys), : len(xs), :channels] = pixels[ys[:, np.newaxis], xs]
+            tile[: len(ys), : len(xs), channels] = 255
+            return encode_png(tile)
+
+        return self.tiles.get((layer.key, z, x, y), create)
+
+    def spectrum(self, x: int, y: int) -> dict[str, Any]:
+        h, w, _ = self.image.data.shape
+        if not (0 <= x < w and 0 <= y < h):
+            raise ValueError(f"Pixel ({x}, {y}) is outside the {w}x{h} image.")
+        # Read without the pixel cache of the image, which isn't shared between threads
+        values = self.image.get_area((x, y), (x, y))[0, 0]
+        return {"x": x, "y": y, "values": json_values(values)}
+
+    def area(self, x0: int, y0: int, x1: int, y1: int) -> dict[str, Any]:
+        """Returns summary curves of the rectangle bounded by (`x0`, `y0`) and (`x1`, `y1`), like the area plot."""
+        h, w, b = self.image.data.shape
+        x0, x1 = sorted((min(max(x0, 0), w - 1), min(max(x1, 0), w - 1)))
+        y0, y1 = sorted((min(max(y0, 0), h - 1), min(max(y1, 0), h - 1)))
+        pixels = (x1 - x0 + 1) * (y1 - y0 + 1)
+        if pixels > MAX_AREA_PIXELS:
+            raise ValueError(
+                f"The rectangle has {pixels} pixels, at most {MAX_AREA_PIXELS} are allowed."
+            )
+        area = self.image.get_area((x0, y0), (x1, y1)).reshape(-1, b)
+        v_min, q_low, q_high, v_max = np.quantile(area, [0, 0.25, 0.75, 1], axis=0)
+        return {
+            "x0": x0,
+            "y0": y0,
+            "x1": x1,
+            "y1": y1,
+            "pixels": pixels,
+            "avg": json_values(area.mean(axis=0)),
+            "min": json_values(v_min),
+            "quartile_low": json_values(q_low),
+            "quartile_high": json_values(q_high),
+            "max": json_values(v_max),
+        }
+
+
+class TileServer(HTTPServer):
+    """HTTP server which handles requests in a thread pool instead of a new thread for every request."""
+
+    def __init__(
+        self,
+        service: TileService,
+        port: int = DEFAULT_PORT,
+        threads: int = SERVE_THREADS,
+        verbose: bool = False,
+    ) -> None:
+        super().__init__((HOST, port), TileRequestHandler)
+        self.service = service
+        self.verbose = verbose
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="tiles")
+
+    def process_request(self, request, client_address) -> None:
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    """Routes `/tiles/{z}/{x}/{y}.png`, `/spectrum`, `/area`, `/info` and the viewer page `/`."""
+
+    server: TileServer
+    server_version = "whaaale"
+
+    def do_GET(self) -> None:
+        service = self.server.service
+        url = urlsplit(self.path)
+        # Only the last value of every parameter is used
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        parts = url.path.strip("/").split("/")
+        try:
+            if url.path == "/":
+                self.respond(VIEWER_PAGE.encode(), "text/html; charset=utf-8")
+            elif url.path == "/info":
+                self.respond_json(url.path, service.info)
+            elif url.path == "/spectrum":
+                x, y = int(query["x"]), int(query["y"])
+                self.respond_json(f"/spectrum {x} {y}", lambda: service.spectrum(x, y))
+            elif url.path == "/area":
+                corners = [int(query[name]) for name in ("x0", "y0", "x1", "y1")]
+                self.respond_json(f"/area {corners}", lambda: service.area(*corners))
+            elif len(parts) == 4 and parts[0] == "tiles" and parts[3].endswith(".png"):
+                z, x, y = int(parts[1]), int(parts[2]), int(parts[3][:-4])
+                layer = service.layer(query)
+                etag = service.etag(f"/tiles {layer.key} {z} {x} {y}")
+                if not service.has_tile(z, x, y):
+                    self.send_error(HTTPStatus.NOT_FOUND, "Tile outside the image")
+                elif not self.not_modified(etag):
+                    tile = service.tile(layer, z, x, y)
+                    assert tile is not None
+                    self.respond(tile, "image/png", etag)
+            else:
+                self.send_error(HTTPStatus.NOT_FOUND)
+        except KeyError as err:
+            self.send_error(HTTPStatus.BAD_REQUEST, f"Missing parameter {err}")
+        except ValueError as err:
+            # The error page adds its own full stop
+            self.send_error(HTTPStatus.BAD_REQUEST, str(err).rstrip("."))
+
+    def if_none_match(self) -> set[str]:
+        """Returns ETags the client has, compared weakly (without a `W/` prefix), or `*` for any response."""
+        return {
+            tag.strip().removeprefix("W/")
+            for header in self.headers.get_all("If-None-Match") or []
+            for tag in header.split(",")
+        }
+
+    def not_modified(self, etag: str) -> bool:
+        """Responds with 304 and returns `True` if the client already has the response with `etag`.
+        `*` matches any response, so the request has to be checked to be valid first.
+        """
+        tags = self.if_none_match()
+        if etag not in tags and "*" not in tags:
+            return False
+        self.send_response(HTTPStatus.NOT_MODIFIED)
+        self.send_header("ETag", etag)
+        self.end_headers()
+        return True
+
+    def respond_json(self, request: str, create: Callable[[], dict[str, Any]]) -> None:
+        etag = self.server.service.etag(request)
+        if "*" in self.if_none_match():
+            # Only a valid request matches, creating the response raises for others
+            create()
+        if not self.not_modified(etag):
+            self.respond(json.dumps(create()).encode(), "application/json", etag)
+
+    def respond(self, body: bytes, content_type: str, etag: Optional[str] = None):
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+            # Browsers revalidate every time, which costs only a 304 response
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+VIEWER_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Whaaale</title>
+<style>
+body { margin: 0; font-family: sans-serif; display: flex; flex-direction: column; height: 100vh; }
+form { padding: 6px; display: flex; gap: 6px; align-items: center; }
+#view { flex: 1; overflow: auto; position: relative; background: #222; }
+#tiles { position: relative; }
+#tiles img { position: absolute; width: 256px; height: 256px; image-rendering: pixelated; }
+#spectrum { height: 6em; margin: 0; padding: 6px; overflow: auto; font-size: 12px; }
+</style>
+</head>
+<body>
+<form id="layer">
+<label>Band <input name="band" type="number" min="0" style="width: 5em"></label>
+<label>RGB <input name="rgb" placeholder="r,g,b" style="width: 8em"></label>
+<label>Expression <input name="expression" placeholder="(R800 - R670) / (R800 + R670)"></label>
+<button>Show</button>
+<button type="button" id="zoom-out">-</button>
+<button type="button" id="zoom-in">+</button>
+<span id="status"></span>
+</form>
+<div id="view"><div id="tiles"></div></div>
+<pre id="spectrum">Click a pixel to show its spectrum</pre>
+<script>
+const form = document.getElementById("layer");
+const tiles = document.getElementById("tiles");
+let info, zoom, query = "";
+
+function show() {
+  const scale = 2 ** (info.native_zoom - zoom);
+  const size = info.tile_size;
+  const columns = Math.ceil(info.width / (size * scale));
+  const rows = Math.ceil(info.height / (size * scale));
+  tiles.replaceChildren();
+  tiles.style.width = columns * size + "px";
+  tiles.style.height = rows * size + "px";
+  for (let y = 0; y < rows; y++) {
+    for (let x = 0; x < columns; x++) {
+      const img = document.createElement("img");
+      img.src = `tiles/${zoom}/${x}/${y}.png${query}`;
+      img.style.left = x * size + "px";
+      img.style.top = y * size + "px";
+      tiles.append(img);
+    }
+  }
+  document.getElementById("status").textContent = `zoom ${zoom} of ${info.max_zoom}`;
+}
+
+form.addEventListener("submit", (event) => {
+  event.preventDefault();
+  const params = new URLSearchParams();
+  for (const [name, value] of new FormData(form)) {
+    if (value) params.set(name, value);
+  }
+  query = params.size ? "?" + params : "";
+  show();
+});
+document.getElementById("zoom-in").onclick = () => { zoom = Math.min(zoom + 1, info.max_zoom); show(); };
+document.getElementById("zoom-out").onclick = () => { zoom = Math.max(zoom - 1, 0); show(); };
+tiles.addEventListener("click", async (event) => {
+  const scale = 2 ** (info.native_zoom - zoom);
+  const bounds = tiles.getBoundingClientRect();
+  const x = Math.floor((event.clientX - bounds.left) * scale);
+  const y = Math.floor((event.clientY - bounds.top) * scale);
+  const response = await fetch(`spectrum?x=${x}&y=${y}`);
+  const text = document.getElementById("spectrum");
+  if (!response.ok) {
+    text.textContent = await response.text();
+    return;
+  }
+  const spectrum = await response.json();
+  text.textContent = `(${x}, ${y})\\n` + spectrum.values
+    .map((value, i) => `${info.labels[i]}: ${value}`).join("  ");
+});
+
+fetch("info").then((response) => response.json()).then((result) => {
+  info = result;
+  zoom = info.native_zoom;
+  show();
+});
+</script>
+</body>
+</html>
+"""
+
+
+def identity(path: str, parsed: argparse.Namespace) -> str:
+    """Returns a description of the file and options which changes whenever tiles may change."""
+    stat = os.stat(path)
+    options = [parsed.normalisation, parsed.bpp, parsed.array_order, parsed.var]
+    return f"{os.path.abspath(path)} {stat.st_size} {stat.st_mtime_ns} {options}"
+
+
+def parse_args(args: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="whaaale.py serve",
+        description=f"Serve PNG tiles and spectra of a hyperspectral image over HTTP on {HOST}.",
+    )
+    parser.add_argument("file", help="ENVI .hdr or Matlab .mat file")
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=DEFAULT_PORT,
+        help=f"port to listen on, 0 picks a free one (default: {DEFAULT_PORT})",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        default=SERVE_THREADS,
+        help=f"number of requests handled at once (default: {SERVE_THREADS})",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="log every request"
+    )
+    add_load_arguments(parser)
+    parsed = parser.parse_args(args)
+    if parsed.threads < 1:
+        parser.error("--threads must be at least 1")
+    return parsed
+
+
+def main(args: list[str]) -> int:
+    """Serves the file given in command line arguments until interrupted. Returns the exit code."""
+    parsed = parse_args(args)
+
+    last_report = ""
+
+    def report_progress(fraction: float, stage: str):
+        nonlocal last_report
+        # Stages include the changing speed of reading, only whole percents are reported
+        report = f"{stage.split(',')[0]} {fraction:.0%}"
+        if report != last_report:
+            print(f"\r{report}", end="", flush=True)
+            last_report = report
+
+    try:
+        file_loader = Loader.find_file_loader(parsed.file)
+        # Both layouts, so that tiles of bands and spectra are fast
+        options = load_options(parsed, DualLayout.AUTO)
+        image = file_loader.load_file(parsed.file, options, report_progress)
+    except Exception as err:
+        print(f"\nloading {parsed.file} failed: {type(err).__name__}: {err}")
+        return 1
+    print()
+
+    service = TileService(image, identity(parsed.file, parsed))
+    with TileServer(service, parsed.port, parsed.threads, parsed.verbose) as server:
+        print(f"serving {parsed.file} at {server.url}, press Ctrl+C to stop")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
@@ -0,0 +1,36 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+import numpy.typing as npt
+
+from lib import HsImage
+from utils import staticproperty
+
+
+class AbstractFileExporter(ABC):
+    @staticproperty
+    @abstractmethod
+    def FILE_FILTER_NAME() -> str:
+        """A user friendly filter name for the "save file" dialog."""
+        pass
+
+    @staticproperty
+    @abstractmethod
+    def EXTENSIONS() -> list[str]:
+        """A list of supported extensions. The first one is used if the user doesn't provide any.
+
+        Examples:
+        ```
+            ["npy"]
+            ["h5", "hdf5"]
+        ```
+        """
+        pass
+
+    @staticmethod
+    @abstractmethod
+    def export_file(path: str, image: HsImage, mask: npt.NDArray[np.bool_]) -> None:
+        """Writes spectra of all pixels selected by `mask` to `path` along with their coordinates.
+        Implementations must stream data using `HsImage.iter_masked` instead of building the whole table in memory.
+        """
+        pass
@@ -0,0 +1,46 @@
+import math
+
+import numpy as np
+import numpy.typing as npt
+
+from exporters.abstract import AbstractFileExporter
+from lib import HsImage, LabelType
+from utils import staticproperty
+
+
+class CSVExporter(AbstractFileExporter):
+    @staticproperty
+    def FILE_FILTER_NAME() -> str:
+        return "CSV files"
+
+    @staticproperty
+    def EXTENSIONS() -> list[str]:
+        return ["csv", "txt"]
+
+    @staticmethod
+    def export_file(path: str, image: HsImage, mask: npt.NDArray[np.bool_]) -> None:
+        if image.dtype.kind == "f":
+            # Enough digits to restore values of the type exactly, 9 for float32 and 17 for float64
+            digits = math.ceil((np.finfo(image.dtype).nmant + 1) * math.log10(2)) + 1
+            value_fmt = f"%.{digits}g"
+        else:
+            value_fmt = "%d"
+        fmt = ["%d", "%d"] + [value_fmt] * image.bands
+
+        if image.labels_type == LabelType.CUSTOM_STR:
+            # Quote custom labels, since they may contain commas
+            band_header = [
+                '"' + label.replace('"', '""') + '"' for label in image.labels
+            ]
+        else:
+            band_header = image.labels
+
+        with open(path, "w", encoding="utf-8") as out_file:
+            out_file.write(",".join(["x", "y"] + band_header) + "\n")
+            for xs, ys, spectra in image.iter_masked(mask):
+                # Format whole chunks at once instead of writing row by row
+                rows = np.empty((len(xs), image.bands + 2), dtype=np.float64)
+                rows[:, 0] = xs
+                rows[:, 1] = ys
+                rows[:, 2:] = spectra
+                np.savetxt(out_file, rows, fmt=fmt, delimiter=",")
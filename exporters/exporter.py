@@ -0,0 +1,101 @@
+import os
+import traceback
+from typing import Type
+
+import numpy as np
+import numpy.typing as npt
+from PyQt6.QtWidgets import QFileDialog, QMessageBox, QWidget
+
+from exporters.abstract import AbstractFileExporter
+from lib import HsImage
+from utils import LazyFormat
+
+
+# Exporters are imported on first use, HDF5 support in particular is slow to import
+def npy_exporter() -> Type[AbstractFileExporter]:
+    from exporters.npy import NpyExporter
+
+    return NpyExporter
+
+
+def hdf5_exporter() -> Type[AbstractFileExporter]:
+    from exporters.hdf5 import HDF5Exporter
+
+    return HDF5Exporter
+
+
+def parquet_exporter() -> Type[AbstractFileExporter]:
+    from exporters.parquet import ParquetExporter
+
+    return ParquetExporter
+
+
+def csv_exporter() -> Type[AbstractFileExporter]:
+    from exporters.delimited import CSVExporter
+
+    return CSVExporter
+
+
+class Exporter:
+    exporters: list[LazyFormat[AbstractFileExporter]] = [
+        LazyFormat("NumPy array", ["npy"], npy_exporter),
+        LazyFormat("HDF5 file", ["h5", "hdf5"], hdf5_exporter),
+        LazyFormat("Apache Parquet", ["parquet"], parquet_exporter),
+        LazyFormat("CSV files", ["csv", "txt"], csv_exporter),
+    ]
+
+    def __init__(self, parent: QWidget) -> None:
+        self.parent = parent
+        self.extensions_map: dict[str, LazyFormat[AbstractFileExporter]] = {}
+        for exporter in self.exporters:
+            for extension in exporter.extensions:
+                if extension in self.extensions_map:
+                    raise Exception(
+                        f"Extension {extension} claimed by {exporter.filter_name} has been already registered by {self.extensions_map[extension].filter_name}."
+                    )
+                self.extensions_map[extension] = exporter
+
+    def export_file(
+        self, path: str, image: HsImage, mask: npt.NDArray[np.bool_]
+    ) -> None:
+        # extension starts with a "."
+        _, extension = os.path.splitext(path)
+        file_exporter = self.extensions_map[extension[1:].lower()].get()
+        file_exporter.export_file(path, image, mask)
+
+    def filters(self) -> list[str]:
+        # prefix extensions with "*." and append them after the filter name
+        return [
+            f"{exporter.filter_name} ({' '.join(['*.' + ext for ext in exporter.extensions])})"
+            for exporter in self.exporters
+        ]
+
+    def save_file(self, image: HsImage, mask: npt.NDArray[np.bool_]) -> bool:
+        """Show a "Save file" dialog and export spectra of pixels selected by `mask`. Returns `True` on success."""
+        filters = self.filters()
+        file_path, used_filter = QFileDialog.getSaveFileName(
+            self.parent, "Export spectra", "", ";;".join(filters)
+        )
+
+        if not file_path:
+            # User pressed Cancel
+            return False
+
+        _, extension = os.path.splitext(file_path)
+        if extension[1:].lower() not in self.extensions_map:
+            # Use the default extension of the selected filter
+            exporter = self.exporters[filters.index(used_filter)]
+            file_path += "." + exporter.extensions[0]
+
+        try:
+            self.export_file(file_path, image, mask)
+            return True
+        except Exception as err:
+            message_box = QMessageBox(self.parent)
+            message_box.setIcon(QMessageBox.Icon.Warning)
+            # Append the error message to text instead of using informative text to force width scaling
+            message_box.setText("Exporting spectra failed\n\n" + str(err))
+            message_box.setDetailedText(traceback.format_exc())
+            message_box.exec()
+
+        return False
@@ -0,0 +1,49 @@
+import h5py
+import numpy as np
+import numpy.typing as npt
+
+from exporters.abstract import AbstractFileExporter
+from lib import HsImage
+from utils import staticproperty
+
+
+class HDF5Exporter(AbstractFileExporter):
+    CHUNK_ROWS = 4096
+    """Number of spectra in a single HDF5 chunk"""
+
+    @staticproperty
+    def FILE_FILTER_NAME() -> str:
+        return "HDF5 file"
+
+    @staticproperty
+    def EXTENSIONS() -> list[str]:
+        return ["h5", "hdf5"]
+
+    @staticmethod
+    def export_file(path: str, image: HsImage, mask: npt.NDArray[np.bool_]) -> None:
+        n = int(np.count_nonzero(mask))
+        chunk_rows = min(n, HDF5Exporter.CHUNK_ROWS)
+        # Chunks can't be larger than the data, an empty selection is stored contiguously
+        with h5py.File(path, "w") as file:
+            spectra_ds = file.create_dataset(
+                "spectra",
+                shape=(n, image.bands),
+                dtype=image.dtype,
+                chunks=(chunk_rows, image.bands) if n > 0 else None,
+            )
+            coordinates_ds = file.create_dataset(
+                "coordinates",
+                shape=(n, 2),
+                dtype=np.uint32,
+                chunks=(chunk_rows, 2) if n > 0 else None,
+            )
+            spectra_ds.attrs["labels"] = image.labels
+            spectra_ds.attrs["labels_type"] = image.labels_type.name
+            coordinates_ds.attrs["columns"] = ["x", "y"]
+
+            start = 0
+            for xs, ys, spectra in image.iter_masked(mask):
+                end = start + len(xs)
+                spectra_ds[start:end] = spectra
+                coordinates_ds[start:end] = np.stack((xs, ys), axis=1)
+                start = end
@@ -0,0 +1,39 @@
+import numpy as np
+import numpy.typing as npt
+
+from exporters.abstract import AbstractFileExporter
+from lib import HsImage
+from utils import staticproperty
+
+
+class NpyExporter(AbstractFileExporter):
+    @staticproperty
+    def FILE_FILTER_NAME() -> str:
+        return "NumPy array"
+
+    @staticproperty
+    def EXTENSIONS() -> list[str]:
+        return ["npy"]
+
+    @staticmethod
+    def export_file(path: str, image: HsImage, mask: npt.NDArray[np.bool_]) -> None:
+        # A structured array keeps coordinates next to spectra of the original type in a single file,
+        # it can be read with `np.load(path)["spectrum"]`
+        dtype = np.dtype(
+            [
+                ("x", np.uint32),
+                ("y", np.uint32),
+                ("spectrum", image.dtype, (image.bands,)),
+            ]
+        )
+        n = int(np.count_nonzero(mask))
+        out = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(n,))
+        start = 0
+        for xs, ys, spectra in image.iter_masked(mask):
+            end = start + len(xs)
+            out["x"][start:end] = xs
+            out["y"][start:end] = ys
+            out["spectrum"][start:end] = spectra
+            start = end
+        out.flush()
+        del out
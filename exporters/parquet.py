@@ -0,0 +1,51 @@
+import numpy as np
+import numpy.typing as npt
+
+from exporters.abstract import AbstractFileExporter
+from lib import HsImage
+from utils import staticproperty
+
+
+class ParquetExporter(AbstractFileExporter):
+    @staticproperty
+    def FILE_FILTER_NAME() -> str:
+        return "Apache Parquet"
+
+    @staticproperty
+    def EXTENSIONS() -> list[str]:
+        return ["parquet"]
+
+    @staticmethod
+    def export_file(path: str, image: HsImage, mask: npt.NDArray[np.bool_]) -> None:
+        # pyarrow is an optional dependency, it's required only for this format
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as err:
+            raise RuntimeError(
+                "Exporting to Parquet requires the pyarrow package."
+            ) from err
+
+        # Parquet has no half precision type
+        dtype = np.dtype(np.float32) if image.dtype == np.float16 else image.dtype
+        band_type = pa.from_numpy_dtype(dtype)
+        # Labels may repeat or be `x` or `y`, so columns are numbered and labels are kept in field metadata
+        schema = pa.schema(
+            [("x", pa.uint32()), ("y", pa.uint32())]
+            + [
+                pa.field(f"band_{i}", band_type, metadata={"label": label})
+                for i, label in enumerate(image.labels)
+            ],
+            metadata={"labels_type": image.labels_type.name},
+        )
+        # Dictionary encoding is useless for measured values and makes writing several times slower
+        with pq.ParquetWriter(path, schema, use_dictionary=False) as writer:
+            for xs, ys, spectra in image.iter_masked(mask):
+                # Each chunk becomes a row group. Transpose the chunk once,
+                # so that every band column wraps contiguous memory without copying.
+                bands = np.ascontiguousarray(spectra.T, dtype=dtype)
+                columns = [
+                    pa.array(xs.astype(np.uint32)),
+                    pa.array(ys.astype(np.uint32)),
+                ] + [pa.array(band) for band in bands]
+                writer.write_batch(pa.record_batch(columns, schema=schema))
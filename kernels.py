@@ -0,0 +1,126 @@
+"""Compiled kernels of the hottest loops of `HsImage`, each a single parallel pass over the data.
+Numba is optional, without it (or with `WHAAALE_KERNELS=numpy` set) `HsImage` uses its NumPy code.
+"""
+
+import os
+
+import numpy as np
+import numpy.typing as npt
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+if numba is not None:
+    # Compiled on first use, cached next to the module for later runs
+    jit = numba.njit(parallel=True, cache=True, nogil=True)
+    prange = numba.prange
+else:
+    # Kernels stay plain Python functions, which the equivalence harness can run on small images
+
+    def jit(func):
+        return func
+
+    prange = range
+
+enabled = numba is not None and os.environ.get("WHAAALE_KERNELS", "") != "numpy"
+"""Whether `HsImage` uses the kernels, can be changed at runtime, e.g. to compare them with NumPy"""
+
+
+@jit
+def _similar(data, scale, offset, pos_mask, use_mask, base, threshold, out):
+    h, w, b = data.shape
+    for y in prange(h):
+        for x in range(w):
+            total = 0.0
+            for i in range(b):
+                value = data[y, x, i] * scale[i] + offset[i]
+                if use_mask and not pos_mask[y, x, i]:
+                    value = 0.0
+                difference = value - base[i]
+                total += difference * difference
+            out[y, x] = total <= threshold
+
+
+@jit
+def _normalise(data, scale, offset, low, div, pos_mask, out):
+    h, w, b = data.shape
+    for y in prange(h):
+        for x in range(w):
+            for i in range(b):
+                if pos_mask[y, x, i]:
+                    # Converted to the type of the result first, so that rounding is the same as in NumPy
+                    out[y, x, i] = data[y, x, i]
+                    value = out[y, x, i]
+                    out[y, x, i] = (value * scale[i] + offset[i] - low[i]) / div[i]
+                else:
+                    out[y, x, i] = 0
+
+
+@jit
+def _to_8bpp(data, shift, half, out):
+    h, w, c = data.shape
+    for y in prange(h):
+        for x in range(w):
+            for i in range(c):
+                value = (np.int64(data[y, x, i]) + half) >> shift
+                out[y, x, i] = min(max(value, 0), 255)
+
+
+def similar(
+    data: npt.NDArray,
+    scale: npt.NDArray[np.floating],
+    offset: npt.NDArray[np.floating],
+    low: npt.NDArray[np.floating],
+    div: npt.NDArray[np.floating],
+    pos_mask: npt.NDArray[np.bool_],
+    use_mask: bool,
+    base: npt.NDArray[np.floating],
+    threshold: float,
+) -> npt.NDArray[np.bool_]:
+    """Returns the mask of pixels of [rows, width, bands] `data` whose MSE from `base` is at most `threshold`.
+    Values are dequantised (`data * scale + offset`), normalised (`(value - low) / div`) and masked by `pos_mask`
+    (if `use_mask` is set) on the fly, so nothing but the mask is allocated.
+    """
+    # Dequantisation and normalisation of every band folded into a single multiplication and addition
+    combined_scale = scale.astype(np.float64) / div
+    combined_offset = (offset.astype(np.float64) - low) / div
+    out = np.empty(data.shape[:2], dtype=np.bool_)
+    _similar(
+        data,
+        combined_scale,
+        combined_offset,
+        pos_mask,
+        use_mask,
+        base,
+        float(threshold) * data.shape[2],
+        out,
+    )
+    return out
+
+
+def normalise(
+    data: npt.NDArray,
+    scale: npt.NDArray[np.floating],
+    offset: npt.NDArray[np.floating],
+    low: npt.NDArray[np.floating],
+    div: npt.NDArray[np.floating],
+    pos_mask: npt.NDArray[np.bool_],
+    dtype: npt.DTypeLike,
+) -> npt.NDArray[np.floating]:
+    """Returns `(data * scale + offset - low) / div` of [rows, width, bands] `data`, 0 where `pos_mask` isn't set."""
+    out = np.empty(data.shape, dtype=dtype)
+    _normalise(data, scale, offset, low, div, pos_mask, out)
+    return out
+
+
+def to_8bpp(data: npt.NDArray[np.integer], bpp: int) -> npt.NDArray[np.uint8]:
+    """Returns `bpp` bit integers of 2 or 3 dimensional `data` rounded to 8 bits and clipped to [0, 255]."""
+    shift = bpp - 8
+    half = 1 << (shift - 1) if shift else 0
+    # Bands are 2D, the kernel is compiled only for 3D arrays
+    values = data[:, :, np.newaxis] if data.ndim == 2 else data
+    out = np.empty(values.shape, dtype=np.uint8)
+    _to_8bpp(values, shift, half, out)
+    return out[:, :, 0] if data.ndim == 2 else out
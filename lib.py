@@ -1,13 +1,26 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
 from enum import Enum
 from math import inf
-from typing import Any, Callable, Generic, Optional, TypeAlias, TypeVar
+from typing import Any, Callable, Generic, Iterator, Optional, TypeAlias, TypeVar
 
 import numpy as np
 import numpy.typing as npt
 
+import kernels
+from tracing import span, traced
+from utils import available_memory
+
 Coordinates: TypeAlias = tuple[int, int]
 """Coordinates in [x, y] order. Remember that the image is kept in row-major order."""
 ScalarType = TypeVar("ScalarType", np.floating, np.signedinteger, np.unsignedinteger)
+PIXEL_CACHE_SIZE = 1024
+"""Number of recently read pixels kept by `HsImage.get_pixel`"""
+SIMILAR_CHUNK_PIXELS = 1 << 16
+"""Number of pixels compared at once by `HsImage.get_similar`, limits memory used for temporary arrays"""
+DUAL_LAYOUT_MEMORY_FRACTION = 0.5
+"""Maximum fraction of available memory used for the second copy of data with `DualLayout.AUTO`"""
 
 
 class LabelType(Enum):
@@ -20,7 +33,7 @@ class LabelType(Enum):
     """
 
     AUTO = 0
-    """An integer sequence generated automatically, convertible to `int`, same as `list(range(n_bands))`"""
+    """Band numbers generated automatically, convertible to `int`, same as `list(range(n_bands))` unless a subset of bands was loaded"""
     WAVELENGTH = 1
     """Floating point numbers representing wavelengths (in nm), convertible to `float`"""
     CUSTOM_STR = 2
@@ -36,6 +49,45 @@ class NormalisationMethod(Enum):
     """Maximum and minimum must be separate for each band"""
 
 
+class DualLayout(Enum):
+    """Decides whether `HsImage` keeps data both band-sequential (fast bands) and band-interleaved (fast spectra).
+
+    The following values are available:
+    - `OFF`
+    - `ON`
+    - `AUTO`
+    """
+
+    OFF = 0
+    """Keep only the given array"""
+    ON = 1
+    """Always build the missing layout"""
+    AUTO = 2
+    """Build the missing layout if it fits in `DUAL_LAYOUT_MEMORY_FRACTION` of available memory"""
+
+
+@dataclass
+class ImageStatistics:
+    """Values computed from all data of an image"""
+
+    pos_mask: npt.NDArray[np.bool_]
+    """A boolean mask of non-negative data"""
+    norm_min: Optional[npt.NDArray[np.floating] | float] = None
+    """Normalisation minimum of floating point data, global or for every band"""
+    norm_div: Optional[npt.NDArray[np.floating] | float] = None
+    """Normalisation divisor (never 0) of floating point data, global or for every band"""
+
+
+@dataclass
+class Quantisation:
+    """Floating point data stored as scaled integers: `value = stored * scale + offset`"""
+
+    scale: npt.NDArray[np.float32]
+    """Scale for every band"""
+    offset: npt.NDArray[np.float32]
+    """Offset for every band"""
+
+
 class HsImage(Generic[ScalarType]):
     """Hyperspectral image data"""
 
@@ -46,7 +98,14 @@ class HsImage(Generic[ScalarType]):
         normalisation: Optional[NormalisationMethod] = None,
         labels: Optional[list[str]] = None,
         labels_type: Optional[LabelType] = None,
+        statistics: Optional[ImageStatistics] = None,
+        dual_layout: DualLayout = DualLayout.AUTO,
+        quantisation: Optional[Quantisation] = None,
+        storage_error: float = 0,
     ) -> None:
+        """`statistics` can be passed to skip computing them, e.g. when restoring a cached image.
+        Quantised data has to be passed with `statistics` of the original floating point values.
+        """
         if data.ndim != 3:
             raise ValueError('"data" parameter must have 3 dimensions')
         if data.shape[2] < 3:
@@ -54,41 +113,19 @@ class HsImage(Generic[ScalarType]):
                 "Image must have at least 3 bands to be properly displayed."
             )
 
-        pos_mask = data >= 0
-
-        if (data.dtype.kind == "i" or data.dtype.kind == "u") and bpp is None:
+        if quantisation is not None and statistics is None:
+            raise RuntimeError("Quantised data loaded, but statistics are None")
+        # Data type of values returned by accessors
+        dtype = np.dtype(np.float32) if quantisation is not None else data.dtype
+        if (dtype.kind == "i" or dtype.kind == "u") and bpp is None:
             raise RuntimeError("Integer data loaded, but bpp is None")
-        if data.dtype.kind == "f":
-            match normalisation:
-                case None:
-                    raise RuntimeError(
-                        "Floating point dara loaded, but normalisation is None"
-                    )
-                case NormalisationMethod.GLOBAL:
-                    ax = None
-                case NormalisationMethod.BAND:
-                    ax = (0, 1)
-
-            norm_min = np.amin(data, axis=ax, initial=np.inf, where=pos_mask)
-            norm_max = np.amax(data, axis=ax, initial=-np.inf, where=pos_mask)
+        if dtype.kind == "f" and normalisation is None:
+            raise RuntimeError("Floating point dara loaded, but normalisation is None")
 
-            if ax is None and (norm_min == np.inf or norm_max == -np.inf):
-                raise ValueError(
-                    "Image contains invalid data - all values are negative or infinity."
-                )
-            if ax is not None:
-                norm_min[norm_min == np.inf] = 0
-                norm_max[norm_max == -np.inf] = 0
-
-            self.norm_div: Optional[npt.NDArray[np.floating] | float] = (
-                norm_max - norm_min
-            )
-            # Make sure that the divisor is not 0
-            if isinstance(self.norm_div, np.ndarray):
-                self.norm_div[self.norm_div == 0] = 1
-            elif self.norm_div == 0:
-                self.norm_div = 1
-            self.norm_min: Optional[npt.NDArray[np.floating] | float] = norm_min
+        if statistics is None:
+            statistics = HsImage.compute_statistics(data, normalisation)
+        self.norm_div = statistics.norm_div
+        self.norm_min = statistics.norm_min
 
         bands = data.shape[2]
         if labels is None:
@@ -103,7 +140,22 @@ class HsImage(Generic[ScalarType]):
                 # `CUSTOM_STR` is a safe fallback value
                 labels_type = LabelType.CUSTOM_STR
 
+        band_data, layout_pending = HsImage._arrange_layouts(data, dual_layout)
         self.data = data
+        """Data in [height, width, bands] order as passed, e.g. a transposed view of a band-sequential file"""
+        self.band_data = band_data
+        """Data in [bands, height, width] order with contiguous bands or `None`"""
+        self._spectral_data = data
+        """Data in [height, width, bands] order read by spectra accessors, a contiguous copy once it has been built"""
+        self._layout_lock = threading.Lock()
+        self.layout_pending = layout_pending
+        """Whether the second layout was deferred, accessors read the available one until `build_layout` is called"""
+        self.dtype = dtype
+        """Type of values returned by accessors, differs from type of `data` if it's quantised"""
+        self.quantisation = quantisation
+        """Scale and offset of quantised data or `None`"""
+        self.storage_error = storage_error
+        """Maximum absolute error introduced by storing data in a more compact type"""
         self.normalisation = normalisation
         self.bpp = bpp
         """Bits per pixel for integer data"""
@@ -113,67 +165,381 @@ class HsImage(Generic[ScalarType]):
         """Origin and type of labels"""
         self.bands = bands
         """Number of bands in the image"""
-        self.pos_mask = pos_mask
+        self.pos_mask = statistics.pos_mask
         """A boolean mask of non-negative data"""
+        self._pixel_cache: OrderedDict[
+            Coordinates, npt.NDArray[ScalarType]
+        ] = OrderedDict()
+
+    @staticmethod
+    @traced("statistics")
+    def compute_statistics(
+        data: npt.NDArray[ScalarType], normalisation: Optional[NormalisationMethod]
+    ) -> ImageStatistics:
+        pos_mask = data >= 0
+        if data.dtype.kind != "f":
+            return ImageStatistics(pos_mask)
+
+        match normalisation:
+            case NormalisationMethod.BAND:
+                ax = (0, 1)
+            case _:
+                ax = None
+
+        norm_min = np.amin(data, axis=ax, initial=np.inf, where=pos_mask)
+        norm_max = np.amax(data, axis=ax, initial=-np.inf, where=pos_mask)
+        return HsImage.statistics_of_range(pos_mask, norm_min, norm_max)
+
+    @staticmethod
+    def statistics_of_range(
+        pos_mask: npt.NDArray[np.bool_],
+        norm_min: npt.NDArray[np.floating] | np.floating,
+        norm_max: npt.NDArray[np.floating] | np.floating,
+    ) -> ImageStatistics:
+        """Returns statistics of floating point data, whose non-negative values are in [`norm_min`, `norm_max`],
+        global or for every band (infinite if there are none).
+        """
+        if not isinstance(norm_min, np.ndarray) and (
+            norm_min == np.inf or norm_max == -np.inf
+        ):
+            raise ValueError(
+                "Image contains invalid data - all values are negative or infinity."
+            )
+        if isinstance(norm_min, np.ndarray) and isinstance(norm_max, np.ndarray):
+            norm_min[norm_min == np.inf] = 0
+            norm_max[norm_max == -np.inf] = 0
+
+        norm_div = norm_max - norm_min
+        # Make sure that the divisor is not 0
+        if isinstance(norm_div, np.ndarray):
+            norm_div[norm_div == 0] = 1
+        elif norm_div == 0:
+            norm_div = 1
+        return ImageStatistics(pos_mask, norm_min, norm_div)
+
+    @staticmethod
+    @traced("arrange_layouts")
+    def _arrange_layouts(
+        data: npt.NDArray[ScalarType], dual_layout: DualLayout
+    ) -> tuple[Optional[npt.NDArray[ScalarType]], bool]:
+        """Returns data with contiguous bands (or `None`) and whether the missing layout should be built by `build_layout`.
+        In memory band-interleaved data gets its band copy right away, if `dual_layout` allows it.
+        Copies of memory mapped or band-outer data are deferred, so that opening a cached image doesn't read it whole.
+        """
+        h, w, _ = data.shape
+        itemsize = data.dtype.itemsize
+        # Files with bands as the outer dimension (BSQ, [bands, height, width]) are only transposed by loaders
+        bands_outer = abs(data.strides[2]) >= h * w * itemsize
+        band_data = data.transpose(2, 0, 1) if bands_outer else None
+
+        match dual_layout:
+            case DualLayout.OFF:
+                build = False
+            case DualLayout.ON:
+                build = True
+            case DualLayout.AUTO:
+                available = available_memory()
+                build = (
+                    available is not None
+                    and data.nbytes <= available * DUAL_LAYOUT_MEMORY_FRACTION
+                )
+        if not build:
+            return band_data, False
+        if bands_outer or isinstance(data, np.memmap):
+            return band_data, True
+        return HsImage._copy_layout(data, band_major=True), False
+
+    @staticmethod
+    def _copy_layout(
+        data: npt.NDArray[ScalarType],
+        band_major: bool,
+        progress: Optional[Callable[[float, str], None]] = None,
+    ) -> npt.NDArray[ScalarType]:
+        """Returns a contiguous copy of [height, width, bands] `data`, in [bands, height, width] order if `band_major`.
+        `progress` is called after every block of rows and may raise an exception to abort the copy.
+        """
+        h, w, b = data.shape
+        result = np.empty((b, h, w) if band_major else (h, w, b), dtype=data.dtype)
+        target = result.transpose(1, 2, 0) if band_major else result
+        # Transposing blocks of rows which fit in CPU cache is several times faster than the whole array at once
+        rows = max(1, (2 << 20) // max(1, w * b * data.dtype.itemsize))
+        for y in range(0, h, rows):
+            target[y : y + rows] = data[y : y + rows]
+            if progress is not None:
+                progress(min(y + rows, h) / h, "Arranging bands")
+        return result
+
+    def build_layout(self, progress: Callable[[float, str], None]) -> None:
+        """Builds the layout deferred by `_arrange_layouts`, which reads the whole image.
+        It's meant for a worker thread, accessors keep reading the available layout until the copy is complete.
+        An exception raised by `progress` aborts the build and leaves it pending.
+        """
+        with self._layout_lock:
+            if not self.layout_pending:
+                return
+            with span("build_layout"):
+                if self.band_data is not None:
+                    self._spectral_data = HsImage._copy_layout(
+                        self.data, False, progress
+                    )
+                else:
+                    self.band_data = HsImage._copy_layout(self.data, True, progress)
+            self.layout_pending = False
+
+    def _dequantise(
+        self, values: npt.NDArray, bands: int | list[int] | slice = slice(None)
+    ) -> npt.NDArray:
+        """Converts quantised `values` of `bands` (the last axis or a single band) back to floating point."""
+        if self.quantisation is None:
+            return values
+        q = self.quantisation
+        return values * q.scale[bands] + q.offset[bands]
+
+    @staticmethod
+    @traced("quantise")
+    def quantise(
+        data: npt.NDArray[np.floating], chunk_pixels: int = 1 << 16
+    ) -> tuple[npt.NDArray[np.uint16], Quantisation, float]:
+        """Quantises `data` to `uint16` with a scale and offset for every band.
+        Works on chunks of rows, so that only the result and small temporary arrays are allocated.
+        Returns quantised data, parameters and the maximum absolute error of finite values.
+        Non-finite values are clipped to the range of the band (NaN becomes the minimum).
+        """
+        h, w, b = data.shape
+        rows = max(1, chunk_pixels // w)
+        band_min = np.full(b, np.inf)
+        band_max = np.full(b, -np.inf)
+        for y in range(0, h, rows):
+            chunk = data[y : y + rows]
+            finite = np.isfinite(chunk)
+            band_min = np.minimum(
+                band_min, np.amin(chunk, axis=(0, 1), initial=np.inf, where=finite)
+            )
+            band_max = np.maximum(
+                band_max, np.amax(chunk, axis=(0, 1), initial=-np.inf, where=finite)
+            )
+        quantisation = HsImage.quantisation_of_range(band_min, band_max)
+
+        quantised = np.empty((h, w, b), dtype=np.uint16)
+        max_error = 0.0
+        for y in range(0, h, rows):
+            error = HsImage.quantise_block(
+                data[y : y + rows], quantisation, quantised[y : y + rows]
+            )
+            max_error = max(max_error, error)
+        return quantised, quantisation, max_error
+
+    @staticmethod
+    def quantisation_of_range(
+        band_min: npt.NDArray[np.floating], band_max: npt.NDArray[np.floating]
+    ) -> Quantisation:
+        """Returns parameters of `quantise` for bands with finite values in [`band_min`, `band_max`]
+        (infinite if a band has none).
+        """
+        # Bands without finite values
+        band_min = np.where(band_min == np.inf, 0, band_min)
+        band_max = np.where(band_max == -np.inf, 0, band_max)
+
+        max_q = np.iinfo(np.uint16).max
+        scale = ((band_max - band_min) / max_q).astype(np.float32)
+        scale[scale == 0] = 1
+        offset = band_min.astype(np.float32)
+        return Quantisation(scale, offset)
+
+    @staticmethod
+    def quantise_block(
+        values: npt.NDArray[np.floating],
+        quantisation: Quantisation,
+        out: npt.NDArray[np.uint16],
+    ) -> float:
+        """Quantises [..., bands] `values` into `out` (they may be broadcast to it) like `quantise`.
+        Returns the maximum absolute error of finite values.
+        """
+        scale, offset = quantisation.scale, quantisation.offset
+        # A single temporary array is reused for all steps, blocks may be large
+        q = np.subtract(values, offset)
+        q /= scale
+        np.nan_to_num(q, copy=False, nan=0)
+        np.rint(q, out=q)
+        np.clip(q, 0, np.iinfo(np.uint16).max, out=q)
+        out[...] = q
+        # Rounded values are integers, so dequantising them gives the same values as dequantising `out`
+        q *= scale
+        q += offset
+        q -= values
+        error = np.abs(q, out=q)
+        return float(np.amax(error, initial=0, where=np.isfinite(error)))
+
+    def statistics(self) -> ImageStatistics:
+        return ImageStatistics(self.pos_mask, self.norm_min, self.norm_div)
 
     def get_pixel(self, x: int, y: int) -> npt.NDArray[ScalarType]:
-        """Returns a single pixel of the image as a 1D `ndarray`."""
-        return self.data[y, x]
+        """Returns a single pixel of the image as a 1D read-only `ndarray`.
+        Recently read pixels are cached (LRU), which makes repeated reads, e.g. when hovering, cheap.
+        """
+        key = (x, y)
+        pixel = self._pixel_cache.get(key)
+        if pixel is not None:
+            self._pixel_cache.move_to_end(key)
+            return pixel
+
+        # Copy to get a contiguous array detached from a possibly strided or lazily loaded cube
+        pixel = self._dequantise(np.array(self._spectral_data[y, x]))
+        pixel.flags.writeable = False
+        self._pixel_cache[key] = pixel
+        if len(self._pixel_cache) > PIXEL_CACHE_SIZE:
+            self._pixel_cache.popitem(last=False)
+        return pixel
 
-    def get_area(self, p1: Coordinates, p2: Coordinates) -> npt.NDArray[ScalarType]:
-        """Returns a subarray from the image bounded by `p1` and `p2`."""
+    @staticmethod
+    def _area_slices(p1: Coordinates, p2: Coordinates) -> tuple[slice, slice]:
+        """Returns `(rows, columns)` slices of the rectangle bounded by `p1` and `p2`."""
         x_min, x_max = (p1[0], p2[0]) if p1[0] <= p2[0] else (p2[0], p1[0])
         y_min, y_max = (p1[1], p2[1]) if p1[1] <= p2[1] else (p2[1], p1[1])
         # Add 1, because ranges don't include the upper bound
         x_max += 1
         y_max += 1
-        return self.data[y_min:y_max, x_min:x_max]
+        return slice(y_min, y_max), slice(x_min, x_max)
+
+    def get_rows(self, start: int, stop: int) -> npt.NDArray[ScalarType]:
+        """Returns rows [`start`, `stop`) of the image in [rows, width, bands] order."""
+        return self._dequantise(self._spectral_data[start:stop])
 
+    def get_pixels(
+        self, xs: npt.NDArray[np.intp], ys: npt.NDArray[np.intp]
+    ) -> npt.NDArray[ScalarType]:
+        """Returns spectra of pixels at coordinates `xs` and `ys` as [pixels, bands] array.
+        Sorting pixels by rows makes reading memory mapped data much faster.
+        """
+        return self._dequantise(self._spectral_data[ys, xs])
+
+    def get_area(self, p1: Coordinates, p2: Coordinates) -> npt.NDArray[ScalarType]:
+        """Returns a subarray from the image bounded by `p1` and `p2`."""
+        return self._dequantise(self._spectral_data[self._area_slices(p1, p2)])
+
+    def get_area_mask(self, p1: Coordinates, p2: Coordinates) -> npt.NDArray[np.bool_]:
+        """Returns a truth mask of pixels in the rectangle bounded by `p1` and `p2`."""
+        mask = np.zeros(self.data.shape[:2], dtype=np.bool_)
+        mask[self._area_slices(p1, p2)] = True
+        return mask
+
+    def iter_masked(
+        self, mask: npt.NDArray[np.bool_], chunk_pixels: int = 1 << 14
+    ) -> Iterator[tuple[npt.NDArray[np.intp], npt.NDArray[np.intp], npt.NDArray]]:
+        """Yields `(x, y, spectra)` of pixels selected by `mask` in row order.
+        Rows are processed in chunks of about `chunk_pixels` pixels, so only one chunk of spectra is kept in memory.
+        """
+        h, w, _ = self.data.shape
+        data = self._spectral_data
+        rows = max(1, chunk_pixels // w)
+        for y in range(0, h, rows):
+            ys, xs = np.nonzero(mask[y : y + rows])
+            if len(ys) == 0:
+                continue
+            yield xs, ys + y, self._dequantise(data[y : y + rows][ys, xs])
+
+    @traced("get_similar")
     def get_similar(
         self, base_coordinates: Coordinates, threshold_percent: float
     ) -> npt.NDArray[np.bool_]:
         """Returns a truth mask of pixels similar to the one with `base_coordinates` within threshold defined as percent of the maximum MSE (depends on `bpp`)."""
         h, w, b = self.data.shape
+        base, threshold = self.similarity_base(base_coordinates, threshold_percent)
+        # Compare chunks of rows, so that temporary arrays stay small for large (or quantised) images
+        similar = np.empty((h, w), dtype=np.bool_)
+        rows = max(1, SIMILAR_CHUNK_PIXELS // w)
+        for y in range(0, h, rows):
+            similar[y : y + rows] = self.similar_rows(base, threshold, y, y + rows)
+        return similar
+
+    def similarity_base(
+        self, base_coordinates: Coordinates, threshold_percent: float
+    ) -> tuple[npt.NDArray[np.floating], float]:
+        """Returns the normalised spectrum of the base pixel and the MSE threshold used by `get_similar`."""
         if self.bpp is not None:
             threshold = ((1 << self.bpp) - 1) ** 2 * threshold_percent / 100
         else:
             threshold = threshold_percent / 100.0
-        normalised = self.normalised()
-        base = normalised[base_coordinates[1], base_coordinates[0]]
         # Covert to float to avoid underflow, make a copy when changing type to reuse the array later as output
         # Cast integers to the smallest safe (including after square) float and floats to f32 if f32 or smaller and f64 if greater than f32
+        # (squares of differences of 10 bit values already overflow f16)
         if self.bpp is not None:
-            if self.bpp <= 10:
-                target_type = np.float16
-            elif self.bpp <= 23:
+            if self.bpp <= 23:
                 target_type = np.float32
             else:
                 target_type = np.float64
-        elif self.data.dtype.itemsize <= 4:
+        elif self.dtype.itemsize <= 4:
             target_type = np.float32
         else:
             target_type = np.float64
-        flattened = normalised.reshape((h * w, b)).astype(target_type, copy=True)
-        flattened -= base
-        mse: npt.NDArray[np.float_] = (
-            np.square(flattened, out=flattened).mean(axis=1).reshape((h, w))
-        )
+        x, y = base_coordinates
+        base = self.normalised_rows(y, y + 1)[0, x].astype(target_type)
+        return base, threshold
+
+    def similar_rows(
+        self, base: npt.NDArray[np.floating], threshold: float, start: int, stop: int
+    ) -> npt.NDArray[np.bool_]:
+        """Returns rows [`start`, `stop`) of the `get_similar` mask for parameters from `similarity_base`."""
+        arguments = self._kernel_arguments(start, stop)
+        if arguments is not None:
+            data, scale, offset, low, div, pos_mask = arguments
+            return kernels.similar(
+                data,
+                scale,
+                offset,
+                low,
+                div,
+                pos_mask,
+                self.normalisation is not None,
+                base.astype(np.float64),
+                threshold,
+            )
+        chunk = self.normalised_rows(start, stop).astype(base.dtype, copy=True)
+        chunk -= base
+        mse = np.square(chunk, out=chunk).mean(axis=2)
         return mse <= threshold
 
+    @traced("get_band")
     def get_band(self, idx: int) -> npt.NDArray[ScalarType]:
         """Returns a single band of the image."""
-        return self.data[:, :, idx]
+        return self.get_band_rows(idx, 0, self.data.shape[0])
+
+    def get_band_rows(self, idx: int, start: int, stop: int) -> npt.NDArray[ScalarType]:
+        """Returns rows [`start`, `stop`) of a single band."""
+        band_data = self.band_data
+        if band_data is not None:
+            band = band_data[idx, start:stop]
+        else:
+            band = self.data[start:stop, :, idx]
+        return self._dequantise(band, idx)
 
+    @traced("get_RGB_bands")
     def get_RGB_bands(
         self, r_idx: int, g_idx: int, b_idx: int
     ) -> npt.NDArray[ScalarType]:
         """Returns three selected bands of the image."""
         assert self.bands >= 3
-        return self.data[:, :, (r_idx, g_idx, b_idx)]
+        bands = [r_idx, g_idx, b_idx]
+        band_data = self.band_data
+        if band_data is not None:
+            # Copying whole bands is much faster than gathering 3 values from every spectrum
+            rgb = band_data[bands].transpose(1, 2, 0)
+        else:
+            rgb = self.data[:, :, bands]
+        return self._dequantise(rgb, bands)
 
     def closest_rgb_idx(self):
         """Returns indexes of bands with wavelengths closest to RGB pixel frequencies or `None`."""
-        if self.labels_type != LabelType.WAVELENGTH:
+        return HsImage.find_rgb_idx(self.labels, self.labels_type)
+
+    @staticmethod
+    def find_rgb_idx(
+        labels: list[str], labels_type: LabelType
+    ) -> Optional[tuple[int, int, int]]:
+        """Returns indexes of `labels` with wavelengths closest to RGB pixel frequencies or `None`.
+        Allows choosing bands before the image is loaded.
+        """
+        if labels_type != LabelType.WAVELENGTH:
             return
 
         R_WAVELENGTH = 630
@@ -186,7 +552,7 @@ class HsImage(Generic[ScalarType]):
         g_idx = 0
         b_idx = 0
         try:
-            for i, l in enumerate(self.labels):
+            for i, l in enumerate(labels):
                 lf = float(l)
                 dr = abs(R_WAVELENGTH - lf)
                 dg = abs(G_WAVELENGTH - lf)
@@ -206,14 +572,63 @@ class HsImage(Generic[ScalarType]):
         if max(diff_r, diff_g, diff_b) < 30:
             return r_idx, g_idx, b_idx
 
+    @traced("normalised")
     def normalised(self):
         """Returns image data normalised to [0, 1] range if the data is integer. Integer data is left unchanged."""
+        return self.normalised_rows(0, self.data.shape[0])
+
+    def normalised_rows(self, start: int, stop: int):
+        """Returns rows [`start`, `stop`) of `normalised()` data."""
         if self.normalisation is None:
-            return self.data
+            return self._dequantise(self._spectral_data[start:stop])
+        arguments = self._kernel_arguments(start, stop)
+        if arguments is not None:
+            return kernels.normalise(*arguments, arguments[3].dtype)
+        rows = self._dequantise(self._spectral_data[start:stop])
+        if self.quantisation is not None and rows.dtype == np.result_type(
+            rows, self.norm_min, self.norm_div
+        ):
+            # Dequantised rows are already a new array, which is reused for the result
+            scaled = np.subtract(rows, self.norm_min, out=rows)
         else:
-            scaled = (self.data - self.norm_min) / self.norm_div
-            scaled[~self.pos_mask] = 0
-            return scaled
+            scaled = rows - self.norm_min
+        scaled /= self.norm_div
+        np.copyto(scaled, 0, where=~self.pos_mask[start:stop])
+        return scaled
+
+    def _kernel_arguments(
+        self, start: int, stop: int
+    ) -> Optional[tuple[npt.NDArray, ...]]:
+        """Returns data, dequantisation and normalisation parameters (for every band) and `pos_mask` of rows
+        [`start`, `stop`), as expected by `kernels`, or `None` if the kernels are disabled or don't support the data type.
+        """
+        data = self._spectral_data[start:stop]
+        # Numba doesn't support all operations on half precision floats
+        if (
+            not kernels.enabled
+            or data.dtype.kind not in "iuf"
+            or data.dtype == np.float16
+        ):
+            return None
+        # Parameters have the type of `normalised_rows` values, so that floating point results are the same
+        if self.normalisation is None:
+            dtype = np.dtype(np.float64)
+        else:
+            dtype = np.result_type(self.dtype, self.norm_min, self.norm_div)
+        b = self.bands
+        if self.quantisation is not None:
+            scale = self.quantisation.scale.astype(dtype)
+            offset = self.quantisation.offset.astype(dtype)
+        else:
+            scale = np.ones(b, dtype=dtype)
+            offset = np.zeros(b, dtype=dtype)
+        if self.normalisation is None:
+            low = np.zeros(b, dtype=dtype)
+            div = np.ones(b, dtype=dtype)
+        else:
+            low = np.broadcast_to(self.norm_min, b).astype(dtype)
+            div = np.broadcast_to(self.norm_div, b).astype(dtype)
+        return data, scale, offset, low, div, self.pos_mask[start:stop]
 
     def get_norm_prop(self, *args: tuple[int] | tuple[int, int, int]):
         if self.normalisation == NormalisationMethod.GLOBAL:
@@ -251,26 +666,41 @@ class HsImage(Generic[ScalarType]):
 
         return wrapper
 
+    @traced("get_band_normalised")
     @_normalise
     def get_band_normalised(self, idx: int):
         """Returns a single band of the image normalised to [0, 1]."""
         return self.get_band(idx)
 
+    @traced("get_RGB_bands_normalised")
     @_normalise
     def get_RGB_bands_normalised(self, r_idx: int, g_idx: int, b_idx: int):
         """Returns three selected bands of the image normalised to [0, 1]."""
         return self.get_RGB_bands(r_idx, g_idx, b_idx)
 
+    @staticmethod
+    @traced("normalised_as_8bpp")
+    def normalised_as_8bpp(values: npt.NDArray[np.floating]) -> npt.NDArray[np.uint8]:
+        """Returns values normalised to [0, 1] rounded to 8 bits, missing values (NaN) are black."""
+        scaled = np.nan_to_num(values, nan=0.0, posinf=1.0, neginf=0.0)
+        np.clip(scaled, 0, 1, out=scaled)
+        scaled *= 255
+        np.rint(scaled, out=scaled)
+        return scaled.astype(np.uint8)
+
+    @traced("as_8bpp")
     def as_8bpp(self, data: npt.NDArray[np.signedinteger | np.unsignedinteger]):
         assert data.dtype.kind == "i" or data.dtype.kind == "u"
         assert self.bpp and self.bpp >= 8
 
+        if kernels.enabled:
+            return kernels.to_8bpp(data, self.bpp)
         bpp_diff = self.bpp - 8
         # Type conversion to uint8 is time consuming, but Qt expects data in such format.
-        # We cant just pass 32-bit values capped at 255
+        # We cant just pass 32-bit values capped at 255, values are widened, so that rounding the maximum doesn't overflow
+        rounded = data.astype(np.int64 if data.itemsize >= 4 else np.int32)
         if bpp_diff:
-            rounded = ((data + (1 << (bpp_diff - 1))) >> bpp_diff).astype(np.uint8)
-        else:
-            rounded = data.astype(np.uint8)
-        rounded[rounded < 0] = 0
-        return rounded
+            rounded += 1 << (bpp_diff - 1)
+            rounded >>= bpp_diff
+        np.clip(rounded, 0, 255, out=rounded)
+        return rounded.astype(np.uint8)
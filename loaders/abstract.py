@@ -1,16 +1,183 @@
+import threading
 from abc import ABC, abstractmethod
-from math import ceil, log2
-from typing import Optional
+from dataclasses import dataclass
+from enum import Enum
+from math import ceil
+from typing import TYPE_CHECKING, Callable, Optional, TypeAlias
 
 import numpy as np
 import numpy.typing as npt
-from PyQt6.QtWidgets import QInputDialog, QWidget
+from PyQt6.QtWidgets import (
+    QDialog,
+    QDialogButtonBox,
+    QFormLayout,
+    QInputDialog,
+    QLineEdit,
+    QWidget,
+)
 
-from lib import HsImage, NormalisationMethod, ScalarType
+from lib import DualLayout, HsImage, LabelType, NormalisationMethod, ScalarType
 from utils import staticproperty
 
+if TYPE_CHECKING:
+    from loaders.blocks import BlockQuantiser
+
+ProgressCallback: TypeAlias = Callable[[float, str], None]
+"""Called by loaders with the completed fraction of work in [0, 1] and a description of the current stage.
+May raise `LoadingCancelled` to abort loading."""
+
+BlockCallback: TypeAlias = Callable[[npt.NDArray, tuple[slice, ...]], None]
+"""Called by loaders, possibly from several threads at once, with values of a block which has just been read
+and its slices in the whole image, both in the order of axes of the file. Slices without a start begin at 0."""
+
+ArrayOrder: TypeAlias = tuple[int, int, int]
+"""Axes passed to `np.transpose` to get [height, width, bands] order"""
+
+Window: TypeAlias = tuple[int, int, int, int]
+"""x, y, width and height of a rectangle in image coordinates"""
+
+
+def ignore_progress(fraction: float, stage: str):
+    """A `ProgressCallback` of work nobody watches."""
+
+
+class StorageType(Enum):
+    """Type used to store floating point data in memory.
+
+    The following values are available:
+    - `ORIGINAL`
+    - `FLOAT32`
+    - `FLOAT16`
+    - `UINT16`
+    """
+
+    ORIGINAL = 0
+    """Keep the type of the file"""
+    FLOAT32 = 1
+    """Convert to `float32` while reading"""
+    FLOAT16 = 2
+    """Convert to `float16` while reading"""
+    UINT16 = 3
+    """Quantise to `uint16` with scale and offset for every band block by block in two passes over the file,
+    the first finds ranges of bands, the second quantises, so the image never exists in floating point as a whole"""
+
+
+class LoadingCancelled(Exception):
+    """Raised from a progress callback to abort loading."""
+
+    pass
+
+
+@dataclass
+class LoadOptions:
+    """Choices made before loading. Loaders must not ask for anything after the options are known."""
+
+    normalisation: NormalisationMethod = NormalisationMethod.GLOBAL
+    """Normalisation method for floating point data"""
+    bpp: Optional[int] = None
+    """Bits per pixel for integer data, `None` to detect from data"""
+    array_order: ArrayOrder = (0, 1, 2)
+    """Order of axes in the file, only used by formats which don't define it"""
+    var_name: Optional[str] = None
+    """Name of the variable containing the image, only used by formats which can store more arrays"""
+    bands: Optional[list[int]] = None
+    """Ascending indexes of bands to load, `None` to load all"""
+    window: Optional[Window] = None
+    """Part of the image to load, `None` to load all pixels"""
+    storage: StorageType = StorageType.ORIGINAL
+    """Type used to store floating point data, ignored for integer data"""
+    dual_layout: DualLayout = DualLayout.AUTO
+    """Whether to keep a second copy of data for fast access to both bands and spectra"""
+    progressive: bool = False
+    """Load a decimated preview of the bands needed for the initial view before loading the full image"""
+
+
+@dataclass
+class FileHeader:
+    """Properties of an image known from headers, before its data is read."""
+
+    dtype: np.dtype
+    bands: int
+    """Number of bands in the file"""
+    labels: Optional[list[str]]
+    labels_type: Optional[LabelType]
+
+
+@dataclass
+class LoadPreview:
+    """A quick look at the image while it's being loaded."""
+
+    image: HsImage
+    """Decimated image with 3 bands: RGB if `rgb` is `True`, otherwise the first band repeated"""
+    rgb: bool
+    width: int
+    """Width of the full resolution image (or window)"""
+    height: int
+    """Height of the full resolution image (or window)"""
+    bands: list[int]
+    """Loaded bands shown in the red, green and blue channels"""
+
+    def as_8bpp(
+        self, values: npt.NDArray, channels: list[int]
+    ) -> npt.NDArray[np.uint8]:
+        """Returns `values` of the preview `channels` (the last axis) scaled to 8 bits like the preview is shown."""
+        image = self.image
+        if image.bpp is not None:
+            return image.as_8bpp(values)
+        norm_min, norm_div = image.norm_min, image.norm_div
+        if isinstance(norm_min, np.ndarray):
+            norm_min = norm_min[channels]
+        if isinstance(norm_div, np.ndarray):
+            norm_div = norm_div[channels]
+        return HsImage.normalised_as_8bpp(
+            (values.astype(np.float32) - norm_min) / norm_div
+        )
+
+
+class PreviewRefinement:
+    """Full resolution pixels of the preview, which start as the stretched decimated preview
+    and are replaced by the loaded values as blocks of the image are read.
+    """
+
+    def __init__(self, preview: LoadPreview, array_order: ArrayOrder) -> None:
+        self.preview = preview
+        self.array_order = array_order
+        image = preview.image
+        decimated = preview.as_8bpp(image.get_rows(0, image.data.shape[0]), [0, 1, 2])
+        # Nearest neighbour, like the preview is stretched when shown
+        ph, pw, _ = decimated.shape
+        ys = np.arange(preview.height) * ph // preview.height
+        xs = np.arange(preview.width) * pw // preview.width
+        self.pixels = decimated[ys][:, xs]
+        """[height, width, 3] pixels of the whole image, the loading thread and reading threads update it"""
+        self.lock = threading.Lock()
+
+    def add_block(
+        self, values: npt.NDArray, index: tuple[slice, ...]
+    ) -> Optional[tuple[int, int, npt.NDArray[np.uint8]]]:
+        """Replaces pixels of the preview bands in a block which has just been read, see `BlockCallback`.
+        Returns x, y and a copy of the updated pixels or `None` if the block contains none of the preview bands.
+        """
+        block = values.transpose(self.array_order)
+        h, w, b = block.shape
+        y0, x0, b0 = (index[axis].start or 0 for axis in self.array_order)
+        channels = [
+            c for c, band in enumerate(self.preview.bands) if b0 <= band < b0 + b
+        ]
+        if not channels or h == 0 or w == 0:
+            return None
+        selected = block[:, :, [self.preview.bands[c] - b0 for c in channels]]
+        pixels = self.preview.as_8bpp(selected, channels)
+        with self.lock:
+            target = self.pixels[y0 : y0 + h, x0 : x0 + w]
+            target[:, :, channels] = pixels
+            return x0, y0, target.copy()
+
 
 class AbstractFileLoader(ABC):
+    PREVIEW_SIZE = 1024
+    """Maximum width and height of a preview"""
+
     @staticproperty
     @abstractmethod
     def FILE_FILTER_NAME() -> str:
@@ -33,12 +200,325 @@ class AbstractFileLoader(ABC):
 
     @staticmethod
     @abstractmethod
-    def load_file(path: str, parent: QWidget) -> Optional[HsImage]:
-        """Loads a file given its path. `parent` is provided to be used as a parent `QWidget` for dialogs/popups.
+    def get_options(
+        path: str, parent: QWidget, subset: bool = False
+    ) -> Optional[LoadOptions]:
+        """Asks the user about everything needed to load a file given its path. Only headers should be read here.
+        `parent` is provided to be used as a parent `QWidget` for dialogs/popups.
+        If `subset` is set, also asks which bands and part of the image to load, see `get_subset`.
         Returns `None` if user cancels the operation.
         """
         pass
 
+    @staticmethod
+    @abstractmethod
+    def load_file(
+        path: str,
+        options: LoadOptions,
+        progress: ProgressCallback,
+        on_block: Optional[BlockCallback] = None,
+    ) -> HsImage:
+        """Loads a file given its path and options. Called from a worker thread, so it must not show any dialogs.
+        Data should be read in chunks reporting `progress`, which may raise `LoadingCancelled`,
+        and passing every chunk to `on_block` if it's provided.
+        """
+        pass
+
+    @staticmethod
+    def read_header(path: str, options: LoadOptions) -> Optional[FileHeader]:
+        """Reads the type, number and labels of bands of the whole file without reading data, e.g. to choose bands
+        to load. Returns `None` if the format doesn't support it.
+        """
+        return None
+
+    @staticmethod
+    def source_files(path: str) -> list[str]:
+        """Returns all files read when loading `path`, changes to any of them invalidate cached images."""
+        return [path]
+
+    @staticmethod
+    def load_preview(path: str, options: LoadOptions) -> Optional[LoadPreview]:
+        """Quickly loads a decimated version of bands shown initially. Called from a worker thread before `load_file`.
+        Returns `None` if the format doesn't support partial reads.
+        """
+        return None
+
+    @staticmethod
+    def preview_factor(width: int, height: int) -> int:
+        """Returns the decimation factor so that preview fits in `PREVIEW_SIZE`."""
+        return max(1, ceil(max(width, height) / AbstractFileLoader.PREVIEW_SIZE))
+
+    @staticmethod
+    def preview_bands(
+        labels: Optional[list[str]], labels_type: Optional[LabelType]
+    ) -> tuple[bool, list[int]]:
+        """Returns whether preview is RGB and indexes of 3 bands matching the initial view of the main window."""
+        if labels is not None and labels_type is not None:
+            rgb_idx = HsImage.find_rgb_idx(labels, labels_type)
+            if rgb_idx is not None:
+                return True, list(rgb_idx)
+        return False, [0, 0, 0]
+
+    @staticmethod
+    def subset_labels(
+        labels: Optional[list[str]],
+        labels_type: Optional[LabelType],
+        options: LoadOptions,
+    ) -> tuple[Optional[list[str]], Optional[LabelType]]:
+        """Returns labels of bands selected in `options`. Bands without labels are labelled with their numbers in the file."""
+        if options.bands is None:
+            return labels, labels_type
+        if labels is None:
+            return [str(b) for b in options.bands], LabelType.AUTO
+        return [labels[b] for b in options.bands], labels_type
+
+    @staticmethod
+    def get_subset(
+        width: int,
+        height: int,
+        labels: Optional[list[str]],
+        labels_type: Optional[LabelType],
+        parent: QWidget,
+        options: LoadOptions,
+    ) -> Optional[LoadOptions]:
+        """Asks which bands and which part of the image should be loaded in a single dialog.
+        Empty fields load everything. Returns `None` if cancelled.
+        """
+        n_bands = len(labels) if labels is not None else None
+        hint = "e.g. 0-49, 60"
+        if labels_type == LabelType.WAVELENGTH:
+            hint += " or 400-1000 nm"
+
+        dialog = QDialog(parent)
+        dialog.setWindowTitle("Whaaale - open part of image")
+        bands_edit = QLineEdit(dialog)
+        bands_edit.setPlaceholderText(f"all bands, {hint}")
+        window_edit = QLineEdit(dialog)
+        window_edit.setPlaceholderText(f"the whole {width}x{height} image")
+        buttons = QDialogButtonBox(
+            QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel,
+            dialog,
+        )
+        buttons.accepted.connect(dialog.accept)
+        buttons.rejected.connect(dialog.reject)
+        layout = QFormLayout(dialog)
+        layout.addRow("Bands:", bands_edit)
+        layout.addRow("Window (x, y, width, height):", window_edit)
+        layout.addRow(buttons)
+        if dialog.exec() != QDialog.DialogCode.Accepted:
+            return
+
+        options.bands = AbstractFileLoader.parse_bands(
+            bands_edit.text(), labels, labels_type, n_bands
+        )
+        options.window = AbstractFileLoader.parse_window(
+            window_edit.text(), width, height
+        )
+        return options
+
+    @staticmethod
+    def parse_bands(
+        text: str,
+        labels: Optional[list[str]],
+        labels_type: Optional[LabelType],
+        n_bands: Optional[int],
+    ) -> Optional[list[int]]:
+        """Parses comma separated band indexes and inclusive ranges of indexes or a wavelength range ending with "nm".
+        Returns `None` for an empty text. Raises `ValueError` if the text is invalid.
+        """
+        text = text.strip()
+        if not text:
+            return None
+
+        if text.endswith("nm"):
+            if labels is None or labels_type != LabelType.WAVELENGTH:
+                raise ValueError("The image has no wavelengths, select bands by index.")
+            low, _, high = text[:-2].partition("-")
+            low_nm = float(low)
+            high_nm = float(high) if high.strip() else low_nm
+            bands = [i for i, l in enumerate(labels) if low_nm <= float(l) <= high_nm]
+        else:
+            selected: set[int] = set()
+            for part in text.split(","):
+                first, _, last = part.partition("-")
+                first_idx = int(first)
+                last_idx = int(last) if last.strip() else first_idx
+                selected.update(range(first_idx, last_idx + 1))
+            bands = sorted(selected)
+
+        if n_bands is not None and any(b < 0 or b >= n_bands for b in bands):
+            raise ValueError(f"Band indexes must be in range 0-{n_bands - 1}.")
+        # Required by HsImage
+        if len(bands) < 3:
+            raise ValueError(
+                f"At least 3 bands must be loaded, {len(bands)} selected by {text}."
+            )
+        return bands
+
+    @staticmethod
+    def parse_window(text: str, width: int, height: int) -> Optional[Window]:
+        """Parses "x, y, width, height", returns `None` for an empty text. Raises `ValueError` if the text is invalid."""
+        text = text.strip()
+        if not text:
+            return None
+
+        parts = [int(x) for x in text.split(",")]
+        if len(parts) != 4:
+            raise ValueError(f"Window must have 4 values, got {text}.")
+        x, y, w, h = parts
+        if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > width or y + h > height:
+            raise ValueError(
+                f"Window {text} doesn't fit in the {width}x{height} image."
+            )
+        return x, y, w, h
+
+    @staticmethod
+    def make_preview(
+        data: npt.NDArray[ScalarType],
+        options: LoadOptions,
+        rgb: bool,
+        width: int,
+        height: int,
+        bands: list[int],
+        labels: Optional[list[str]] = None,
+    ) -> LoadPreview:
+        """Creates `LoadPreview` from decimated data, the same way as `make_image`."""
+        image = AbstractFileLoader.make_image(data, options, ignore_progress, labels)
+        return LoadPreview(image, rgb, width, height, bands)
+
+    @staticmethod
+    def storage_dtype(dtype: np.dtype, options: LoadOptions) -> np.dtype:
+        """Returns the type of the array data should be read into, conversions never increase precision."""
+        if dtype.kind != "f":
+            return dtype
+        match options.storage:
+            case StorageType.FLOAT32 | StorageType.UINT16:
+                target = np.dtype(np.float32)
+            case StorageType.FLOAT16:
+                target = np.dtype(np.float16)
+            case _:
+                target = dtype
+        return target if target.itemsize < dtype.itemsize else dtype
+
+    @staticmethod
+    def conversion_error(
+        data: npt.NDArray[np.floating],
+        source_dtype: np.dtype,
+        chunk_pixels: int = 1 << 16,
+    ) -> float:
+        """Returns the bound of the absolute rounding error of finite values in `data` converted from `source_dtype`.
+        Raises `ValueError` if values overflowed when converting to `float16`.
+        """
+        if data.dtype == source_dtype:
+            return 0
+        h, w, _ = data.shape
+        rows = max(1, chunk_pixels // w)
+        max_abs = 0.0
+        for y in range(0, h, rows):
+            chunk = data[y : y + rows]
+            finite = np.isfinite(chunk)
+            if data.dtype == np.float16 and np.isinf(chunk).any():
+                # Infinity in the file is unlikely, but values over 65504 are common
+                raise ValueError(
+                    "Values exceed the range of float16, choose another storage type."
+                )
+            max_abs = max(
+                max_abs,
+                float(np.amax(chunk, initial=0, where=finite)),
+                -float(np.amin(chunk, initial=0, where=finite)),
+            )
+        return AbstractFileLoader.rounding_error(max_abs, data.dtype)
+
+    @staticmethod
+    def rounding_error(max_abs: float, dtype: np.dtype) -> float:
+        """Returns the bound of the absolute error of rounding values up to `max_abs` to `dtype`."""
+        info = np.finfo(dtype)
+        # Rounding to nearest is off by half of the spacing at most (subnormal spacing for the smallest values)
+        return max_abs * float(info.eps) / 2 + float(info.smallest_subnormal) / 2
+
+    @staticmethod
+    def make_image(
+        data: npt.NDArray[ScalarType],
+        options: LoadOptions,
+        progress: ProgressCallback,
+        labels: Optional[list[str]] = None,
+        labels_type: Optional[LabelType] = None,
+        source_dtype: Optional[np.dtype] = None,
+        quantiser: Optional["BlockQuantiser"] = None,
+    ) -> HsImage:
+        """Creates `HsImage` from loaded data, computing statistics is reported as the last stage.
+        `source_dtype` is the type in the file if data was converted with `storage_dtype` while reading.
+        `quantiser` is passed if data was quantised while reading, it provides statistics of the original values.
+        """
+        if data.dtype.kind not in ("i", "u", "f"):
+            raise NotImplementedError(
+                f"Only integer and floating point types are supported, file uses {data.dtype.name}."
+            )
+
+        if data.dtype.kind == "f" and source_dtype is None:
+            # Not converted while reading, e.g. because the format can't be read in parts
+            source_dtype = data.dtype
+            data = data.astype(
+                AbstractFileLoader.storage_dtype(data.dtype, options), copy=False
+            )
+
+        data = data.transpose(options.array_order)
+        progress(0.9, "Computing statistics")
+        quantisation = None
+        storage_error = 0.0
+        statistics = None
+        if quantiser is not None:
+            assert source_dtype is not None
+            bpp = None
+            normalisation = options.normalisation
+            statistics = quantiser.statistics(options.array_order)
+            quantisation = quantiser.quantisation
+            storage_error = quantiser.storage_error(source_dtype)
+        elif data.dtype.kind == "f":
+            bpp = None
+            normalisation = options.normalisation
+            assert source_dtype is not None
+            storage_error = AbstractFileLoader.conversion_error(data, source_dtype)
+            if options.storage == StorageType.UINT16:
+                # Statistics of the original values are used for normalisation
+                statistics = HsImage.compute_statistics(data, normalisation)
+                progress(0.95, "Quantising")
+                data, quantisation, quantisation_error = HsImage.quantise(data)
+                storage_error += quantisation_error
+        else:
+            bpp = AbstractFileLoader.check_bpp(data, options.bpp)
+            normalisation = None
+
+        image = HsImage(
+            data,
+            bpp=bpp,
+            normalisation=normalisation,
+            labels=labels,
+            labels_type=labels_type,
+            statistics=statistics,
+            dual_layout=options.dual_layout,
+            quantisation=quantisation,
+            storage_error=storage_error,
+        )
+        progress(1, "Done")
+        return image
+
+    @staticmethod
+    def check_bpp(data: npt.NDArray[ScalarType], bpp: Optional[int]) -> int:
+        """Returns the number of bits needed to store the maximum value in `data` (at least 8) if `bpp` is `None`.
+        Otherwise makes sure that `bpp` is sufficient and returns it.
+        """
+        max_val = int(np.max(data))
+        # HsImage.as_8bpp requires at least 8 bits
+        min_bpp = max(8, max_val.bit_length())
+        if bpp is None:
+            return min_bpp
+        if bpp < min_bpp:
+            raise ValueError(
+                f"Bits per pixel set to {bpp}, but the maximum value in data needs {min_bpp}."
+            )
+        return bpp
+
     @staticmethod
     def get_normalisation(parent: QWidget) -> Optional[NormalisationMethod]:
         GLOBAL = "Global"
@@ -50,22 +530,46 @@ class AbstractFileLoader(ABC):
             [GLOBAL, BAND],
             editable=False,
         )
+        if not ok:
+            return
         if norm == GLOBAL:
             return NormalisationMethod.GLOBAL
         if norm == BAND:
             return NormalisationMethod.BAND
 
     @staticmethod
-    def get_bpp(data: npt.NDArray[ScalarType], parent: QWidget) -> Optional[int]:
-        max = data.dtype.itemsize * 8
-        max_val: ScalarType = np.max(data)
-        min_bpp = ceil(log2(max_val))
+    def get_storage(dtype: np.dtype, parent: QWidget) -> Optional[StorageType]:
+        """Asks for the type used to store floating point data. Returns `None` if cancelled."""
+        choices = {f"Original ({dtype.name})": StorageType.ORIGINAL}
+        if dtype.itemsize > 4:
+            choices["float32"] = StorageType.FLOAT32
+        if dtype.itemsize > 2:
+            choices["float16"] = StorageType.FLOAT16
+            choices["Quantised uint16"] = StorageType.UINT16
+        if len(choices) == 1:
+            return StorageType.ORIGINAL
+
+        storage, ok = QInputDialog.getItem(
+            parent,
+            "Whaaale - open file",
+            "Store data as:",
+            list(choices),
+            editable=False,
+        )
+        if ok:
+            return choices[storage]
+
+    @staticmethod
+    def get_bpp(dtype: np.dtype, parent: QWidget) -> Optional[int]:
+        """Returns bits per pixel selected by the user, 0 to detect from data or `None` if cancelled."""
+        max = dtype.itemsize * 8
 
         bpp, ok = QInputDialog.getInt(
             parent,
             "Whaaale - open file",
-            "Bits per pixel:",
-            min=min_bpp,
+            "Bits per pixel (0 to detect from data):",
+            value=0,
+            min=0,
             max=max,
         )
 
@@ -73,7 +577,34 @@ class AbstractFileLoader(ABC):
             return bpp
 
     @staticmethod
-    def fix_array_order(data: npt.NDArray[ScalarType], parent: QWidget):
+    def get_type_options(
+        dtype: np.dtype, parent: QWidget, options: LoadOptions
+    ) -> Optional[LoadOptions]:
+        """Asks for normalisation or bits per pixel depending on `dtype`. Returns `None` if cancelled."""
+        if dtype.kind == "f":
+            normalisation = AbstractFileLoader.get_normalisation(parent)
+            if normalisation is None:
+                return
+            options.normalisation = normalisation
+            storage = AbstractFileLoader.get_storage(dtype, parent)
+            if storage is None:
+                return
+            options.storage = storage
+        elif dtype.kind == "i" or dtype.kind == "u":
+            bpp = AbstractFileLoader.get_bpp(dtype, parent)
+            if bpp is None:
+                return
+            options.bpp = bpp if bpp != 0 else None
+        else:
+            raise NotImplementedError(
+                f"Only integer and floating point types are supported, file uses {dtype.name}."
+            )
+        return options
+
+    @staticmethod
+    def fix_array_order(
+        shape: tuple[int, ...], parent: QWidget
+    ) -> Optional[ArrayOrder]:
         HWB = "[height, width, bands]"
         WHB = "[width, height, bands]"
         BHW = "[bands, height, width]"
@@ -82,7 +613,7 @@ class AbstractFileLoader(ABC):
         option, ok = QInputDialog.getItem(
             parent,
             "Whaaale - open file",
-            f"Array order [{', '.join([str(x) for x in data.shape])}]:",
+            f"Array order [{', '.join([str(x) for x in shape])}]:",
             [HWB, WHB, BHW, BWH],
             editable=False,
         )
@@ -91,10 +622,10 @@ class AbstractFileLoader(ABC):
             return
 
         if option == HWB:
-            return data
+            return (0, 1, 2)
         elif option == WHB:
-            return data.transpose((1, 0, 2))
+            return (1, 0, 2)
         elif option == BHW:
-            return data.transpose((1, 2, 0))
+            return (1, 2, 0)
         elif option == BWH:
-            return data.transpose((2, 1, 0))
+            return (2, 1, 0)
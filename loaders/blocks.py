@@ -0,0 +1,184 @@
+import threading
+from typing import Iterator, Optional
+
+import numpy as np
+import numpy.typing as npt
+
+from lib import HsImage, ImageStatistics, NormalisationMethod, Quantisation
+from loaders.abstract import (
+    AbstractFileLoader,
+    ArrayOrder,
+    BlockCallback,
+    LoadOptions,
+    ProgressCallback,
+    StorageType,
+)
+
+
+class BlockQuantiser:
+    """Quantises floating point data to `uint16` block by block (`StorageType.UINT16`),
+    so that the image never exists in floating point as a whole.
+    Blocks of the first pass over the file are passed to `measure`, which finds ranges of bands and statistics,
+    blocks of the second pass to `store`, which quantises them into `data`.
+    """
+
+    def __init__(
+        self, shape: tuple[int, ...], dtype: np.dtype, options: LoadOptions
+    ) -> None:
+        self.data = np.empty(shape, dtype=np.uint16)
+        """Quantised data in the order of axes of the file"""
+        self.pos_mask = np.empty(shape, dtype=np.bool_)
+        """A boolean mask of non-negative data in the order of axes of the file"""
+        self.dtype = dtype
+        """Type of values, which are quantised"""
+        self.b_axis = options.array_order[2]
+        self.normalisation = options.normalisation
+        b = shape[self.b_axis]
+        self.band_min = np.full(b, np.inf)
+        self.band_max = np.full(b, -np.inf)
+        self.pos_min = np.full(b, np.inf, dtype=dtype)
+        self.pos_max = np.full(b, -np.inf, dtype=dtype)
+        self.max_abs = 0.0
+        self.max_error = 0.0
+        self.quantisation: Optional[Quantisation] = None
+        self.lock = threading.Lock()
+
+    def _bands_last(
+        self, values: npt.NDArray, index: tuple[slice, ...]
+    ) -> tuple[npt.NDArray, slice]:
+        """Returns `values` converted to `dtype` with bands as the last axis and their slice."""
+        values = np.moveaxis(values.astype(self.dtype, copy=False), self.b_axis, -1)
+        start = index[self.b_axis].start or 0
+        return values, slice(start, start + values.shape[-1])
+
+    def measure(self, values: npt.NDArray, index: tuple[slice, ...]) -> None:
+        """Adds values of a block at `index` to ranges of bands, may be called from several threads."""
+        values, bands = self._bands_last(values, index)
+        axes = tuple(range(values.ndim - 1))
+        finite = np.isfinite(values)
+        positive = values >= 0
+        band_min = np.amin(values, axis=axes, initial=np.inf, where=finite)
+        band_max = np.amax(values, axis=axes, initial=-np.inf, where=finite)
+        pos_min = np.amin(values, axis=axes, initial=np.inf, where=positive)
+        pos_max = np.amax(values, axis=axes, initial=-np.inf, where=positive)
+        extremes = np.abs(np.concatenate([band_min, band_max]))
+        max_abs = float(np.amax(extremes, initial=0, where=np.isfinite(extremes)))
+        with self.lock:
+            np.minimum(self.band_min[bands], band_min, out=self.band_min[bands])
+            np.maximum(self.band_max[bands], band_max, out=self.band_max[bands])
+            np.minimum(self.pos_min[bands], pos_min, out=self.pos_min[bands])
+            np.maximum(self.pos_max[bands], pos_max, out=self.pos_max[bands])
+            self.max_abs = max(self.max_abs, max_abs)
+
+    def finish_measuring(self) -> None:
+        """Chooses quantisation parameters once all blocks have been measured."""
+        self.quantisation = HsImage.quantisation_of_range(self.band_min, self.band_max)
+
+    def store(self, values: npt.NDArray, index: tuple[slice, ...]) -> None:
+        """Quantises values of a block into `data` at `index`, may be called from several threads.
+        `values` may be broadcast to the block, e.g. a fill value.
+        """
+        assert self.quantisation is not None
+        values, bands = self._bands_last(values, index)
+        quantisation = Quantisation(
+            self.quantisation.scale[bands], self.quantisation.offset[bands]
+        )
+        target = np.moveaxis(self.data[index], self.b_axis, -1)
+        error = HsImage.quantise_block(values, quantisation, target)
+        np.moveaxis(self.pos_mask[index], self.b_axis, -1)[...] = values >= 0
+        with self.lock:
+            self.max_error = max(self.max_error, error)
+
+    def statistics(self, array_order: ArrayOrder) -> ImageStatistics:
+        """Returns statistics of the original values for data transposed by `array_order`."""
+        pos_mask = self.pos_mask.transpose(array_order)
+        if self.normalisation == NormalisationMethod.BAND:
+            return HsImage.statistics_of_range(pos_mask, self.pos_min, self.pos_max)
+        return HsImage.statistics_of_range(
+            pos_mask, self.pos_min.min(), self.pos_max.max()
+        )
+
+    def storage_error(self, source_dtype: np.dtype) -> float:
+        """Returns the bound of the absolute error of conversion from `source_dtype` and quantisation."""
+        error = self.max_error
+        if self.dtype != source_dtype:
+            error += AbstractFileLoader.rounding_error(self.max_abs, self.dtype)
+        return error
+
+
+class BlockWriter:
+    """Collects blocks read by a loader into the array of the whole image in the order of axes of the file.
+    Blocks are converted to the storage type and passed to `on_block`.
+    Floating point data stored as `uint16` is read twice, see `BlockQuantiser`.
+    """
+
+    def __init__(
+        self,
+        shape: tuple[int, ...],
+        source_dtype: np.dtype,
+        options: LoadOptions,
+        on_block: Optional[BlockCallback] = None,
+    ) -> None:
+        self.dtype = AbstractFileLoader.storage_dtype(source_dtype, options)
+        """Type blocks should be read in, `data` has this type unless it's quantised"""
+        self.quantiser: Optional[BlockQuantiser] = None
+        if options.storage == StorageType.UINT16 and source_dtype.kind == "f":
+            self.quantiser = BlockQuantiser(shape, self.dtype, options)
+            self.data = self.quantiser.data
+        else:
+            self.data = np.empty(shape, dtype=self.dtype)
+        self.on_block = on_block
+        self.measuring = False
+
+    def passes(self, progress: ProgressCallback) -> Iterator[ProgressCallback]:
+        """Yields progress callbacks of all passes over the file, each reports the whole pass like `read_parallel`."""
+        if self.quantiser is None:
+            yield progress
+            return
+
+        def pass_progress(i: int) -> ProgressCallback:
+            def report(fraction: float, stage: str):
+                progress((0.9 * i + fraction) / 2, f"Pass {i + 1} of 2: {stage}")
+
+            return report
+
+        self.measuring = True
+        yield pass_progress(0)
+        self.quantiser.finish_measuring()
+        self.measuring = False
+        yield pass_progress(1)
+
+    def target(self, index: tuple[slice, ...]) -> Optional[npt.NDArray]:
+        """Returns the part of `data` a block at `index` can be read into directly or `None` if it's quantised."""
+        if self.quantiser is not None:
+            return None
+        return self.data[index]
+
+    def write(self, values: npt.NDArray, index: tuple[slice, ...]) -> None:
+        """Stores values of a block at `index`, unless they were read into `target` already."""
+        if self.quantiser is None:
+            target = self.data[index]
+            if not np.may_share_memory(values, target):
+                target[...] = values
+        elif self.measuring:
+            self.quantiser.measure(values, index)
+        else:
+            self.quantiser.store(values, index)
+            # The preview was refined by the first pass
+            return
+        if self.on_block is not None:
+            self.on_block(values, index)
+
+    def fill(self, value: float) -> None:
+        """Sets all data to `value`, e.g. a fill value of parts missing in the file."""
+        if self.quantiser is None:
+            self.data[...] = value
+            return
+        # A single value of every band broadcast to the whole array
+        shape = [1] * self.data.ndim
+        shape[self.quantiser.b_axis] = self.data.shape[self.quantiser.b_axis]
+        index = tuple(slice(0, n) for n in self.data.shape)
+        if self.measuring:
+            self.quantiser.measure(np.full(shape, value, dtype=self.dtype), index)
+        else:
+            self.quantiser.store(np.full(shape, value, dtype=self.dtype), index)
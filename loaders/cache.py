@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from dataclasses import asdict
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+from numpy.lib.format import open_memmap
+from PyQt6.QtCore import QStandardPaths
+
+from lib import (
+    HsImage,
+    ImageStatistics,
+    LabelType,
+    NormalisationMethod,
+    Quantisation,
+)
+from loaders.abstract import LoadOptions, ProgressCallback
+from tracing import instant
+
+
+class ImageCache:
+    """Persistent cache of loaded images, so that reopening a file only maps it from disk.
+    The cube is stored band-contiguous together with statistics and labels.
+    Entries are keyed by source files (path, size and modification time) and load options,
+    least recently used entries are evicted when the cache grows over `max_bytes`.
+    """
+
+    VERSION = 2
+    """Changing the version invalidates all entries"""
+    MAX_BYTES = 8 << 30
+    WRITE_CHUNK_BYTES = 64 << 20
+
+    def __init__(
+        self, directory: Optional[str] = None, max_bytes: int = MAX_BYTES
+    ) -> None:
+        if directory is None:
+            directory = os.path.join(
+                QStandardPaths.writableLocation(
+                    QStandardPaths.StandardLocation.CacheLocation
+                ),
+                "images",
+            )
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, files: list[str], options: LoadOptions) -> str:
+        sources = []
+        for file in files:
+            stat = os.stat(file)
+            sources.append([os.path.abspath(file), stat.st_size, stat.st_mtime_ns])
+        # These options don't change the stored image
+        options_dict = asdict(options)
+        del options_dict["progressive"]
+        del options_dict["dual_layout"]
+        description = json.dumps(
+            [ImageCache.VERSION, sources, options_dict], default=str
+        )
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def load(self, files: list[str], options: LoadOptions) -> Optional[HsImage]:
+        """Returns the cached image memory mapped from disk or `None` if it's not cached."""
+        entry = os.path.join(self.directory, self.key(files, options))
+        meta_path = os.path.join(entry, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+
+        try:
+            with open(meta_path, encoding="utf-8") as meta_file:
+                meta = json.load(meta_file)
+            # Stored as [bands, height, width], transposed views keep the usual order
+            data = np.load(os.path.join(entry, "data.npy"), mmap_mode="r")
+            pos_mask = np.load(os.path.join(entry, "pos_mask.npy"), mmap_mode="r")
+            norm_min = norm_div = None
+            if meta["normalised"]:
+                with np.load(os.path.join(entry, "norm.npz")) as norm:
+                    # 0-d arrays are converted back to scalars used for global normalisation
+                    norm_min = norm["norm_min"][()]
+                    norm_div = norm["norm_div"][()]
+            quantisation = None
+            if meta["quantised"]:
+                with np.load(os.path.join(entry, "quantisation.npz")) as q:
+                    quantisation = Quantisation(q["scale"], q["offset"])
+            normalisation = meta["normalisation"]
+            image = HsImage(
+                data.transpose(1, 2, 0),
+                bpp=meta["bpp"],
+                normalisation=NormalisationMethod[normalisation]
+                if normalisation is not None
+                else None,
+                labels=meta["labels"],
+                labels_type=LabelType[meta["labels_type"]],
+                statistics=ImageStatistics(
+                    pos_mask.transpose(1, 2, 0), norm_min, norm_div
+                ),
+                dual_layout=options.dual_layout,
+                quantisation=quantisation,
+                storage_error=meta["storage_error"],
+            )
+        except (OSError, ValueError, KeyError) as err:
+            instant("cache_entry_invalid", entry=entry, error=repr(err))
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+
+        # Modification time of metadata marks the last use
+        os.utime(meta_path)
+        return image
+
+    def store(
+        self,
+        files: list[str],
+        options: LoadOptions,
+        image: HsImage,
+        progress: ProgressCallback,
+    ) -> None:
+        """Writes the image to the cache and evicts old entries. Images larger than the whole cache aren't stored."""
+        if image.data.nbytes + image.pos_mask.nbytes > self.max_bytes:
+            return
+
+        key = self.key(files, options)
+        entry = os.path.join(self.directory, key)
+        # Write to a temporary directory, so that a partially written entry is never used
+        tmp = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp)
+        try:
+            progress(0, "Saving to cache")
+            band_data = image.band_data
+            if band_data is None:
+                band_data = image.data.transpose(2, 0, 1)
+            ImageCache.write_band_major(
+                os.path.join(tmp, "data.npy"), band_data, progress
+            )
+            ImageCache.write_band_major(
+                os.path.join(tmp, "pos_mask.npy"),
+                image.pos_mask.transpose(2, 0, 1),
+                progress,
+            )
+            normalised = image.norm_min is not None and image.norm_div is not None
+            if normalised:
+                np.savez(
+                    os.path.join(tmp, "norm.npz"),
+                    norm_min=image.norm_min,
+                    norm_div=image.norm_div,
+                )
+            quantised = image.quantisation is not None
+            if image.quantisation is not None:
+                np.savez(
+                    os.path.join(tmp, "quantisation.npz"),
+                    scale=image.quantisation.scale,
+                    offset=image.quantisation.offset,
+                )
+            meta = {
+                "bpp": image.bpp,
+                "normalisation": image.normalisation.name
+                if image.normalisation is not None
+                else None,
+                "normalised": normalised,
+                "quantised": quantised,
+                "storage_error": image.storage_error,
+                "labels": image.labels,
+                "labels_type": image.labels_type.name,
+            }
+            with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(tmp, entry)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self.evict()
+
+    @staticmethod
+    def write_band_major(
+        path: str, band_data: npt.NDArray, progress: ProgressCallback
+    ) -> None:
+        """Writes data in [bands, height, width] order."""
+        b, h, w = band_data.shape
+        out = open_memmap(path, mode="w+", dtype=band_data.dtype, shape=(b, h, w))
+        # Copy blocks of rows of all bands, if data isn't band-major already
+        # transposing small blocks is much faster than gathering whole bands
+        rows = max(
+            1, ImageCache.WRITE_CHUNK_BYTES // max(1, b * w * band_data.itemsize)
+        )
+        for y in range(0, h, rows):
+            progress(y / h, "Saving to cache")
+            out[:, y : y + rows, :] = band_data[:, y : y + rows, :]
+        out.flush()
+        del out
+
+    def evict(self) -> None:
+        """Removes least recently used entries until the cache fits in `max_bytes`."""
+        entries: list[tuple[float, int, str]] = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            meta_path = os.path.join(entry, "meta.json")
+            if name.endswith(".tmp") or not os.path.exists(meta_path):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(entry, file)) for file in os.listdir(entry)
+            )
+            entries.append((os.path.getmtime(meta_path), size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            # Files of an image which is still open can't be removed on Windows, they are skipped
+            shutil.rmtree(entry, ignore_errors=True)
+            if not os.path.exists(entry):
+                total -= size
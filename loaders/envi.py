@@ -1,19 +1,35 @@
 import os
+import threading
+from math import ceil
 from string import whitespace
 from typing import Optional
 
+import numpy as np
 import numpy.typing as npt
-from osgeo import gdal
+from osgeo import gdal, gdal_array
 from PyQt6.QtWidgets import QWidget
 
 from lib import HsImage, LabelType
-from loaders.abstract import AbstractFileLoader
+from loaders.abstract import (
+    AbstractFileLoader,
+    BlockCallback,
+    FileHeader,
+    LoadOptions,
+    LoadPreview,
+    ProgressCallback,
+    Window,
+)
+from loaders.blocks import BlockWriter
+from loaders.parallel import READ_THREADS, read_parallel
 from utils import staticproperty
 
 gdal.UseExceptions()
 
 
 class ENVILoader(AbstractFileLoader):
+    READ_CHUNK_BYTES = 64 << 20
+    """Approximate size of a single read, small enough to report progress often"""
+
     @staticproperty
     def FILE_FILTER_NAME() -> str:
         return "ENVI .hdr labelled raster"
@@ -23,11 +39,77 @@ class ENVILoader(AbstractFileLoader):
         return ["hdr"]
 
     @staticmethod
-    def load_file(path: str, parent: QWidget) -> Optional[HsImage]:
+    def open_dataset(path: str) -> gdal.Dataset:
         path_no_ext, _ = os.path.splitext(path)
-        dataset: gdal.Dataset = gdal.Open(path_no_ext)
-        # set pixel interleaving, so that bands will be the third dimension
-        data: npt.NDArray = dataset.ReadAsArray(interleave="pixel")
+        return gdal.Open(path_no_ext)
+
+    @staticmethod
+    def source_files(path: str) -> list[str]:
+        # The header and the raw data file without an extension
+        path_no_ext, _ = os.path.splitext(path)
+        return [path, path_no_ext]
+
+    @staticmethod
+    def get_dtype(dataset: gdal.Dataset) -> np.dtype:
+        return np.dtype(
+            gdal_array.GDALTypeCodeToNumericTypeCode(dataset.GetRasterBand(1).DataType)
+        )
+
+    @staticmethod
+    def get_options(
+        path: str, parent: QWidget, subset: bool = False
+    ) -> Optional[LoadOptions]:
+        dataset = ENVILoader.open_dataset(path)
+        options = ENVILoader.get_type_options(
+            ENVILoader.get_dtype(dataset), parent, LoadOptions()
+        )
+        if options is None or not subset:
+            return options
+        labels, labels_type = ENVILoader.read_labels(dataset)
+        if labels is None:
+            labels = [str(b) for b in range(dataset.RasterCount)]
+        return ENVILoader.get_subset(
+            dataset.RasterXSize,
+            dataset.RasterYSize,
+            labels,
+            labels_type,
+            parent,
+            options,
+        )
+
+    @staticmethod
+    def read_header(path: str, options: LoadOptions) -> Optional[FileHeader]:
+        dataset = ENVILoader.open_dataset(path)
+        labels, labels_type = ENVILoader.read_labels(dataset)
+        return FileHeader(
+            ENVILoader.get_dtype(dataset), dataset.RasterCount, labels, labels_type
+        )
+
+    @staticmethod
+    def get_window(dataset: gdal.Dataset, options: LoadOptions) -> Window:
+        if options.window is not None:
+            return options.window
+        return 0, 0, dataset.RasterXSize, dataset.RasterYSize
+
+    @staticmethod
+    def get_bands(dataset: gdal.Dataset, options: LoadOptions) -> list[int]:
+        if options.bands is not None:
+            return options.bands
+        return list(range(dataset.RasterCount))
+
+    @staticmethod
+    def read_buffer(
+        target: Optional[npt.NDArray], shape: tuple[int, int, int], dtype: np.dtype
+    ) -> npt.NDArray:
+        """Returns `target` or a buffer of `shape` if there's no target or GDAL can't read into it (`float16`)."""
+        if target is None:
+            return np.empty(shape, dtype=dtype)
+        if target.dtype == np.float16:
+            return np.empty(shape, dtype=np.float32)
+        return target
+
+    @staticmethod
+    def read_labels(dataset: gdal.Dataset) -> tuple[Optional[list[str]], LabelType]:
         labels = None
         labels_type = LabelType.AUTO
         if "ENVI" in dataset.GetMetadataDomainList():
@@ -48,23 +130,124 @@ class ENVILoader(AbstractFileLoader):
                     for x in metadata["band_names"].split(",")
                 ]
                 labels_type = LabelType.CUSTOM_STR
+        return labels, labels_type
+
+    @staticmethod
+    def load_preview(path: str, options: LoadOptions) -> Optional[LoadPreview]:
+        dataset = ENVILoader.open_dataset(path)
+        labels, labels_type = ENVILoader.subset_labels(
+            *ENVILoader.read_labels(dataset), options
+        )
+        rgb, bands = ENVILoader.preview_bands(labels, labels_type)
+        x, y, w, h = ENVILoader.get_window(dataset, options)
+        file_bands = ENVILoader.get_bands(dataset, options)
+        factor = ENVILoader.preview_factor(w, h)
+        # Read every band only once, GDAL band numbers start at 1
+        unique_bands, inverse = np.unique(bands, return_inverse=True)
+        # GDAL decimates while reading, so only a fraction of the file is read for large images
+        data = np.stack(
+            [
+                dataset.GetRasterBand(file_bands[b] + 1).ReadAsArray(
+                    x,
+                    y,
+                    w,
+                    h,
+                    buf_xsize=ceil(w / factor),
+                    buf_ysize=ceil(h / factor),
+                    resample_alg=gdal.GRIORA_NearestNeighbour,
+                )
+                for b in unique_bands
+            ],
+            axis=-1,
+        )
+        preview_labels = [labels[b] for b in bands] if labels is not None else None
+        return ENVILoader.make_preview(
+            data[..., inverse], options, rgb, w, h, bands, preview_labels
+        )
+
+    @staticmethod
+    def load_file(
+        path: str,
+        options: LoadOptions,
+        progress: ProgressCallback,
+        on_block: Optional[BlockCallback] = None,
+    ) -> HsImage:
+        dataset = ENVILoader.open_dataset(path)
+        labels, labels_type = ENVILoader.subset_labels(
+            *ENVILoader.read_labels(dataset), options
+        )
+
+        # Only the selected window and bands are read
+        x, y0, w, h = ENVILoader.get_window(dataset, options)
+        bands = ENVILoader.get_bands(dataset, options)
+        b = len(bands)
+        source_dtype = ENVILoader.get_dtype(dataset)
+        # Data is converted to the storage type (or quantised) block by block
+        writer = BlockWriter((h, w, b), source_dtype, options, on_block)
+        dtype = writer.dtype
+
+        # GDAL datasets can't be shared between threads, every thread opens its own
+        local = threading.local()
+
+        def get_thread_dataset() -> gdal.Dataset:
+            if not hasattr(local, "dataset"):
+                local.dataset = ENVILoader.open_dataset(path)
+            return local.dataset
 
-        if data.dtype.kind == "f":
-            bpp = None
-            normalisation = ENVILoader.get_normalisation(parent)
-            if normalisation is None:
-                return
+        interleave = dataset.GetMetadataItem("INTERLEAVE", "IMAGE_STRUCTURE")
+        if interleave == "BAND":
+            # Bands are contiguous in BSQ files, read each one separately
+            def read_band(i: int) -> int:
+                index = (slice(0, h), slice(0, w), slice(i, i + 1))
+                buffer = ENVILoader.read_buffer(writer.target(index), (h, w, 1), dtype)
+                get_thread_dataset().GetRasterBand(bands[i] + 1).ReadAsArray(
+                    x, y0, w, h, buf_obj=buffer[:, :, 0]
+                )
+                writer.write(buffer, index)
+                return w * h * dtype.itemsize
+
+            for pass_progress in writer.passes(progress):
+                read_parallel(
+                    read_band, range(b), h * w * b * dtype.itemsize, pass_progress
+                )
         else:
-            bpp = ENVILoader.get_bpp(data, parent)
-            if bpp is None:
-                return
-            normalisation = None
-
-        image = HsImage(
-            data,
-            bpp=bpp,
-            normalisation=normalisation,
-            labels=labels,
-            labels_type=labels_type,
+            # Read blocks of rows, small enough to report progress often and keep all threads busy
+            row_bytes = w * b * dtype.itemsize
+            rows = max(1, ENVILoader.READ_CHUNK_BYTES // row_bytes)
+            rows = min(rows, max(1, ceil(h / (4 * READ_THREADS))))
+
+            def read_rows(y: int) -> int:
+                ysize = min(rows, h - y)
+                thread_dataset = get_thread_dataset()
+                index = (slice(y, y + ysize), slice(0, w), slice(0, b))
+                buffer = ENVILoader.read_buffer(
+                    writer.target(index), (ysize, w, b), dtype
+                )
+                if options.bands is None:
+                    # set pixel interleaving, so that bands will be the third dimension
+                    thread_dataset.ReadAsArray(
+                        x, y0 + y, w, ysize, buf_obj=buffer, interleave="pixel"
+                    )
+                else:
+                    # Rows are cached by GDAL, so reading bands one by one doesn't read the file again
+                    for i, band in enumerate(bands):
+                        thread_dataset.GetRasterBand(band + 1).ReadAsArray(
+                            x, y0 + y, w, ysize, buf_obj=buffer[:, :, i]
+                        )
+                writer.write(buffer, index)
+                return ysize * row_bytes
+
+            for pass_progress in writer.passes(progress):
+                read_parallel(
+                    read_rows, range(0, h, rows), h * row_bytes, pass_progress
+                )
+
+        return ENVILoader.make_image(
+            writer.data,
+            options,
+            progress,
+            labels,
+            labels_type,
+            source_dtype,
+            writer.quantiser,
         )
-        return image
@@ -1,44 +1,217 @@
 import os
 import traceback
-from typing import Optional, Type
+from typing import Any, Callable, Optional, Type
 
-from PyQt6.QtWidgets import QFileDialog, QMessageBox, QWidget
+import numpy as np
+import numpy.typing as npt
+from PyQt6.QtCore import Qt, QThread, pyqtSignal
+from PyQt6.QtWidgets import QFileDialog, QMessageBox, QProgressDialog, QWidget
 
 from lib import HsImage
-from loaders.abstract import AbstractFileLoader
-from loaders.envi import ENVILoader
-from loaders.matlab import MatlabLoader
+from loaders.abstract import (
+    AbstractFileLoader,
+    LoadingCancelled,
+    LoadOptions,
+    LoadPreview,
+    PreviewRefinement,
+)
+from loaders.cache import ImageCache
+from tracing import instant, span
+from utils import LazyFormat
+
+
+# Loaders depend on GDAL, h5py and scipy, which take a while to import
+def envi_loader() -> Type[AbstractFileLoader]:
+    from loaders.envi import ENVILoader
+
+    return ENVILoader
+
+
+def matlab_loader() -> Type[AbstractFileLoader]:
+    from loaders.matlab import MatlabLoader
+
+    return MatlabLoader
+
+
+class LoadingWorker(QThread):
+    """Loads a file in a separate thread. Signals are delivered in the thread owning the worker."""
+
+    progress = pyqtSignal(float, str)
+    preview = pyqtSignal(object)
+    refined = pyqtSignal(int, int, object)
+    """x, y and full resolution [height, width, 3] 8 bit pixels of a part of the preview, which has been read"""
+    loaded = pyqtSignal(object)
+    failed = pyqtSignal(str, str)
+    cancelled = pyqtSignal()
+
+    def __init__(
+        self,
+        file_loader: Type[AbstractFileLoader],
+        path: str,
+        options: LoadOptions,
+        cache: Optional[ImageCache] = None,
+        parent: Optional[QWidget] = None,
+    ) -> None:
+        super().__init__(parent)
+        self.file_loader = file_loader
+        self.path = path
+        self.options = options
+        self.cache = cache
+        self.cancel_requested = False
+        self.files: list[str] = []
+        """Source files of the image, set when loading starts"""
+        self.from_cache = False
+        """Whether the image has been loaded from the cache, so it doesn't need to be stored"""
+
+    def cancel(self):
+        self.cancel_requested = True
+
+    def report_progress(self, fraction: float, stage: str):
+        if self.cancel_requested:
+            raise LoadingCancelled()
+        self.progress.emit(fraction, stage)
+
+    def run(self):
+        try:
+            image = self.load_image()
+        except LoadingCancelled:
+            self.cancelled.emit()
+        except Exception as err:
+            self.failed.emit(str(err), traceback.format_exc())
+        else:
+            self.loaded.emit(image)
+
+    def load_image(self) -> HsImage:
+        with span("load_image", path=self.path):
+            self.files = self.file_loader.source_files(self.path)
+            if self.cache is not None:
+                self.report_progress(0, "Reading cache")
+                with span("cache_load"):
+                    image = self.cache.load(self.files, self.options)
+                if image is not None:
+                    self.from_cache = True
+                    return image
+
+            refinement: Optional[PreviewRefinement] = None
+            if self.options.progressive:
+                self.report_progress(0, "Loading preview")
+                with span("load_preview"):
+                    preview = self.file_loader.load_preview(self.path, self.options)
+                if preview is not None:
+                    self.preview.emit(preview)
+                    refinement = PreviewRefinement(preview, self.options.array_order)
+
+            def refine(data: npt.NDArray, index: tuple[slice, ...]):
+                assert refinement is not None
+                update = refinement.add_block(data, index)
+                if update is not None:
+                    self.refined.emit(*update)
+
+            with span("load_file"):
+                image = self.file_loader.load_file(
+                    self.path,
+                    self.options,
+                    self.report_progress,
+                    refine if refinement is not None else None,
+                )
+            return image
+
+
+class CachingWorker(QThread):
+    """Writes a loaded image to the cache in a separate thread, after it has been shown.
+    It isn't cancelled from the loading dialog, but when another file is opened or the application exits.
+    """
+
+    def __init__(
+        self,
+        cache: ImageCache,
+        files: list[str],
+        options: LoadOptions,
+        image: HsImage,
+    ) -> None:
+        # Without a parent the thread isn't destroyed with the window while it's writing
+        super().__init__()
+        self.cache = cache
+        self.files = files
+        self.options = options
+        self.image = image
+        self.cancel_requested = False
+
+    def cancel(self):
+        self.cancel_requested = True
+
+    def check_cancelled(self, fraction: float, stage: str):
+        if self.cancel_requested:
+            raise LoadingCancelled()
+
+    def run(self):
+        try:
+            with span("cache_store"):
+                self.cache.store(
+                    self.files, self.options, self.image, self.check_cancelled
+                )
+        except Exception as err:
+            # Cancelling (`LoadingCancelled`) or failing to cache the image only skips the cache,
+            # the partially written entry has been removed by `store`
+            instant("cache_store_failed", error=repr(err))
 
 
 class Loader:
-    loaders: list[Type[AbstractFileLoader]] = [ENVILoader, MatlabLoader]
+    loaders: list[LazyFormat[AbstractFileLoader]] = [
+        LazyFormat("ENVI .hdr labelled raster", ["hdr"], envi_loader),
+        LazyFormat("Matlab files", ["mat"], matlab_loader),
+    ]
+    worker: Optional[LoadingWorker] = None
+    caching_worker: Optional[CachingWorker] = None
 
     def __init__(self, parent: QWidget) -> None:
         self.parent = parent
-        self.extensions_map: dict[str, Type[AbstractFileLoader]] = {}
+        self.cache = ImageCache()
+        self.extensions_map: dict[str, LazyFormat[AbstractFileLoader]] = {}
         for loader in self.loaders:
-            for extension in loader.EXTENSIONS:
+            for extension in loader.extensions:
                 if extension in self.extensions_map:
                     raise Exception(
-                        f"Extension {extension} claimed by {loader} has been already registered by {self.extensions_map[extension].__name__}."
+                        f"Extension {extension} claimed by {loader.filter_name} has been already registered by {self.extensions_map[extension].filter_name}."
                     )
                 self.extensions_map[extension] = loader
 
-    def load_file(self, path: str) -> Optional[HsImage]:
+    def get_file_loader(self, path: str) -> Type[AbstractFileLoader]:
         # extension starts with a "."
         _, extension = os.path.splitext(path)
-        file_loader = self.extensions_map[extension[1:]]
-        return file_loader.load_file(path, self.parent)
+        return self.extensions_map[extension[1:]].get()
+
+    @staticmethod
+    def find_file_loader(path: str) -> Type[AbstractFileLoader]:
+        """Returns the loader for `path` without creating a `Loader`, e.g. outside of the GUI."""
+        _, extension = os.path.splitext(path)
+        for loader in Loader.loaders:
+            if extension[1:] in loader.extensions:
+                return loader.get()
+        raise ValueError(f"Files with extension {extension} are not supported.")
 
     def filters(self) -> list[str]:
         # prefix extensions with "*." and append them after the filter name
         return [
-            f"{loader.FILE_FILTER_NAME} ({' '.join(['*.' + ext for ext in loader.EXTENSIONS])})"
+            f"{loader.filter_name} ({' '.join(['*.' + ext for ext in loader.extensions])})"
             for loader in self.loaders
         ]
 
-    def open_file(self) -> Optional[HsImage]:
-        """Show an "Open file" dialog and load the selected file. Returns `None` on failure or when cancelled, `HsImage` otherwise."""
+    def open_file(
+        self,
+        on_loaded: Callable[[HsImage], Any],
+        on_preview: Optional[Callable[[LoadPreview], Any]] = None,
+        on_aborted: Optional[Callable[[], Any]] = None,
+        on_refined: Optional[Callable[[int, int, npt.NDArray[np.uint8]], Any]] = None,
+        subset: bool = False,
+    ) -> None:
+        """Show an "Open file" dialog, ask for loading options and load the selected file in the background.
+        If `subset` is set, the user also chooses bands and a window to load.
+        `on_loaded` is called with the image once loading succeeds.
+        If `on_preview` is provided, a quick look at the image is loaded first if the format supports it.
+        `on_refined` is then called with full resolution parts of the preview as they're read, see `LoadingWorker.refined`.
+        `on_aborted` is called when loading fails or is cancelled after it has started.
+        """
         file_filter = ";;".join(self.filters())
         file_path, used_filter = QFileDialog.getOpenFileName(
             self.parent, "Open image", "", file_filter
@@ -49,13 +222,102 @@ class Loader:
             return
 
         try:
-            return self.load_file(file_path)
+            file_loader = self.get_file_loader(file_path)
+            # Ask all questions before loading, so that the background job never waits for the user
+            options = file_loader.get_options(file_path, self.parent, subset)
         except Exception as err:
-            message_box = QMessageBox(self.parent)
-            message_box.setIcon(QMessageBox.Icon.Warning)
-            # Append the error message to text instead of using informative text to force width scaling
-            message_box.setText("Loading file failed\n\n" + str(err))
-            message_box.setDetailedText(traceback.format_exc())
-            message_box.exec()
-
-        return
+            self.show_error(str(err), traceback.format_exc())
+            return
+
+        if options is None:
+            return
+        options.progressive = on_preview is not None
+        # Writing the previous image would compete with reading the new one
+        self.stop_caching()
+
+        progress_dialog = QProgressDialog(
+            "Opening file", "Cancel", 0, 1000, self.parent
+        )
+        progress_dialog.setWindowTitle("Whaaale - open file")
+        progress_dialog.setWindowModality(Qt.WindowModality.WindowModal)
+        progress_dialog.setMinimumDuration(500)
+        progress_dialog.setAutoReset(False)
+        progress_dialog.setValue(0)
+
+        worker = LoadingWorker(file_loader, file_path, options, self.cache, self.parent)
+
+        def update_progress(fraction: float, stage: str):
+            progress_dialog.setLabelText(stage)
+            progress_dialog.setValue(int(fraction * 1000))
+
+        def cancel():
+            progress_dialog.setLabelText("Cancelling")
+            worker.cancel()
+
+        def loaded(image: HsImage):
+            progress_dialog.hide()
+            on_loaded(image)
+            if not worker.from_cache:
+                self.start_caching(worker.files, options, image)
+
+        def failed(message: str, details: str):
+            progress_dialog.hide()
+            self.show_error(message, details)
+            if on_aborted is not None:
+                on_aborted()
+
+        def finish():
+            # Closing the dialog emits `canceled`
+            progress_dialog.canceled.disconnect(cancel)
+            progress_dialog.close()
+            progress_dialog.deleteLater()
+            worker.deleteLater()
+            if self.worker is worker:
+                self.worker = None
+
+        worker.progress.connect(update_progress)
+        worker.loaded.connect(loaded)
+        worker.failed.connect(failed)
+        if on_preview is not None:
+            worker.preview.connect(on_preview)
+        if on_refined is not None:
+            worker.refined.connect(on_refined)
+        if on_aborted is not None:
+            worker.cancelled.connect(on_aborted)
+        worker.finished.connect(finish)
+        progress_dialog.canceled.connect(cancel)
+        self.worker = worker
+        worker.start()
+
+    def start_caching(
+        self, files: list[str], options: LoadOptions, image: HsImage
+    ) -> None:
+        """Stores a freshly loaded image in the cache in the background."""
+        caching_worker = CachingWorker(self.cache, files, options, image)
+
+        def finish():
+            caching_worker.deleteLater()
+            if self.caching_worker is caching_worker:
+                self.caching_worker = None
+
+        caching_worker.finished.connect(finish)
+        self.caching_worker = caching_worker
+        caching_worker.start()
+
+    def stop_caching(self) -> None:
+        """Cancels storing an image in the cache and waits until its partially written entry is removed.
+        It's checked after every written block, so it doesn't take long.
+        """
+        caching_worker = self.caching_worker
+        if caching_worker is None:
+            return
+        caching_worker.cancel()
+        caching_worker.wait()
+
+    def show_error(self, message: str, details: str):
+        message_box = QMessageBox(self.parent)
+        message_box.setIcon(QMessageBox.Icon.Warning)
+        # Append the error message to text instead of using informative text to force width scaling
+        message_box.setText("Loading file failed\n\n" + message)
+        message_box.setDetailedText(details)
+        message_box.exec()
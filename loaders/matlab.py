@@ -1,4 +1,6 @@
-from typing import Any, BinaryIO, Optional
+import zlib
+from math import ceil, prod
+from typing import Optional, TypeAlias
 
 import h5py
 import numpy as np
@@ -7,12 +9,33 @@ import scipy.io as sio
 from PyQt6.QtWidgets import QInputDialog, QWidget
 
 from lib import HsImage
-from loaders.abstract import AbstractFileLoader
+from loaders.abstract import (
+    AbstractFileLoader,
+    BlockCallback,
+    FileHeader,
+    LoadOptions,
+    LoadPreview,
+    ProgressCallback,
+)
+from loaders.blocks import BlockWriter
+from loaders.parallel import READ_THREADS, read_parallel
 from utils import staticproperty
 
+VarInfo = tuple[tuple[int, ...], Optional[np.dtype]]
+"""Shape and type of a variable. Type is `None` if it's not a numeric array."""
+
+AxisIndex: TypeAlias = slice | npt.NDArray[np.intp]
+"""Indexes along one axis: a slice with explicit start and stop or an ascending array"""
+
+Selection: TypeAlias = tuple[AxisIndex, AxisIndex, AxisIndex]
+"""Part of a 3D array, at most one axis is indexed with an array"""
+
 
 class MatlabLoader(AbstractFileLoader):
     DIALOG_TITLE = "Matlab file loader"
+    HDF5_HEADER = b"MATLAB 7.3 MAT-file"
+    READ_CHUNK_BYTES = 64 << 20
+    """Approximate size of a single read from HDF5 files, small enough to report progress often"""
 
     @staticproperty
     def FILE_FILTER_NAME() -> str:
@@ -23,90 +46,85 @@ class MatlabLoader(AbstractFileLoader):
         return ["mat"]
 
     @staticmethod
-    def load_hdf5(raw_file: BinaryIO, parent: QWidget) -> Optional[HsImage]:
-        data = h5py.File(raw_file)
-        names: list[str] = [
-            k for k, v in data.items() if (not k.startswith("#") and v.ndim == 3)
-        ]
-        var_name = MatlabLoader.check_vars(data, names, parent)
-        if var_name is None:
-            return
+    def is_hdf5(path: str) -> bool:
+        with open(path, "rb") as file:
+            header = file.read(len(MatlabLoader.HDF5_HEADER))
+        return header == MatlabLoader.HDF5_HEADER
 
-        # Extract data as NumPy array
-        # https://docs.h5py.org/en/stable/whatsnew/2.1.html#dataset-value-property-is-now-deprecated
-        var: npt.NDArray = data[var_name][()]
-        if var.dtype.kind != "i" and var.dtype.kind != "u" and var.dtype.kind != "f":
-            raise NotImplementedError(
-                f"Only integer and floating point types are supported, file uses {var.dtype.name}."
-            )
+    @staticmethod
+    def list_vars(path: str) -> dict[str, VarInfo]:
+        """Returns shapes and types of all 3D variables in the file without reading them."""
+        if MatlabLoader.is_hdf5(path):
+            with h5py.File(path) as data:
+                return {
+                    k: (v.shape, v.dtype)
+                    for k, v in data.items()
+                    if not k.startswith("#")
+                    and isinstance(v, h5py.Dataset)
+                    and v.ndim == 3
+                }
 
-        reordered = MatlabLoader.fix_array_order(var, parent)
-        if reordered is None:
-            return
-        else:
-            var = reordered
+        variables: dict[str, VarInfo] = {}
+        for name, shape, matlab_class in sio.whosmat(path):
+            if len(shape) != 3:
+                continue
+            if matlab_class == "double":
+                dtype = np.dtype(np.float64)
+            elif matlab_class == "single":
+                dtype = np.dtype(np.float32)
+            elif matlab_class.startswith("int") or matlab_class.startswith("uint"):
+                dtype = np.dtype(matlab_class)
+            else:
+                dtype = None
+            variables[name] = (shape, dtype)
+        return variables
 
-        if var.dtype.kind == "f":
-            bpp = None
-            normalisation = MatlabLoader.get_normalisation(parent)
-            if normalisation is None:
-                return
-        else:
-            bpp = MatlabLoader.get_bpp(var, parent)
-            if bpp is None:
-                return
-            normalisation = None
-
-        image = HsImage(var, bpp=bpp, normalisation=normalisation)
-        return image
-
-    @staticmethod
-    def load_scipy(file: BinaryIO, parent: QWidget) -> Optional[HsImage]:
-        data: dict[str, Any] = sio.loadmat(file)
-        names = [
-            k
-            for k, v in data.items()
-            if (not k.startswith("__")) and isinstance(v, np.ndarray) and v.ndim == 3
-        ]
-        var_name = MatlabLoader.check_vars(data, names, parent)
+    @staticmethod
+    def get_options(
+        path: str, parent: QWidget, subset: bool = False
+    ) -> Optional[LoadOptions]:
+        variables = MatlabLoader.list_vars(path)
+        var_name = MatlabLoader.check_vars(variables, parent)
         if var_name is None:
             return
 
-        var: npt.NDArray = data[var_name]
-        if var.dtype.kind != "i" and var.dtype.kind != "u" and var.dtype.kind != "f":
+        shape, dtype = variables[var_name]
+        if dtype is None:
             raise NotImplementedError(
-                f"Only integer and floating point types are supported, file uses {var.dtype.name}."
+                f"Only integer and floating point types are supported, {var_name} is not a numeric array."
             )
 
-        reordered = MatlabLoader.fix_array_order(var, parent)
-        if reordered is None:
+        array_order = MatlabLoader.fix_array_order(shape, parent)
+        if array_order is None:
             return
-        else:
-            var = reordered
 
-        if var.dtype.kind == "f":
-            bpp = None
-            normalisation = MatlabLoader.get_normalisation(parent)
-            if normalisation is None:
-                return
-        else:
-            bpp = MatlabLoader.get_bpp(var, parent)
-            if bpp is None:
-                return
-            normalisation = None
-
-        image = HsImage(var, bpp=bpp, normalisation=normalisation)
-        return image
+        options = LoadOptions(array_order=array_order, var_name=var_name)
+        options = MatlabLoader.get_type_options(dtype, parent, options)
+        if options is None or not subset:
+            return options
+        h_axis, w_axis, b_axis = array_order
+        labels = [str(b) for b in range(shape[b_axis])]
+        return MatlabLoader.get_subset(
+            shape[w_axis], shape[h_axis], labels, None, parent, options
+        )
 
     @staticmethod
     def check_vars(
-        data: dict[str, Any] | h5py.File, names: list[str], parent: QWidget
+        variables: dict[str, VarInfo], parent: Optional[QWidget]
     ) -> Optional[str]:
+        """Returns the name of the only 3D variable or asks the user to select one.
+        Raises `RuntimeError` if there are more variables and `parent` is `None`.
+        """
+        names = list(variables)
         n_names = len(names)
         if n_names == 0:
             raise RuntimeError("No 3D arrays found in the data file.")
         elif n_names > 1:
-            shapes: list[tuple[int, int, int]] = [data[name].shape for name in names]
+            if parent is None:
+                raise RuntimeError(
+                    f"More than one 3D array found in the data file ({', '.join(names)}), select one."
+                )
+            shapes = [variables[name][0] for name in names]
             var_name = MatlabLoader.select_var(parent, names, shapes)
         else:
             var_name = names[0]
@@ -115,7 +133,7 @@ class MatlabLoader(AbstractFileLoader):
 
     @staticmethod
     def select_var(
-        parent: QWidget, vars: list[str], shapes: list[tuple[int, int, int]]
+        parent: QWidget, vars: list[str], shapes: list[tuple[int, ...]]
     ) -> Optional[str]:
         assert len(vars) == len(shapes)
 
@@ -136,15 +154,289 @@ class MatlabLoader(AbstractFileLoader):
         return name
 
     @staticmethod
-    def load_file(path: str, parent: QWidget) -> Optional[HsImage]:
-        with open(path, "rb") as file:
-            header = file.read(19)
-            # "rewind" back to the beginning
-            file.seek(0)
+    def read_header(path: str, options: LoadOptions) -> Optional[FileHeader]:
+        variables = MatlabLoader.list_vars(path)
+        var_name = options.var_name or MatlabLoader.check_vars(variables, None)
+        if var_name not in variables:
+            # Loading reports the error
+            return None
+        shape, dtype = variables[var_name]
+        if dtype is None:
+            return None
+        # Matlab files have no labels
+        return FileHeader(dtype, shape[options.array_order[2]], None, None)
 
-            if header == b"MATLAB 7.3 MAT-file":
-                image = MatlabLoader.load_hdf5(file, parent)
-            else:
-                image = MatlabLoader.load_scipy(file, parent)
+    @staticmethod
+    def get_var_name(path: str, options: LoadOptions) -> str:
+        if options.var_name is not None:
+            return options.var_name
+        var_name = MatlabLoader.check_vars(MatlabLoader.list_vars(path), None)
+        assert var_name is not None
+        return var_name
+
+    @staticmethod
+    def get_selection(shape: tuple[int, ...], options: LoadOptions) -> Selection:
+        """Returns indexes of the window and bands selected in `options` along axes of the file."""
+        h_axis, w_axis, b_axis = options.array_order
+        selection: list[AxisIndex] = [slice(0, n) for n in shape]
+        if options.window is not None:
+            x, y, w, h = options.window
+            selection[h_axis] = slice(y, y + h)
+            selection[w_axis] = slice(x, x + w)
+        if options.bands is not None:
+            selection[b_axis] = np.array(options.bands, dtype=np.intp)
+        return selection[0], selection[1], selection[2]
+
+    @staticmethod
+    def axis_length(index: AxisIndex) -> int:
+        if isinstance(index, slice):
+            return index.stop - index.start
+        return len(index)
+
+    @staticmethod
+    def axis_block(index: AxisIndex, start: int, stop: int) -> AxisIndex:
+        """Returns indexes at positions [start, stop) of `index`."""
+        if isinstance(index, slice):
+            return slice(index.start + start, min(index.start + stop, index.stop))
+        return index[start:stop]
+
+    @staticmethod
+    def axis_intersection(
+        index: AxisIndex, start: int, length: int
+    ) -> Optional[tuple[slice, AxisIndex]]:
+        """Intersects `index` with a range of a chunk.
+        Returns positions in `index` and the matching indexes relative to the chunk or `None` if they don't intersect.
+        """
+        if isinstance(index, slice):
+            low = max(index.start, start)
+            high = min(index.stop, start + length)
+            if low >= high:
+                return None
+            return slice(low - index.start, high - index.start), slice(
+                low - start, high - start
+            )
+        # Indexes are ascending, so the matching ones are next to each other
+        low, high = np.searchsorted(index, (start, start + length))
+        if low >= high:
+            return None
+        return slice(low, high), index[low:high] - start
 
-        return image
+    @staticmethod
+    def load_preview(path: str, options: LoadOptions) -> Optional[LoadPreview]:
+        if not MatlabLoader.is_hdf5(path):
+            # SciPy can't read parts of variables
+            return None
+
+        var_name = MatlabLoader.get_var_name(path, options)
+        # There are no labels, so the first band is shown initially
+        rgb, bands = MatlabLoader.preview_bands(None, None)
+        unique_bands, inverse = np.unique(bands, return_inverse=True)
+        with h5py.File(path) as file:
+            dataset: h5py.Dataset = file[var_name]
+            selection = list(MatlabLoader.get_selection(dataset.shape, options))
+            # Axes of the file containing height, width and bands
+            h_axis, w_axis, b_axis = options.array_order
+            h = MatlabLoader.axis_length(selection[h_axis])
+            w = MatlabLoader.axis_length(selection[w_axis])
+            factor = MatlabLoader.preview_factor(w, h)
+            # Strided hyperslab of the selected bands
+            for axis in (h_axis, w_axis):
+                index = selection[axis]
+                assert isinstance(index, slice)
+                selection[axis] = slice(index.start, index.stop, factor)
+            b_index = selection[b_axis]
+            file_bands = (
+                unique_bands + b_index.start
+                if isinstance(b_index, slice)
+                else b_index[unique_bands]
+            )
+            selection[b_axis] = file_bands.tolist()
+            data = dataset[tuple(selection)]
+        data = np.take(data, inverse, axis=b_axis)
+        return MatlabLoader.make_preview(data, options, rgb, w, h, bands)
+
+    @staticmethod
+    def load_file(
+        path: str,
+        options: LoadOptions,
+        progress: ProgressCallback,
+        on_block: Optional[BlockCallback] = None,
+    ) -> HsImage:
+        var_name = MatlabLoader.get_var_name(path, options)
+
+        if MatlabLoader.is_hdf5(path):
+            with h5py.File(path) as file:
+                dataset: h5py.Dataset = file[var_name]
+                selection = MatlabLoader.get_selection(dataset.shape, options)
+                source_dtype = dataset.dtype
+                shape = tuple(MatlabLoader.axis_length(index) for index in selection)
+                # Data is converted to the storage type (or quantised) block by block
+                writer = BlockWriter(shape, source_dtype, options, on_block)
+                if writer.data.size > 0:
+                    for pass_progress in writer.passes(progress):
+                        MatlabLoader.read_dataset(
+                            path, dataset, selection, writer, pass_progress
+                        )
+                data = writer.data
+                quantiser = writer.quantiser
+        else:
+            # SciPy reads a variable at once, so progress can't be reported while reading
+            progress(0, "Reading data")
+            data = sio.loadmat(path, variable_names=[var_name])[var_name]
+            data = data[MatlabLoader.get_selection(data.shape, options)]
+            # Converted by make_image
+            source_dtype = None
+            quantiser = None
+
+        labels, labels_type = MatlabLoader.subset_labels(None, None, options)
+        return MatlabLoader.make_image(
+            data, options, progress, labels, labels_type, source_dtype, quantiser
+        )
+
+    @staticmethod
+    def read_dataset(
+        path: str,
+        dataset: h5py.Dataset,
+        selection: Selection,
+        writer: BlockWriter,
+        progress: ProgressCallback,
+    ) -> None:
+        """Reads the selected part of the dataset to `writer` choosing the fastest method supported by its layout."""
+        if dataset.chunks is None and dataset.id.get_offset() is not None:
+            MatlabLoader.read_contiguous(path, dataset, selection, writer, progress)
+        elif dataset.chunks is not None and MatlabLoader.can_decode(dataset):
+            MatlabLoader.read_chunks(dataset, selection, writer, progress)
+        else:
+            # Other filters can only be decoded by HDF5, which runs a single thread at a time
+            n = writer.data.shape[0]
+            # Read hyperslabs along the first axis, so that progress can be reported
+            step = max(
+                1,
+                MatlabLoader.READ_CHUNK_BYTES
+                // max(1, writer.data[0].size * writer.dtype.itemsize),
+            )
+            for i in range(0, n, step):
+                progress(0.9 * i / n, "Reading data")
+                block = MatlabLoader.axis_block(selection[0], i, i + step)
+                writer.write(
+                    dataset[(block,) + selection[1:]],
+                    (slice(i, i + step),) + (slice(None),) * 2,
+                )
+
+    @staticmethod
+    def read_contiguous(
+        path: str,
+        dataset: h5py.Dataset,
+        selection: Selection,
+        writer: BlockWriter,
+        progress: ProgressCallback,
+    ) -> None:
+        """Uncompressed contiguous data is stored in C order at a known offset, so it's mapped directly from the file.
+        Only pages containing the selection are read.
+        """
+        mapped = np.memmap(
+            path,
+            dtype=dataset.dtype,
+            mode="r",
+            offset=dataset.id.get_offset(),
+            shape=dataset.shape,
+        )
+        n = writer.data.shape[0]
+        slab_bytes = writer.data[0].size * writer.dtype.itemsize
+        step = max(1, MatlabLoader.READ_CHUNK_BYTES // max(1, slab_bytes))
+        step = min(step, max(1, ceil(n / (4 * READ_THREADS))))
+
+        def read_slab(start: int) -> int:
+            block = MatlabLoader.axis_block(selection[0], start, start + step)
+            values = mapped[(block,) + selection[1:]]
+            writer.write(values, (slice(start, start + step),) + (slice(None),) * 2)
+            return len(values) * slab_bytes
+
+        read_parallel(read_slab, range(0, n, step), n * slab_bytes, progress)
+
+    @staticmethod
+    def get_filters(dataset: h5py.Dataset) -> list[int]:
+        plist = dataset.id.get_create_plist()
+        return [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+
+    @staticmethod
+    def can_decode(dataset: h5py.Dataset) -> bool:
+        """Checks if all filters of the dataset are supported by `read_chunks`."""
+        # Reading chunk information requires HDF5 1.10.5+
+        if not hasattr(dataset.id, "get_chunk_info"):
+            return False
+        return all(
+            f in (h5py.h5z.FILTER_DEFLATE, h5py.h5z.FILTER_SHUFFLE)
+            for f in MatlabLoader.get_filters(dataset)
+        )
+
+    @staticmethod
+    def unshuffle(raw: bytes, itemsize: int) -> npt.NDArray[np.uint8]:
+        """Reverses the shuffle filter, which groups n-th bytes of all values together."""
+        shuffled = np.frombuffer(raw, np.uint8)
+        n = shuffled.size // itemsize
+        result = np.empty_like(shuffled)
+        # Strided copies of whole byte planes are much faster than transposing
+        for k in range(itemsize):
+            result[k : n * itemsize : itemsize] = shuffled[k * n : (k + 1) * n]
+        # Bytes which don't form a whole value are left in place
+        result[n * itemsize :] = shuffled[n * itemsize :]
+        return result
+
+    @staticmethod
+    def read_chunks(
+        dataset: h5py.Dataset,
+        selection: Selection,
+        writer: BlockWriter,
+        progress: ProgressCallback,
+    ) -> None:
+        """Reads raw chunks intersecting the selection and decodes them concurrently.
+        zlib releases the GIL, unlike HDF5 filters.
+        """
+        filters = MatlabLoader.get_filters(dataset)
+        chunk_shape = dataset.chunks
+        # Chunks are stored in the type of the file, data may use a more compact one
+        file_dtype = dataset.dtype
+        n_chunks = dataset.id.get_num_chunks()
+        if n_chunks < prod(ceil(s / c) for s, c in zip(dataset.shape, chunk_shape)):
+            # Chunks which were never written aren't stored
+            writer.fill(dataset.fillvalue)
+
+        # Positions in `data` and in the chunk for every chunk intersecting the selection
+        Task = tuple[tuple[int, ...], tuple[slice, ...], tuple[AxisIndex, ...]]
+        tasks: list[Task] = []
+        for index in range(n_chunks):
+            chunk_offset = dataset.id.get_chunk_info(index).chunk_offset
+            intersections = [
+                MatlabLoader.axis_intersection(axis_index, start, length)
+                for axis_index, start, length in zip(
+                    selection, chunk_offset, chunk_shape
+                )
+            ]
+            if all(i is not None for i in intersections):
+                destination, source = zip(*intersections)
+                tasks.append((chunk_offset, destination, source))
+
+        def read_chunk(task: Task) -> int:
+            chunk_offset, destination, source = task
+            filter_mask, raw = dataset.id.read_direct_chunk(chunk_offset)
+            # Filters are applied in order when writing, so decode in reverse.
+            # A set bit in the mask means that the filter was skipped for this chunk.
+            for i in reversed(range(len(filters))):
+                if filter_mask & (1 << i):
+                    continue
+                if filters[i] == h5py.h5z.FILTER_DEFLATE:
+                    raw = zlib.decompress(raw)
+                else:
+                    raw = MatlabLoader.unshuffle(raw, file_dtype.itemsize)
+            chunk = np.frombuffer(raw, dtype=file_dtype).reshape(chunk_shape)
+            # Edge chunks are stored whole, but the intersection is always inside the dataset
+            part = chunk[source]
+            writer.write(part, destination)
+            return part.size * writer.dtype.itemsize
+
+        total_bytes = sum(
+            prod(s.stop - s.start for s in destination) * writer.dtype.itemsize
+            for _, destination, _ in tasks
+        )
+        read_parallel(read_chunk, tasks, total_bytes, progress)
@@ -0,0 +1,49 @@
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import perf_counter
+from typing import Callable, Sequence, TypeVar
+
+from loaders.abstract import ProgressCallback
+from tracing import span, traced
+from utils import complete_all
+
+T = TypeVar("T")
+
+READ_THREADS = min(8, os.cpu_count() or 1)
+"""Number of concurrent reads, fast storage needs several requests in flight to reach full bandwidth"""
+
+
+def format_throughput(n_bytes: int, seconds: float) -> str:
+    return f"{n_bytes / max(seconds, 1e-9) / (1 << 20):.0f} MiB/s"
+
+
+def read_parallel(
+    read_block: Callable[[T], int],
+    blocks: Sequence[T],
+    total_bytes: int,
+    progress: ProgressCallback,
+    threads: int = READ_THREADS,
+) -> None:
+    """Calls `read_block` for every block in a thread pool, it must return the number of bytes read.
+    Blocks have to be written to disjoint parts of a preallocated array.
+    Progress (including throughput) is reported from the calling thread, so `LoadingCancelled` stops pending reads.
+    """
+    start = perf_counter()
+    done = 0
+    progress(0, "Reading data")
+    # Every block is a span on its reading thread, throughput of the whole read follows from the bytes and duration
+    read_block = traced("read_block")(read_block)
+    with span("read", threads=threads, bytes=total_bytes):
+        with ThreadPoolExecutor(threads) as executor:
+            futures = [executor.submit(read_block, block) for block in blocks]
+
+            def block_done(future: Future[int]):
+                nonlocal done
+                done += future.result()
+                throughput = format_throughput(done, perf_counter() - start)
+                progress(
+                    0.9 * done / max(1, total_bytes), f"Reading data, {throughput}"
+                )
+
+            # Blocks nobody will use aren't read, running ones finish before the executor exits
+            complete_all(futures, block_done)
@@ -0,0 +1,180 @@
+import functools
+import json
+import os
+import threading
+from collections import deque
+from time import perf_counter_ns
+from typing import Any, Callable, Optional, TypeVar
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+MAX_EVENTS = 1 << 18
+"""Maximum number of recorded events, the oldest ones are dropped first"""
+TRACE_ENV = "WHAAALE_TRACE"
+"""Environment variable with the path of a trace file written on exit, setting it enables tracing on start"""
+
+
+class Span:
+    """Measures time between entering and leaving a `with` block. Created by `Tracer.span`."""
+
+    __slots__ = ("tracer", "name", "args", "start", "children")
+
+    def __init__(self, tracer: "Tracer", name: str, args: dict[str, Any]) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = 0
+        self.children: list[tuple[str, int]] = []
+        """Names and durations (ns) of spans finished directly inside this one"""
+
+    def __enter__(self) -> "Span":
+        self.tracer._stack().append(self)
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        end = perf_counter_ns()
+        stack = self.tracer._stack()
+        stack.pop()
+        duration = end - self.start
+        self.tracer._record(self.name, "X", self.start, duration, self.args)
+        if stack:
+            stack[-1].children.append((self.name, duration))
+        elif threading.current_thread() is threading.main_thread():
+            on_frame = self.tracer.on_frame
+            if on_frame is not None:
+                on_frame(self, duration)
+
+
+class NoSpan:
+    """Does nothing, returned while tracing is disabled, so that spans cost only a function call."""
+
+    __slots__ = ()
+
+    def __enter__(self) -> "NoSpan":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+class Tracer:
+    """Records spans and events in memory and exports them in the Chrome trace format,
+    which can be opened in Perfetto (https://ui.perfetto.dev) or chrome://tracing.
+    """
+
+    def __init__(self, max_events: int = MAX_EVENTS) -> None:
+        self.enabled = False
+        self.events: deque[dict[str, Any]] = deque(maxlen=max_events)
+        self.on_frame: Optional[Callable[[Span, int], Any]] = None
+        """Called with every top level span of the main thread and its duration (ns), e.g. to show timings of the last frame"""
+        self._origin = perf_counter_ns()
+        self._local = threading.local()
+        self._thread_names: dict[int, str] = {}
+
+    def _stack(self) -> list[Span]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _record(
+        self, name: str, phase: str, start: int, duration: int, args: dict[str, Any]
+    ) -> None:
+        thread = threading.current_thread()
+        self._thread_names[thread.ident or 0] = thread.name
+        event = {
+            "name": name,
+            "ph": phase,
+            "ts": (start - self._origin) / 1000,
+            "pid": os.getpid(),
+            "tid": thread.ident,
+        }
+        if phase == "X":
+            event["dur"] = duration / 1000
+        elif phase == "i":
+            # Instant events are shown on their thread only
+            event["s"] = "t"
+        if args:
+            event["args"] = args
+        # Appending to a deque is atomic, so threads don't need a lock
+        self.events.append(event)
+
+    def span(self, name: str, **args: Any) -> Span | NoSpan:
+        """Returns a context manager measuring the duration of a `with` block. `args` are shown with the span."""
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name, args)
+
+    def instant(self, name: str, **args: Any) -> None:
+        """Records an event without duration, e.g. a click."""
+        if self.enabled:
+            self._record(name, "i", perf_counter_ns(), 0, args)
+
+    def complete(self, name: str, start: int, end: int, **args: Any) -> None:
+        """Records a span measured elsewhere with `perf_counter_ns`."""
+        if self.enabled:
+            self._record(name, "X", start, end - start, args)
+
+    def clear(self) -> None:
+        self.events.clear()
+
+    def export(self, path: str) -> None:
+        """Writes recorded events as a Chrome trace JSON file."""
+        pid = os.getpid()
+        metadata = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for tid, name in list(self._thread_names.items())
+        ]
+        with open(path, "w", encoding="utf-8") as trace_file:
+            json.dump(
+                {
+                    "traceEvents": metadata + list(self.events),
+                    "displayTimeUnit": "ms",
+                },
+                trace_file,
+            )
+
+
+tracer = Tracer()
+"""Tracer used by the whole application"""
+span = tracer.span
+instant = tracer.instant
+
+
+def traced(name: str) -> Callable[[F], F]:
+    """Decorator measuring every call of a function as a span called `name`."""
+
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with Span(tracer, name, {}):
+                return func(*args, **kwargs)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+def format_frame(frame: Span, duration: int) -> str:
+    """Describes timings of a top level span and spans directly inside it, e.g. for the status bar."""
+    # Spans repeated for every chunk are summed
+    totals: dict[str, int] = {}
+    for name, child in frame.children:
+        totals[name] = totals.get(name, 0) + child
+    parts = [f"{name} {total / 1e6:.1f} ms" for name, total in totals.items()]
+    text = f"{frame.name} {duration / 1e6:.1f} ms"
+    if parts:
+        text += ": " + ", ".join(parts)
+    return text
@@ -0,0 +1,110 @@
+import traceback
+from typing import Any, Callable, Optional
+
+from PyQt6.QtCore import Qt, QThread, pyqtSignal
+from PyQt6.QtWidgets import QMessageBox, QProgressDialog, QWidget
+
+from loaders.abstract import ProgressCallback
+
+
+class TaskCancelled(Exception):
+    """Raised from a progress callback to abort a background task."""
+
+    pass
+
+
+class TaskWorker(QThread):
+    """Runs a long computation in a separate thread. Signals are delivered in the thread owning the worker."""
+
+    progress = pyqtSignal(float, str)
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str, str)
+    cancelled = pyqtSignal()
+
+    def __init__(
+        self,
+        task: Callable[[ProgressCallback], Any],
+        parent: Optional[QWidget] = None,
+    ) -> None:
+        super().__init__(parent)
+        self.task = task
+        self.cancel_requested = False
+
+    def cancel(self):
+        self.cancel_requested = True
+
+    def report_progress(self, fraction: float, stage: str):
+        if self.cancel_requested:
+            raise TaskCancelled()
+        self.progress.emit(fraction, stage)
+
+    def run(self):
+        try:
+            result = self.task(self.report_progress)
+        except TaskCancelled:
+            self.cancelled.emit()
+        except Exception as err:
+            self.failed.emit(str(err), traceback.format_exc())
+        else:
+            self.done.emit(result)
+
+
+def run_in_background(
+    parent: QWidget,
+    title: str,
+    task: Callable[[ProgressCallback], Any],
+    on_done: Callable[[Any], Any],
+    on_aborted: Optional[Callable[[], Any]] = None,
+) -> TaskWorker:
+    """Runs `task` with a progress dialog, which allows cancelling it.
+    `task` is called in a worker thread with a progress callback, so it must not touch widgets.
+    `on_done` is called with its result, `on_aborted` when it fails (after showing the error) or is cancelled.
+    """
+    progress_dialog = QProgressDialog(title, "Cancel", 0, 1000, parent)
+    progress_dialog.setWindowTitle("Whaaale - " + title.lower())
+    progress_dialog.setWindowModality(Qt.WindowModality.WindowModal)
+    progress_dialog.setMinimumDuration(500)
+    progress_dialog.setAutoReset(False)
+    progress_dialog.setValue(0)
+
+    worker = TaskWorker(task, parent)
+
+    def update_progress(fraction: float, stage: str):
+        progress_dialog.setLabelText(stage)
+        progress_dialog.setValue(int(fraction * 1000))
+
+    def cancel():
+        progress_dialog.setLabelText("Cancelling")
+        worker.cancel()
+
+    def done(result: Any):
+        progress_dialog.hide()
+        on_done(result)
+
+    def failed(message: str, details: str):
+        progress_dialog.hide()
+        message_box = QMessageBox(parent)
+        message_box.setIcon(QMessageBox.Icon.Warning)
+        message_box.setWindowTitle("Whaaale - " + title.lower())
+        message_box.setText(f"{title} failed\n\n{message}")
+        message_box.setDetailedText(details)
+        message_box.exec()
+        if on_aborted is not None:
+            on_aborted()
+
+    def finish():
+        # Closing the dialog emits `canceled`
+        progress_dialog.canceled.disconnect(cancel)
+        progress_dialog.close()
+        progress_dialog.deleteLater()
+        worker.deleteLater()
+
+    worker.progress.connect(update_progress)
+    worker.done.connect(done)
+    worker.failed.connect(failed)
+    if on_aborted is not None:
+        worker.cancelled.connect(on_aborted)
+    worker.finished.connect(finish)
+    progress_dialog.canceled.connect(cancel)
+    worker.start()
+    return worker
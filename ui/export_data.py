@@ -0,0 +1,57 @@
+import csv
+from pathlib import Path
+
+from matplotlib.backend_tools import ToolBase
+from PyQt6.QtWidgets import QFileDialog
+
+from lib import LabelType
+from ui.spectral_viewer import AreaValues, PixelValues, SpectralViewer
+
+
+class ExportData(ToolBase):
+    """Export data as CSV button"""
+
+    default_keymap = ["C"]
+    description = "Export plot as CSV"
+    image = (
+        Path(__file__).parent.joinpath("../style/icons/export_csv").resolve().as_posix()
+    )
+
+    def __init__(self, *args, viewer: SpectralViewer, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.viewer = viewer
+
+    def trigger(self, *args, **kwargs) -> None:
+        plot_values = self.viewer.data
+        if plot_values is None or self.viewer.labels is None:
+            return
+
+        out_path, _filter = QFileDialog.getSaveFileName(
+            self.viewer, "Choose a filename to export to", "", "CSV files (*.csv *.txt)"
+        )
+        if not out_path:
+            return
+
+        if self.viewer.labels_type == LabelType.WAVELENGTH:
+            band_header = "Wavelength"
+        else:
+            band_header = "Band"
+        if self.viewer.labels_type == LabelType.CUSTOM_STR:
+            bands = self.viewer.labels
+        else:
+            bands = self.viewer.x_values
+
+        with open(out_path, "w", encoding="utf-8") as out_file:
+            writer = csv.writer(out_file, dialect="excel", lineterminator="\n")
+            match plot_values:
+                case PixelValues(values):
+                    writer.writerow([band_header, "Value"])
+                    for row in zip(bands, values):
+                        writer.writerow(row)
+
+                case AreaValues(avg, min, max, quartile_low, quartile_high):
+                    writer.writerow(
+                        [band_header, "Minimum", "25%", "Average", "75%", "Maximum"]
+                    )
+                    for row in zip(bands, min, quartile_low, avg, quartile_high, max):
+                        writer.writerow(row)
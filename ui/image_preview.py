@@ -2,9 +2,10 @@ from typing import Any, Callable, Optional
 
 import numpy as np
 import numpy.typing as npt
-from PyQt6.QtCore import QPoint, QRect, Qt
-from PyQt6.QtGui import QImage, QMouseEvent, QPixmap, QFont
+from PyQt6.QtCore import QPoint, QRect, Qt, QTimer
+from PyQt6.QtGui import QColor, QFont, QImage, QMouseEvent, QPainter, QPixmap
 from PyQt6.QtWidgets import (
+    QWIDGETSIZE_MAX,
     QGridLayout,
     QLabel,
     QRubberBand,
@@ -13,13 +14,23 @@ from PyQt6.QtWidgets import (
     QWidget,
 )
 
-from lib import Coordinates
+from lib import Coordinates, HsImage
+from tracing import span, traced
+
+
+def class_colors(n: int) -> list[QColor]:
+    """Returns `n` distinct colours, hues are spread by the golden ratio, so that consecutive classes differ."""
+    return [QColor.fromHsvF((i * 0.618033988749895) % 1, 0.85, 0.95) for i in range(n)]
 
 
 class ImagePreview(QWidget):
-    img_data: Optional[npt.NDArray[np.uint8 | np.float32]] = None
+    img_data: Optional[npt.NDArray[np.uint8]] = None
     handler_mouse_down: Optional[Callable[[Coordinates], Any]] = None
     handler_mouse_up: Optional[Callable[[Coordinates], Any]] = None
+    handler_hover: Optional[Callable[[Coordinates], Any]] = None
+    hover_position: Optional[Coordinates] = None
+    hover_reported: Optional[Coordinates] = None
+    base_pixmap: Optional[QPixmap] = None
 
     def __init__(
         self, parent: Optional[QWidget], flags: Qt.WindowType = Qt.WindowType.Widget
@@ -51,6 +62,14 @@ class ImagePreview(QWidget):
         self.rubber_band = QRubberBand(QRubberBand.Shape.Rectangle, self.label)
         self.rubber_band.setVisible(False)
 
+        self.overlays: dict[str, tuple[QImage, float]] = {}
+        """Overlay layers drawn over the base image in insertion order, `name -> (image, opacity)`"""
+
+        # Coalesces mouse moves, so that hover handler is called at most once per display refresh
+        self.hover_timer = QTimer(self)
+        self.hover_timer.setSingleShot(True)
+        self.hover_timer.timeout.connect(self._report_hover)
+
         self._setup_handlers()
 
     def _setup_handlers(self):
@@ -77,15 +96,32 @@ class ImagePreview(QWidget):
         event.accept()
 
     def _on_mouse_move(self, event: QMouseEvent):
+        if self.img_data is None:
+            event.accept()
+            return
+        pos = event.position()
+        x = int(pos.x())
+        y = int(pos.y())
+        x, y = self.clamp_xy(x, y)
         if self.rubber_band.isVisible():
-            pos = event.position()
-            x = int(pos.x())
-            y = int(pos.y())
-            x, y = self.clamp_xy(x, y)
             geometry = QRect.span(self.rubber_band_start, QPoint(x, y))
             self.rubber_band.setGeometry(geometry)
+        if self.handler_hover is not None:
+            # Only remember the latest position, it will be reported when the timer fires
+            self.hover_position = (x, y)
+            if not self.hover_timer.isActive():
+                self.hover_timer.start()
         event.accept()
 
+    def _report_hover(self):
+        if (
+            self.handler_hover is not None
+            and self.hover_position is not None
+            and self.hover_position != self.hover_reported
+        ):
+            self.hover_reported = self.hover_position
+            self.handler_hover(self.hover_position)
+
     def register_handlers(
         self,
         on_mouse_down: Callable[[Coordinates], Any],
@@ -94,6 +130,24 @@ class ImagePreview(QWidget):
         self.handler_mouse_down = on_mouse_down
         self.handler_mouse_up = on_mouse_up
 
+    def set_hover_handler(self, on_hover: Optional[Callable[[Coordinates], Any]]):
+        """Enables reporting the pixel under the cursor to `on_hover` or disables it if `None`.
+        Mouse moves are coalesced to the display refresh rate.
+        """
+        self.handler_hover = on_hover
+        self.hover_position = None
+        self.hover_reported = None
+        self.label.setMouseTracking(on_hover is not None)
+        if on_hover is None:
+            self.hover_timer.stop()
+            return
+
+        screen = self.screen()
+        refresh_rate = screen.refreshRate() if screen is not None else 0
+        if refresh_rate <= 0:
+            refresh_rate = 60
+        self.hover_timer.setInterval(max(1, int(1000 / refresh_rate)))
+
     def draw_rubber_band(self, start: Coordinates):
         self.rubber_band_start = QPoint(*start)
         self.rubber_band.move(self.rubber_band_start)
@@ -103,6 +157,7 @@ class ImagePreview(QWidget):
     def clear_rubber_band(self):
         self.rubber_band.setVisible(False)
 
+    @traced("render_rgb")
     def render_rgb(self, rgb_bands: npt.NDArray[np.uint8]):
         self.img_data = rgb_bands.copy()
         h, w, _ = self.img_data.shape
@@ -115,21 +170,11 @@ class ImagePreview(QWidget):
         )
         self._show_image()
 
+    @traced("render_rgb_f")
     def render_rgb_f(self, rgb_bands: npt.NDArray[np.floating]):
-        img_data = rgb_bands.astype(np.float32)
-        h, w, _ = img_data.shape
-        self.img_data = np.append(
-            img_data, np.ones((h, w, 1), dtype=np.float32), axis=2
-        ).copy()
-        self.image = QImage(
-            self.img_data.data,
-            w,
-            h,
-            self.img_data.strides[0],
-            QImage.Format.Format_RGBX32FPx4,
-        )
-        self._show_image()
+        self.render_rgb(HsImage.normalised_as_8bpp(rgb_bands))
 
+    @traced("render_single")
     def render_single(self, band: npt.NDArray[np.uint8]):
         self.img_data = band.copy()
         h, w = self.img_data.shape
@@ -142,34 +187,137 @@ class ImagePreview(QWidget):
         )
         self._show_image()
 
+    @traced("render_single_f")
     def render_single_f(self, band: npt.NDArray[np.floating]):
-        self.render_single((band * 255).astype(np.uint8))
+        self.render_single(HsImage.normalised_as_8bpp(band))
 
-    def render_similar(self, band: npt.NDArray[np.uint8], mask: npt.NDArray[np.bool8]):
-        band_3D = np.broadcast_to(band[..., None], band.shape + (3,)).copy()
-        band_3D[mask] = np.array([255, 0, 0])
-        self.img_data = band_3D
-        self.image = QImage(
-            self.img_data.data,
-            self.img_data.shape[1],
-            self.img_data.shape[0],
-            self.img_data.strides[0],
-            QImage.Format.Format_RGB888,
-        )
-        self._show_image()
+    @traced("set_overlay")
+    def set_overlay(
+        self,
+        name: str,
+        mask: npt.NDArray[np.bool_],
+        color: QColor = QColor(255, 0, 0),
+        opacity: float = 1.0,
+    ):
+        """Sets overlay layer `name` painting `color` over pixels where `mask` is `True`.
+        The layer is cached, so changing the base image does not rebuild it.
+        """
+        h, w = mask.shape
+        # Pack the mask into a 1 bit per pixel image padded to 32-bit scanlines, as Qt expects
+        packed = np.packbits(mask, axis=1)
+        stride = (packed.shape[1] + 3) // 4 * 4
+        mask_bits = np.zeros((h, stride), dtype=np.uint8)
+        mask_bits[:, : packed.shape[1]] = packed
+        mono = QImage(mask_bits.data, w, h, stride, QImage.Format.Format_Mono)
+        mono.setColorTable([QColor(0, 0, 0, 0).rgba(), color.rgba()])
+        # Convert once, premultiplied ARGB is the fastest format for the painter.
+        # Conversion makes a deep copy, so `mask_bits` may be freed afterwards.
+        overlay = mono.convertToFormat(QImage.Format.Format_ARGB32_Premultiplied)
+        self.overlays[name] = (overlay, opacity)
+        self._compose()
 
-    def render_similar_f(
-        self, band: npt.NDArray[np.floating], mask: npt.NDArray[np.bool8]
+    @traced("set_class_overlay")
+    def set_class_overlay(
+        self,
+        name: str,
+        classes: npt.NDArray[np.uint8],
+        colors: list[QColor],
+        opacity: float = 0.5,
     ):
-        self.render_similar((band * 255).astype(np.uint8), mask)
+        """Sets overlay layer `name` painting pixels of class `i` with `colors[i]`.
+        Pixels of classes without a colour are transparent.
+        """
+        h, w = classes.shape
+        # 8 bits per pixel padded to 32-bit scanlines, as Qt expects
+        stride = (w + 3) // 4 * 4
+        indexes = np.zeros((h, stride), dtype=np.uint8)
+        indexes[:, :w] = classes
+        indexed = QImage(indexes.data, w, h, stride, QImage.Format.Format_Indexed8)
+        transparent = QColor(0, 0, 0, 0).rgba()
+        color_table = [color.rgba() for color in colors[:256]]
+        indexed.setColorTable(color_table + [transparent] * (256 - len(color_table)))
+        overlay = indexed.convertToFormat(QImage.Format.Format_ARGB32_Premultiplied)
+        self.overlays[name] = (overlay, opacity)
+        self._compose()
+
+    def set_overlay_opacity(self, name: str, opacity: float):
+        overlay, _ = self.overlays[name]
+        self.overlays[name] = (overlay, opacity)
+        self._compose()
+
+    def clear_overlay(self, name: str):
+        if self.overlays.pop(name, None) is not None:
+            self._compose()
+
+    def clear_overlays(self):
+        if self.overlays:
+            self.overlays.clear()
+            self._compose()
 
     def _show_image(self):
         height = self.image.height()
         width = self.image.width()
-        self.pixmap = QPixmap.fromImage(self.image)
-        self.label.setPixmap(self.pixmap)
+        with span("pixmap"):
+            self.base_pixmap = QPixmap.fromImage(self.image)
+        self._compose()
+        self.label.setScaledContents(False)
         self.label.setFixedSize(width, height)
 
+    def scale_to(self, width: int, height: int):
+        """Stretches the currently shown image to `width` and `height`, e.g. to show a decimated preview in place."""
+        self.label.setScaledContents(True)
+        self.label.setFixedSize(width, height)
+
+    @traced("refine")
+    def refine(self, x: int, y: int, pixels: npt.NDArray[np.uint8]):
+        """Paints full resolution [height, width, 3] `pixels` at `x`, `y` over the image stretched by `scale_to`."""
+        if self.base_pixmap is None:
+            return
+        if self.label.hasScaledContents():
+            # The stretched image becomes the base, so that parts which haven't been read yet stay visible
+            self.base_pixmap = self.base_pixmap.scaled(self.label.size())
+            self.label.setScaledContents(False)
+        h, w, _ = pixels.shape
+        image = QImage(
+            pixels.data, w, h, pixels.strides[0], QImage.Format.Format_RGB888
+        )
+        # The label shares the pixmap, painting over it while shared would copy the whole pixmap
+        self.label.setPixmap(QPixmap())
+        painter = QPainter(self.base_pixmap)
+        painter.drawImage(x, y, image)
+        painter.end()
+        self._compose()
+
+    def clear(self):
+        self.img_data = None
+        self.base_pixmap = None
+        self.overlays.clear()
+        self.label.clear()
+        self.label.setScaledContents(False)
+        self.label.setText("Open an image to display preview.")
+        self.label.setMinimumSize(0, 0)
+        self.label.setMaximumSize(QWIDGETSIZE_MAX, QWIDGETSIZE_MAX)
+        self.label.resize(self.scroll_area.viewport().size())
+
+    @traced("compose")
+    def _compose(self):
+        """Paints cached overlays over the cached base image."""
+        if self.base_pixmap is None:
+            return
+        if not self.overlays:
+            self.pixmap = self.base_pixmap
+        else:
+            self.pixmap = self.base_pixmap.copy()
+            painter = QPainter(self.pixmap)
+            for overlay, opacity in self.overlays.values():
+                if overlay.size() != self.pixmap.size():
+                    # Stale overlay from a previous image
+                    continue
+                painter.setOpacity(opacity)
+                painter.drawImage(0, 0, overlay)
+            painter.end()
+        self.label.setPixmap(self.pixmap)
+
     def clamp_xy(self, x: int, y: int):
         assert self.img_data is not None
         x = max(0, min(self.img_data.shape[1] - 1, x))
@@ -1,34 +1,25 @@
-import csv
 from dataclasses import dataclass
+from enum import Enum
 from math import ceil
-from pathlib import Path
-from typing import Literal, Optional
-from matplotlib.cbook import _exception_printer
+from typing import TYPE_CHECKING, Any, Literal, Optional
 
-import matplotlib.backend_tools
-import matplotlib.colors
-import matplotlib.style
 import numpy as np
-from matplotlib.axes import Axes
-from matplotlib.backend_managers import ToolManager
-from matplotlib.backend_tools import ToolBase
-from matplotlib.backends.backend_qt import ToolbarQt
-from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
+import numpy.typing as npt
 from numpy.typing import NDArray
 from PyQt6.QtCore import Qt
-from PyQt6.QtGui import QAction, QFont
-from PyQt6.QtWidgets import (
-    QFileDialog,
-    QGridLayout,
-    QLabel,
-    QSizePolicy,
-    QToolButton,
-    QWidget,
-    QWidgetAction,
-)
+from PyQt6.QtGui import QFont
+from PyQt6.QtWidgets import QGridLayout, QLabel, QSizePolicy, QWidget
 
 from lib import LabelType, ScalarType
+from tracing import span, traced
+
+# matplotlib takes most of the startup time, it's imported when the first spectrum is shown
+if TYPE_CHECKING:
+    from matplotlib.artist import Artist
+    from matplotlib.axes import Axes
+    from matplotlib.backend_bases import DrawEvent
+    from matplotlib.image import AxesImage
+    from matplotlib.lines import Line2D
 
 
 @dataclass
@@ -43,10 +34,78 @@ class AreaValues:
     max: NDArray[np.float64]
     quartile_low: NDArray[np.float64]
     quartile_high: NDArray[np.float64]
+    density: Optional[NDArray[np.int64]] = None
+    """Histogram of values in each band, `[value bin, band]`, bins span [min(min), max(max)]"""
+    samples: Optional[NDArray] = None
+    """Randomly selected spectra, `[sample, band]`"""
+
+
+class AreaPlotMode(Enum):
+    """Defines what is shown behind the summary curves of an area."""
+
+    SUMMARY = 0
+    """Only the summary curves"""
+    DENSITY = 1
+    """Heatmap of values of all pixels in each band"""
+    SAMPLES = 2
+    """Randomly selected spectra of individual pixels"""
+
+
+DENSITY_BINS = 256
+"""Number of value bins of the spectral density"""
+DENSITY_CHUNK_PIXELS = 1 << 16
+"""Approximate number of pixels processed at once when computing spectral density"""
+SAMPLE_SPECTRA = 500
+"""Maximum number of spectra drawn in `AreaPlotMode.SAMPLES`"""
+
+
+def spectral_density(
+    area: NDArray[ScalarType], v_min: float, v_max: float, bins: int = DENSITY_BINS
+) -> NDArray[np.int64]:
+    """Returns a 2D histogram of values against bands of all pixels in `area`, `[value bin, band]`.
+    Rows of `area` are processed in chunks, so memory use does not depend on the area size.
+    """
+    h, w, b = area.shape
+    counts = np.zeros(bins * b, dtype=np.int64)
+    scale = bins / (v_max - v_min) if v_max > v_min else 0.0
+    # Offsets of bands in the flattened histogram
+    band_offsets = np.arange(b, dtype=np.intp)
+    rows = max(1, DENSITY_CHUNK_PIXELS // w)
+    for y in range(0, h, rows):
+        chunk = area[y : y + rows].reshape((-1, b))
+        idx = ((chunk - v_min) * scale).astype(np.intp)
+        np.clip(idx, 0, bins - 1, out=idx)
+        idx *= b
+        idx += band_offsets
+        counts += np.bincount(idx.ravel(), minlength=bins * b)
+    return counts.reshape((bins, b))
+
+
+def sample_spectra(
+    area: NDArray[ScalarType], n: int = SAMPLE_SPECTRA, seed: Optional[int] = None
+) -> NDArray[ScalarType]:
+    """Returns up to `n` randomly selected spectra from `area`, `[sample, band]`."""
+    h, w, _ = area.shape
+    rng = np.random.default_rng(seed)
+    idx = rng.choice(h * w, size=min(n, h * w), replace=False)
+    ys, xs = np.divmod(idx, w)
+    return area[ys, xs]
 
 
 class SpectralViewer(QWidget):
+    """Spectral curve plot. The figure, axes and lines are created with the first spectrum and updated in place."""
+
+    CSV_TOOL_NAME = "CSV"
     data: Optional[PixelValues | AreaValues] = None
+    labels: Optional[list[str]] = None
+    labels_type = LabelType.AUTO
+    spectrum_bg: Optional["AxesImage"] = None
+    area: Optional[NDArray] = None
+    area_mode = AreaPlotMode.SUMMARY
+    area_artist: Optional["Artist"] = None
+    """Density image or sampled spectra shown behind area curves"""
+    blit_background: Optional[Any] = None
+    """Canvas region without animated lines, captured after each full draw"""
 
     def __init__(
         self,
@@ -54,11 +113,9 @@ class SpectralViewer(QWidget):
         flags: Qt.WindowType = Qt.WindowType.Widget,
     ) -> None:
         super().__init__(parent, flags)
-
-        # Force Qt backend, new toolbar and set style
-        matplotlib.use("qtagg")
-        matplotlib.rcParams["toolbar"] = "toolmanager"
-        matplotlib.style.use("style/dark_plot.mplstyle")
+        self.figure_ready = False
+        self.lines: list["Line2D"] = []
+        self.x_values: NDArray = np.arange(0)
 
         status_label = QLabel(
             "Open an image and select a pixel or an area to show the spectral curve.",
@@ -76,42 +133,28 @@ class SpectralViewer(QWidget):
         font.setBold(True)
         status_label.setFont(font)
 
-        self.new_figure()
-
         grid_layout = QGridLayout()
         grid_layout.addWidget(status_label)
         self.setLayout(grid_layout)
         self.grid_layout = grid_layout
 
-    def new_figure(self):
-        if hasattr(self, "fig"):
-            self.fig.clear()
-            self.grid_layout.removeWidget(self.canvas)
-            self.grid_layout.removeWidget(self.toolbar)
-            self.toolbar.setParent(None)
-            self.canvas.setParent(None)
-            self.toolbar.destroy()
-            self.canvas.destroy()
-            if "CSV" in self.toolmanager.tools:
-                self.toolmanager.remove_tool("CSV")
-                # ToolManager.remove_tool triggers an action which removes the item from the toolbar,
-                # but remove_toolitem leaves the action in group and keeps itself as its parent
-                # This workaround may break when remove_toolitem gets fixed.
-                # self.toolbar.actions() can be used instead of the group, but may potentially find another action with no default widget
-                actions: list[QAction] = self.toolbar._groups["io"]
-                action: QWidgetAction = [
-                    a
-                    for a in actions
-                    if isinstance(a, QWidgetAction)
-                    and (
-                        a.defaultWidget() is None
-                        or isinstance(a.defaultWidget(), QToolButton)
-                        and a.defaultWidget().text() == "CSV"
-                    )
-                ][0]
-                self.toolbar._groups["io"].remove(action)
-                self.toolbar.removeAction(action)
-                action.setParent(None)
+    @traced("setup_figure")
+    def setup_figure(self):
+        import matplotlib
+        import matplotlib.backend_tools
+        import matplotlib.style
+        from matplotlib.backend_managers import ToolManager
+        from matplotlib.backends.backend_qt import ToolbarQt
+        from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
+        from matplotlib.cbook import _exception_printer
+        from matplotlib.figure import Figure
+
+        from ui.export_data import ExportData
+
+        # Force Qt backend, new toolbar and set style
+        matplotlib.use("qtagg")
+        matplotlib.rcParams["toolbar"] = "toolmanager"
+        matplotlib.style.use("style/dark_plot.mplstyle")
 
         self.fig = Figure(tight_layout=True)
         self.canvas = FigureCanvas(self.fig)
@@ -136,37 +179,143 @@ class SpectralViewer(QWidget):
             self.toolmanager.remove_tool(tool)
         self.toolmanager._callbacks.exception_handler = _exception_printer
 
+        # The tool reads current values from the viewer, so it is registered only once
+        self.toolmanager.add_tool(self.CSV_TOOL_NAME, ExportData, viewer=self)
+        self.toolbar.add_tool(self.CSV_TOOL_NAME, "io", 1)
+
+        self.ax: "Axes" = self.fig.subplots()
+        # Full draws happen when Qt repaints the canvas, trace them where they're called
+        self.canvas.draw = traced("plot_draw")(self.canvas.draw)
+        self.canvas.mpl_connect("draw_event", self._on_draw)
+        self.figure_ready = True
+        if self.labels is not None:
+            self.setup_axes()
+
     def update_labels(self, labels: list[str], labels_type: LabelType):
         self.labels = labels
         self.labels_type = labels_type
 
+        bands = len(labels)
+        match labels_type:
+            case LabelType.CUSTOM_STR:
+                self.x_values = np.arange(bands)
+            case LabelType.WAVELENGTH:
+                self.x_values = np.array(labels, dtype=np.float64)
+            case LabelType.AUTO:
+                self.x_values = np.array(labels, dtype=np.int64)
+
+        if self.figure_ready:
+            self.setup_axes()
+
+    def setup_axes(self):
+        """Resets the axes for the current labels."""
+        if self.labels is None:
+            raise RuntimeError("Labels have not been provided")
+
+        # Labels change only with a new image, so it's fine to reset the whole axes
+        self.ax.cla()
+        self.lines = []
+        self.spectrum_bg = None
+        self.area_artist = None
+        self.blit_background = None
+
+        match self.labels_type:
+            case LabelType.CUSTOM_STR:
+                bands = len(self.labels)
+                self.ax.set_xticks(
+                    np.arange(bands),
+                    labels=self.labels,
+                    rotation=90,
+                    fontsize="x-small",
+                )
+                size = self.fig.get_size_inches() * self.fig.dpi
+                w = size[0]
+                step = ceil(bands / w * 12)
+                for i, label in enumerate(self.ax.xaxis.get_ticklabels()):
+                    if (i % step) != 0:
+                        label.set_visible(False)
+                self.ax.set_xlabel("Band")
+
+            case LabelType.WAVELENGTH:
+                self.ax.set_xlabel("Wavelength [nm]")
+
+            case LabelType.AUTO:
+                self.ax.set_xlabel("Band")
+
     def from_pixel(self, pixel: NDArray):
         self.data = PixelValues(pixel)
         self.render()
 
+    @traced("plot_pixel")
+    def update_pixel(self, pixel: NDArray):
+        """Shows values of a pixel updating the current plot in place if possible.
+        Intended for high frequency updates, e.g. when hovering over the image.
+        The value axis only grows, so that most updates can be blitted.
+        """
+        if not isinstance(self.data, PixelValues) or len(self.lines) != 1:
+            self.from_pixel(pixel)
+            return
+
+        self.data = PixelValues(pixel)
+        line = self.lines[0]
+        line.set_ydata(pixel)
+
+        v_min, v_max = self.value_range(self.data)
+        y_min, y_max = self.ax.get_ylim()
+        if self.blit_background is None or v_min < y_min or v_max > y_max:
+            # Limits (and ticks) change, so the whole figure has to be redrawn
+            self.set_value_range(min(v_min, y_min), max(v_max, y_max))
+            self.canvas.draw_idle()
+        else:
+            self.canvas.restore_region(self.blit_background)
+            self.ax.draw_artist(line)
+            self.canvas.blit(self.ax.bbox)
+
     def from_area(self, area: NDArray[ScalarType]):
-        h, w, b = area.shape
-        a_lin = area.reshape((h * w, b))
-        avg = np.mean(a_lin, axis=0)
-        q: np.ndarray[tuple[Literal[4], int], np.dtype[np.float64]] = np.quantile(
-            a_lin, [0, 0.25, 0.75, 1], axis=0
-        )
-        v_min, q_low, q_high, v_max = q
-        values = AreaValues(
-            avg=avg, min=v_min, max=v_max, quartile_low=q_low, quartile_high=q_high
-        )
+        with span("area_statistics", mode=self.area_mode.name):
+            h, w, b = area.shape
+            # Band-major copy, so that quantiles partition contiguous memory
+            a_lin = np.ascontiguousarray(area.reshape((h * w, b)).T)
+            avg = np.mean(a_lin, axis=1)
+            q: np.ndarray[tuple[Literal[4], int], np.dtype[np.float64]] = np.quantile(
+                a_lin, [0, 0.25, 0.75, 1], axis=1
+            )
+            v_min, q_low, q_high, v_max = q
+            values = AreaValues(
+                avg=avg, min=v_min, max=v_max, quartile_low=q_low, quartile_high=q_high
+            )
+            match self.area_mode:
+                case AreaPlotMode.DENSITY:
+                    values.density = spectral_density(
+                        area, np.min(v_min), np.max(v_max)
+                    )
+                case AreaPlotMode.SAMPLES:
+                    values.samples = sample_spectra(area)
+        self.area = area
         self.data = values
         self.render()
 
+    def set_area_mode(self, mode: AreaPlotMode):
+        self.area_mode = mode
+        if isinstance(self.data, AreaValues) and self.area is not None:
+            self.from_area(self.area)
+
     def clear(self):
         self.data = None
-
-        if not self.status_label.isVisible():
+        self.area = None
+        if self.area_artist is not None:
+            self.area_artist.remove()
+            self.area_artist = None
+        for line in self.lines:
+            line.remove()
+        self.lines = []
+        self.blit_background = None
+
+        if self.figure_ready and not self.status_label.isVisible():
             self.grid_layout.removeWidget(self.canvas)
             self.grid_layout.removeWidget(self.toolbar)
             self.canvas.setVisible(False)
             self.toolbar.setVisible(False)
-            self.fig.clear()
 
         self.status_label.setText(
             "Select a pixel or an area to show the spectral curve."
@@ -174,120 +323,154 @@ class SpectralViewer(QWidget):
         self.status_label.setVisible(True)
         self.grid_layout.addWidget(self.status_label)
 
+    @traced("plot")
     def render(self):
         if self.data is None:
             raise RuntimeError("Spectral curve render requested, but data is None")
         if self.labels is None:
             raise RuntimeError("Labels have not been provided")
+        if not self.figure_ready:
+            self.setup_figure()
 
-        bands = len(self.labels)
-        # Regenerate all plot objects, because tools are not updated after clearing the figure and creating new Axes
-        self.new_figure()
-        ax: Axes = self.fig.subplots()
-
-        match self.labels_type:
-            case LabelType.CUSTOM_STR:
-                ax.set_xticks(
-                    np.arange(bands),
-                    labels=self.labels,
-                    rotation=90,
-                    fontsize="x-small",
-                )
-                size = self.fig.get_size_inches() * self.fig.dpi
-                w = size[0]
-                step = ceil(bands / w * 12)
-                for i, label in enumerate(ax.xaxis.get_ticklabels()):
-                    if (i % step) != 0:
-                        label.set_visible(False)
-
-                x_values = np.arange(bands)
-                ax.set_xlabel("Band")
-
-            case LabelType.WAVELENGTH:
-                x_values = np.array(self.labels, dtype=np.float64)
-                self.show_spectrum_bg(ax, self.data, x_values)
-                ax.set_xlabel("Wavelength [nm]")
-
-            case LabelType.AUTO:
-                x_values = np.arange(bands)
-                ax.set_xlabel("Band")
+        from matplotlib.backend_tools import _views_positions
 
         match self.data:
             case AreaValues(avg, min, max, quartile_low, quartile_high):
-                ax.plot(x_values, avg, label="avg")
-                ax.plot(x_values, min, label="min")
-                ax.plot(x_values, max, label="max")
-                ax.plot(x_values, quartile_low, label="25%")
-                ax.plot(x_values, quartile_high, label="75%")
+                curves = [
+                    ("avg", avg),
+                    ("min", min),
+                    ("max", max),
+                    ("25%", quartile_low),
+                    ("75%", quartile_high),
+                ]
 
             case PixelValues(values):
-                ax.plot(x_values, values, label="Value")
+                curves = [("Value", values)]
 
             case None:
                 raise RuntimeError("No value")
 
-        ax.margins(0, 0)
-        ax.legend()
-
-        CSV_TOOL_NAME = "CSV"
-        self.toolmanager.add_tool(
-            CSV_TOOL_NAME,
-            ExportData,
-            parent=self,
-            plot_values=self.data,
-            labels_type=self.labels_type,
-            bands=self.labels if self.labels_type == LabelType.CUSTOM_STR else x_values,
-        )
-        self.toolbar.add_tool(CSV_TOOL_NAME, "io", 1)
+        if [line.get_label() for line in self.lines] == [c[0] for c in curves]:
+            for line, (_, values) in zip(self.lines, curves):
+                line.set_ydata(values)
+        else:
+            for line in self.lines:
+                line.remove()
+            # Restart the colour cycle, so that curves keep their colours
+            self.ax.set_prop_cycle(None)
+            self.lines = []
+            for label, values in curves:
+                # Animated lines are skipped by full draws and drawn on top in `_on_draw`, which allows blitting
+                self.lines += self.ax.plot(
+                    self.x_values, values, label=label, animated=True
+                )
+            self.ax.legend()
+
+        if self.area_artist is not None:
+            self.area_artist.remove()
+            self.area_artist = None
+        if isinstance(self.data, AreaValues):
+            self.area_artist = self.show_area_details(self.data)
+
+        self.ax.set_xlim(np.min(self.x_values), np.max(self.x_values))
+        self.set_value_range(*self.value_range(self.data))
+        # Reset zoom history, so that "home" shows the new data
+        self.toolmanager.get_tool(_views_positions).clear(self.fig)
 
         if self.status_label.isVisible():
             self.status_label.setVisible(False)
             self.grid_layout.removeWidget(self.status_label)
 
-        self.grid_layout.addWidget(self.canvas)
-        self.grid_layout.addWidget(self.toolbar)
-        self.canvas.setVisible(True)
-        self.toolbar.setVisible(True)
+            self.grid_layout.addWidget(self.canvas)
+            self.grid_layout.addWidget(self.toolbar)
+            self.canvas.setVisible(True)
+            self.toolbar.setVisible(True)
 
-    def show_spectrum_bg(
-        self, ax: Axes, values: AreaValues | PixelValues, x_values: NDArray[np.float64]
-    ):
-        # Visible spectrum limits for the image
-        clim = (350, 780)
-        # Prepare normalizer scaling [350, 780] to [0, 1]
-        norm = matplotlib.colors.Normalize(*clim)
-        # List of wavelengths from the visible light spectrum every 2 nm
-        wl = np.arange(clim[0], clim[1] + 1, 2)
-        # Prepare a `(wavelength, RGBA colour)` list
-        colorlist = list(zip(norm(wl), [wavelength_to_rgb(w) for w in wl]))
-        # Prepare a colormap for `imshow`
-        spectralmap = matplotlib.colors.LinearSegmentedColormap.from_list(
-            "spectrum", colorlist
-        )
+        self.canvas.draw_idle()
 
+    def _on_draw(self, event: "DrawEvent"):
+        if event.canvas.is_saving():
+            # Animated artists are drawn normally when saving
+            return
+        self.blit_background = self.canvas.copy_from_bbox(self.ax.bbox)
+        for line in self.lines:
+            self.ax.draw_artist(line)
+
+    @staticmethod
+    def value_range(values: AreaValues | PixelValues) -> tuple[float, float]:
         if isinstance(values, AreaValues):
-            v_min = np.min(values.min)
-            v_max = np.max(values.max)
+            return float(np.min(values.min)), float(np.max(values.max))
         else:
-            v_min = np.min(values.values)
-            v_max = np.max(values.values)
-
-        x_min = np.min(x_values)
-        x_max = np.max(x_values)
-        x_stripes = np.linspace(x_min, x_max, 1000)
+            return float(np.min(values.values)), float(np.max(values.values))
 
-        y = np.linspace(v_min, v_max, 100)
-        X, Y = np.meshgrid(x_stripes, y)
-
-        extent = (x_min, x_max, v_min, v_max)
-
-        ax.imshow(
-            X, clim=clim, extent=extent, cmap=spectralmap, aspect="auto", alpha=0.5
-        )
+    def set_value_range(self, v_min: float, v_max: float):
+        from matplotlib.transforms import nonsingular
 
+        v_min, v_max = nonsingular(v_min, v_max)
+        self.ax.set_ylim(v_min, v_max)
+        if self.labels_type == LabelType.WAVELENGTH:
+            extent = (np.min(self.x_values), np.max(self.x_values), v_min, v_max)
+            if self.spectrum_bg is None:
+                self.spectrum_bg = self.show_spectrum_bg(self.ax, self.x_values, extent)
+            else:
+                # The background depends only on labels, just stretch it over the new range
+                self.spectrum_bg.set_extent(extent)
+
+    def show_area_details(self, values: AreaValues) -> Optional["Artist"]:
+        """Shows spectral density or sampled spectra as a single artist."""
+        from matplotlib.collections import LineCollection
+        from matplotlib.image import NonUniformImage
+        from matplotlib.transforms import nonsingular
+
+        if values.density is not None:
+            bins = values.density.shape[0]
+            v_min, v_max = nonsingular(np.min(values.min), np.max(values.max))
+            bin_size = (v_max - v_min) / bins
+            y_values = v_min + bin_size * (np.arange(bins) + 0.5)
+            extent = (np.min(self.x_values), np.max(self.x_values), v_min, v_max)
+            image = NonUniformImage(
+                self.ax, cmap="magma", interpolation="nearest", extent=extent
+            )
+            # Logarithmic scale to keep rare values visible, empty bins are transparent
+            density = np.log1p(np.ma.masked_equal(values.density, 0))
+            image.set_data(self.x_values, y_values, density)
+            image.set_alpha(0.8)
+            # Above the visible spectrum background, below curves
+            image.set_zorder(0.5)
+            self.ax.add_image(image)
+            return image
+
+        if values.samples is not None:
+            segments = np.empty(values.samples.shape + (2,), dtype=np.float64)
+            segments[..., 0] = self.x_values
+            segments[..., 1] = values.samples
+            lines = LineCollection(
+                segments, linewidths=0.5, colors="white", alpha=0.15, zorder=1.5
+            )
+            self.ax.add_collection(lines, autolim=False)
+            return lines
 
-# From https://stackoverflow.com/a/44960748
-def wavelength_to_rgb(wavelength: float, gamma: float = 0.8):
+    def show_spectrum_bg(
+        self,
+        ax: "Axes",
+        x_values: NDArray[np.float64],
+        extent: tuple[float, float, float, float],
+    ) -> "AxesImage":
+        """Shows the visible light spectrum behind the curves.
+        Called once per set of labels, later only the extent of the returned image is updated.
+        """
+        x_stripes = np.linspace(np.min(x_values), np.max(x_values), 1000)
+        # Colour depends only on the wavelength, so a single row is stretched over the whole plot
+        raster = wavelength_to_rgb(x_stripes)[np.newaxis]
+        raster[..., 3] *= 0.5
+
+        return ax.imshow(raster, extent=extent, aspect="auto")
+
+
+# Based on https://stackoverflow.com/a/44960748
+def wavelength_to_rgb(
+    wavelength: npt.ArrayLike, gamma: float = 0.8
+) -> NDArray[np.float64]:
     """taken from http://www.noah.org/wiki/Wavelength_to_RGB_in_Python
     This converts a given wavelength of light to an
     approximate RGB color value. The wavelength must be given
@@ -296,98 +479,59 @@ def wavelength_to_rgb(wavelength: float, gamma: float = 0.8):
 
     Based on code by Dan Bruton
     http://www.physics.sfasu.edu/astro/color/spectra.html
-    Additionally alpha value set to 0.5 outside range
+    Additionally alpha value set to 0.2 outside range
+
+    Vectorised, returns an array of RGBA colours with shape `wavelength.shape + (4,)`.
     """
-    if wavelength >= 380 and wavelength <= 750:
-        A = 1.0
-    else:
-        A = 0.2
-    if wavelength < 380:
-        wavelength = 380.0
-    if wavelength > 750:
-        wavelength = 750.0
-    if wavelength >= 380 and wavelength <= 440:
-        attenuation = 0.3 + 0.7 * (wavelength - 380) / (440 - 380)
-        R: float = ((-(wavelength - 440) / (440 - 380)) * attenuation) ** gamma
-        G: float = 0.0
-        B: float = (1.0 * attenuation) ** gamma
-    elif wavelength >= 440 and wavelength <= 490:
-        R = 0.0
-        G = ((wavelength - 440) / (490 - 440)) ** gamma
-        B = 1.0
-    elif wavelength >= 490 and wavelength <= 510:
-        R = 0.0
-        G = 1.0
-        B = (-(wavelength - 510) / (510 - 490)) ** gamma
-    elif wavelength >= 510 and wavelength <= 580:
-        R = ((wavelength - 510) / (580 - 510)) ** gamma
-        G = 1.0
-        B = 0.0
-    elif wavelength >= 580 and wavelength <= 645:
-        R = 1.0
-        G = (-(wavelength - 645) / (645 - 580)) ** gamma
-        B = 0.0
-    elif wavelength >= 645 and wavelength <= 750:
-        attenuation = 0.3 + 0.7 * (750 - wavelength) / (750 - 645)
-        R = (1.0 * attenuation) ** gamma
-        G = 0.0
-        B = 0.0
-    else:
-        R = 0.0
-        G = 0.0
-        B = 0.0
-    return (R, G, B, A)
-
-
-class ExportData(ToolBase):
-    """Export data as CSV button"""
-
-    default_keymap = ["C"]
-    description = "Export plot as CSV"
-    image = (
-        Path(__file__).parent.joinpath("../style/icons/export_csv").resolve().as_posix()
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    A = np.where((wavelength >= 380) & (wavelength <= 750), 1.0, 0.2)
+    wavelength = np.clip(wavelength, 380.0, 750.0)
+
+    def ramp(x: NDArray[np.float64]) -> NDArray[np.float64]:
+        # Bases are negative only outside of their range, where results are discarded anyway
+        return np.clip(x, 0, None) ** gamma
+
+    # `np.select` takes the first matching condition, same as the original `elif` chain
+    ranges = [
+        wavelength <= 440,
+        wavelength <= 490,
+        wavelength <= 510,
+        wavelength <= 580,
+        wavelength <= 645,
+    ]
+    attenuation_low = 0.3 + 0.7 * (wavelength - 380) / (440 - 380)
+    attenuation_high = 0.3 + 0.7 * (750 - wavelength) / (750 - 645)
+    R = np.select(
+        ranges,
+        [
+            ramp(-(wavelength - 440) / (440 - 380) * attenuation_low),
+            0.0,
+            0.0,
+            ramp((wavelength - 510) / (580 - 510)),
+            1.0,
+        ],
+        ramp(attenuation_high),
     )
-
-    def __init__(
-        self,
-        *args,
-        parent: QWidget,
-        plot_values: PixelValues | AreaValues,
-        labels_type: LabelType,
-        bands: list[str] | NDArray[np.int_] | NDArray[np.float64],
-        **kwargs
-    ) -> None:
-        super().__init__(*args, **kwargs)
-        self.parent = parent
-        self.plot_values = plot_values
-        self.labels_type = labels_type
-        self.bands = bands
-
-    def trigger(self, *args, **kwargs) -> None:
-        out_path, _filter = QFileDialog.getSaveFileName(
-            self.parent, "Choose a filename to export to", "", "CSV files (*.csv *.txt)"
-        )
-        if not out_path:
-            return
-
-        if self.labels_type == LabelType.WAVELENGTH:
-            band_header = "Wavelength"
-        else:
-            band_header = "Band"
-
-        with open(out_path, "w", encoding="utf-8") as out_file:
-            writer = csv.writer(out_file, dialect="excel", lineterminator="\n")
-            match self.plot_values:
-                case PixelValues(values):
-                    writer.writerow([band_header, "Value"])
-                    for row in zip(self.bands, values):
-                        writer.writerow(row)
-
-                case AreaValues(avg, min, max, quartile_low, quartile_high):
-                    writer.writerow(
-                        [band_header, "Minimum", "25%", "Average", "75%", "Maximum"]
-                    )
-                    for row in zip(
-                        self.bands, min, quartile_low, avg, quartile_high, max
-                    ):
-                        writer.writerow(row)
+    G = np.select(
+        ranges,
+        [
+            0.0,
+            ramp((wavelength - 440) / (490 - 440)),
+            1.0,
+            1.0,
+            ramp(-(wavelength - 645) / (645 - 580)),
+        ],
+        0.0,
+    )
+    B = np.select(
+        ranges,
+        [
+            ramp(attenuation_low),
+            1.0,
+            ramp(-(wavelength - 510) / (510 - 490)),
+            0.0,
+            0.0,
+        ],
+        0.0,
+    )
+    return np.stack([R, G, B, A], axis=-1)
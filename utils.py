@@ -1,9 +1,13 @@
-# @property doesn't work with static methods, but this simple decorator does
-from typing import Callable, Generic, TypeVar
+import ctypes
+import os
+import sys
+from concurrent.futures import Future, as_completed
+from typing import Any, Callable, Generic, Iterable, Optional, Type, TypeVar
 
 T = TypeVar("T")
 
 
+# @property doesn't work with static methods, but this simple decorator does
 class staticproperty(property, Generic[T]):
     def __init__(
         self,
@@ -14,3 +18,87 @@ class staticproperty(property, Generic[T]):
 
     def __get__(self, cls, owner) -> T:
         return self.fget()
+
+
+class LazyFormat(Generic[T]):
+    """A file format handler registered by its metadata and imported on first use.
+    The filter name and extensions are enough to populate file dialogs,
+    so modules with heavy dependencies are imported only when a file of that format is used.
+    `load` should import the module inside the function, so that packaging tools still find it.
+    """
+
+    def __init__(
+        self, filter_name: str, extensions: list[str], load: Callable[[], Type[T]]
+    ) -> None:
+        self.filter_name = filter_name
+        self.extensions = extensions
+        self._load = load
+        self._cls: Optional[Type[T]] = None
+
+    def get(self) -> Type[T]:
+        if self._cls is None:
+            cls = self._load()
+            # The registry and the class must describe the same format
+            if (
+                cls.FILE_FILTER_NAME != self.filter_name
+                or cls.EXTENSIONS != self.extensions
+            ):
+                raise Exception(
+                    f"{cls.__name__} doesn't match its registration {self.filter_name} {self.extensions}."
+                )
+            self._cls = cls
+        return self._cls
+
+
+def available_memory() -> Optional[int]:
+    """Returns physical memory available for new allocations in bytes or `None` if unknown."""
+    if sys.platform == "win32":
+
+        class MemoryStatusEx(ctypes.Structure):
+            _fields_ = [
+                ("dwLength", ctypes.c_ulong),
+                ("dwMemoryLoad", ctypes.c_ulong),
+                ("ullTotalPhys", ctypes.c_ulonglong),
+                ("ullAvailPhys", ctypes.c_ulonglong),
+                ("ullTotalPageFile", ctypes.c_ulonglong),
+                ("ullAvailPageFile", ctypes.c_ulonglong),
+                ("ullTotalVirtual", ctypes.c_ulonglong),
+                ("ullAvailVirtual", ctypes.c_ulonglong),
+                ("ullAvailExtendedVirtual", ctypes.c_ulonglong),
+            ]
+
+        status = MemoryStatusEx()
+        status.dwLength = ctypes.sizeof(MemoryStatusEx)
+        if not ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return None
+        return status.ullAvailPhys
+
+    # MemAvailable includes page cache which can be reclaimed, unlike free pages
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError):
+        return None
+
+
+def complete_all(
+    futures: Iterable[Future[T]], on_done: Callable[[Future[T]], Any]
+) -> None:
+    """Calls `on_done` with every future as it completes.
+    If anything raises, e.g. a progress callback when the user cancels, futures which haven't started are cancelled,
+    so that the executor only waits for running ones.
+    """
+    futures = list(futures)
+    try:
+        for future in as_completed(futures):
+            on_done(future)
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
@@ -1,34 +1,61 @@
 # This is a demo to test packaging
+from time import perf_counter
+
+# Taken before other imports, which are the slowest part of starting the application
+STARTUP_BEGIN = perf_counter()
+
+import atexit
 import math
 import os
 from enum import Enum
+from multiprocessing import freeze_support
 from sys import argv, exit
 from typing import Optional
 
 import numpy as np
 import numpy.typing as npt
-from PyQt6.QtCore import Qt
+from PyQt6.QtCore import Qt, QTimer
 from PyQt6.QtGui import QAction, QIcon, QKeySequence
 from PyQt6.QtWidgets import (
     QApplication,
     QComboBox,
     QDoubleSpinBox,
+    QFileDialog,
     QFormLayout,
     QGridLayout,
     QHBoxLayout,
+    QInputDialog,
     QLabel,
     QMainWindow,
     QMenuBar,
+    QMessageBox,
     QPushButton,
     QSlider,
+    QSpinBox,
     QVBoxLayout,
     QWidget,
 )
 
+import tracing
+from analysis.anomaly import AnomalyDetection, AnomalyMethod
+from analysis.band_math import BandMath
+from analysis.clustering import MAX_CLASSES, NO_CLASS, Clustering, cluster
+from analysis.components import ComponentAnalysis, ComponentMethod
+from analysis.library import (
+    NO_MATCH,
+    LibraryMatch,
+    MatchMethod,
+    SpectralLibrary,
+    match_library,
+)
+from analysis.processes import ProcessBackend
+from exporters.exporter import Exporter
 from lib import Coordinates, HsImage
+from loaders.abstract import LoadPreview, ignore_progress
 from loaders.loader import Loader
-from ui.image_preview import ImagePreview
-from ui.spectral_viewer import SpectralViewer
+from ui.background import TaskWorker, run_in_background
+from ui.image_preview import ImagePreview, class_colors
+from ui.spectral_viewer import AreaPlotMode, SpectralViewer
 
 
 class ApplicationState(Enum):
@@ -38,15 +65,23 @@ class ApplicationState(Enum):
     SELECT_AREA_FIRST = 3
     SELECT_AREA_SECOND = 4
     SELECT_SIMILAR = 5
+    SELECT_CLASS = 6
 
 
 class ImageMode(Enum):
     MONO = 0
     RGB = 1
     SIMILAR = 2
+    BAND_MATH = 3
+    COMPONENTS = 4
+    LIBRARY_MATCH = 5
+    ANOMALY = 6
 
 
 class MainWindow(QMainWindow):
+    SIMILAR_OVERLAY = "similar"
+    CLASSES_OVERLAY = "classes"
+    ANOMALY_OVERLAY = "anomalies"
     state = ApplicationState.NO_IMAGE
     image_mode = ImageMode.MONO
     band_mono = 0
@@ -54,9 +89,28 @@ class MainWindow(QMainWindow):
     band_g = 0
     band_b = 0
     image: Optional[HsImage] = None
+    band_math: Optional[BandMath] = None
+    expression = ""
+    """Band math expression rendered in `ImageMode.BAND_MATH`"""
+    components: Optional[ComponentAnalysis] = None
+    component_method = ComponentMethod.PCA
+    clustering: Optional[Clustering] = None
+    anomalies: Optional[AnomalyDetection] = None
+    anomaly_method = AnomalyMethod.GLOBAL
+    anomaly_fraction = 0.01
+    """Fraction of the most anomalous pixels shown by the overlay"""
+    ignore_anomaly_change = False
+    library_match: Optional[LibraryMatch] = None
+    """Best library matches rendered in `ImageMode.LIBRARY_MATCH`"""
+    task: Optional[TaskWorker] = None
+    """The last computation started in the background"""
+    backend: Optional[ProcessBackend] = None
+    """Worker processes used for heavy analysis or `None` to compute in this process"""
     threshold = 1.0
     ignore_threshold_change = False
     similar_mask: Optional[npt.NDArray[np.bool8]] = None
+    selection_mask: Optional[npt.NDArray[np.bool_]] = None
+    """Pixels selected most recently by any tool, used for exporting spectra"""
 
     def start(self):
         self.resize(1280, 720)
@@ -68,6 +122,12 @@ class MainWindow(QMainWindow):
 
     def setup_logic(self):
         self.loader = Loader(self)
+        # The window may be destroyed while an image is being cached, also when exiting from the File menu
+        app = QApplication.instance()
+        assert app is not None
+        app.aboutToQuit.connect(self.loader.stop_caching)
+        atexit.register(self.loader.stop_caching)
+        self.exporter = Exporter(self)
         self.image_preview.register_handlers(self.on_mouse_down, self.on_mouse_up)
 
     def setup_ui(self):
@@ -105,6 +165,18 @@ class MainWindow(QMainWindow):
         self.fake_col_button.setText("Fake color")
         self.fake_col_button.clicked.connect(self.fake_col_click)
 
+        self.band_math_button = QPushButton(self)
+        self.band_math_button.setText("Band math")
+        self.band_math_button.clicked.connect(self.band_math_click)
+
+        self.components_button = QPushButton(self)
+        self.components_button.setText("Components")
+        self.components_button.clicked.connect(self.components_click)
+
+        self.anomalies_button = QPushButton(self)
+        self.anomalies_button.setText("Anomalies")
+        self.anomalies_button.clicked.connect(self.anomalies_click)
+
         self.single_band_settings = QWidget(central_widget)
         sb_settings_layout = QFormLayout(self.single_band_settings)
         sb_settings_layout.setContentsMargins(0, 0, 0, 0)
@@ -128,6 +200,48 @@ class MainWindow(QMainWindow):
         self.rgb_band_settings.setLayout(rgb_settings_layout)
         self.rgb_band_settings.setVisible(False)
 
+        self.component_settings = QWidget(central_widget)
+        component_settings_layout = QFormLayout(self.component_settings)
+        component_settings_layout.setContentsMargins(0, 0, 0, 0)
+        self.component_combo = QComboBox(self.component_settings)
+        # Order must match `ComponentMethod` values
+        self.component_combo.addItems(["PCA", "MNF"])
+        self.component_combo.currentIndexChanged.connect(self.component_method_changed)
+        component_settings_layout.addRow("Method", self.component_combo)
+        self.component_settings.setLayout(component_settings_layout)
+        self.component_settings.setVisible(False)
+
+        self.anomaly_settings = QWidget(central_widget)
+        anomaly_settings_layout = QFormLayout(self.anomaly_settings)
+        anomaly_settings_layout.setContentsMargins(0, 0, 0, 0)
+        self.anomaly_combo = QComboBox(self.anomaly_settings)
+        # Order must match `AnomalyMethod` values
+        self.anomaly_combo.addItems(["Global RX", "Local RX"])
+        self.anomaly_combo.currentIndexChanged.connect(self.anomaly_method_changed)
+        anomaly_settings_layout.addRow("Method", self.anomaly_combo)
+        anomaly_threshold_label = QLabel("Anomalous pixels (%)")
+        anomaly_settings_layout.setWidget(
+            1, QFormLayout.ItemRole.SpanningRole, anomaly_threshold_label
+        )
+        self.input_anomaly = QDoubleSpinBox(self.anomaly_settings)
+        self.input_anomaly.setDecimals(3)
+        self.input_anomaly.setMinimum(0.001)
+        self.input_anomaly.setMaximum(100.0)
+        self.input_anomaly.setSingleStep(0.1)
+        self.input_anomaly.setValue(1.0)
+        self.input_anomaly.valueChanged.connect(self.anomaly_input_changed)
+        self.slider_anomaly = QSlider(Qt.Orientation.Horizontal, self.anomaly_settings)
+        self.slider_anomaly.setMinimum(0)
+        self.slider_anomaly.setMaximum(50)
+        self.slider_anomaly.setValue(30)
+        self.slider_anomaly.setTickPosition(QSlider.TickPosition.TicksBothSides)
+        self.slider_anomaly.setTickInterval(5)
+        self.slider_anomaly.setTracking(True)
+        self.slider_anomaly.valueChanged.connect(self.anomaly_slider_changed)
+        anomaly_settings_layout.addRow(self.input_anomaly, self.slider_anomaly)
+        self.anomaly_settings.setLayout(anomaly_settings_layout)
+        self.anomaly_settings.setVisible(False)
+
         # ****** Magic Wand ******
 
         self.label_wand = QLabel("Magic wand", self)
@@ -165,6 +279,55 @@ class MainWindow(QMainWindow):
 
         magic_wand_layout.addRow(self.input_magic_wand, self.slider_magic_wand)
 
+        # ****** Classification ******
+
+        self.label_classes = QLabel("Classification", self)
+
+        self.classify_button = QPushButton(self)
+        self.classify_button.setText("Classify")
+        self.classify_button.clicked.connect(self.classify_click)
+
+        classes_settings = QWidget(central_widget)
+        classes_layout = QFormLayout(classes_settings)
+        classes_layout.setContentsMargins(0, 0, 0, 0)
+        self.classes_input = QSpinBox(classes_settings)
+        self.classes_input.setRange(2, MAX_CLASSES)
+        self.classes_input.setValue(8)
+        self.classes_components_input = QSpinBox(classes_settings)
+        # 0 classifies whole spectra
+        self.classes_components_input.setRange(0, 64)
+        self.classes_components_input.setSpecialValueText("Off")
+        self.classes_components_input.setValue(10)
+        classes_layout.addRow("Classes", self.classes_input)
+        classes_layout.addRow("PCA components", self.classes_components_input)
+        classes_settings.setLayout(classes_layout)
+
+        self.select_class = QPushButton(self)
+        self.select_class.setText("Select class")
+        self.select_class.clicked.connect(self.select_class_click)
+
+        self.show_classes = QPushButton(self)
+        self.show_classes.setText("Show classes")
+        self.show_classes.setCheckable(True)
+        self.show_classes.toggled.connect(self.show_classes_toggled)
+
+        # ****** Spectral library ******
+
+        self.label_library = QLabel("Spectral library", self)
+
+        self.match_library_button = QPushButton(self)
+        self.match_library_button.setText("Match library")
+        self.match_library_button.clicked.connect(self.match_library_click)
+
+        library_settings = QWidget(central_widget)
+        library_layout = QFormLayout(library_settings)
+        library_layout.setContentsMargins(0, 0, 0, 0)
+        self.match_method_combo = QComboBox(library_settings)
+        # Order must match `MatchMethod` values
+        self.match_method_combo.addItems(["Spectral angle", "Correlation"])
+        library_layout.addRow("Similarity", self.match_method_combo)
+        library_settings.setLayout(library_layout)
+
         # ****** Spectral curve ******
 
         self.label_spectral = QLabel("Spectral curve", self)
@@ -177,23 +340,55 @@ class MainWindow(QMainWindow):
         self.select_area.setText("Select area")
         self.select_area.clicked.connect(self.select_area_click)
 
+        self.hover_inspect = QPushButton(self)
+        self.hover_inspect.setText("Inspect on hover")
+        self.hover_inspect.setCheckable(True)
+        self.hover_inspect.toggled.connect(self.hover_inspect_toggled)
+
+        area_plot_settings = QWidget(central_widget)
+        area_plot_layout = QFormLayout(area_plot_settings)
+        area_plot_layout.setContentsMargins(0, 0, 0, 0)
+        self.area_plot_combo = QComboBox(area_plot_settings)
+        # Order must match `AreaPlotMode` values
+        self.area_plot_combo.addItems(["Summary", "Density", "Samples"])
+        self.area_plot_combo.currentIndexChanged.connect(self.area_plot_mode_changed)
+        area_plot_layout.addRow("Area plot", self.area_plot_combo)
+        area_plot_settings.setLayout(area_plot_layout)
+
         # ****** Add elements to layout ******
 
         """Change the order of toolbars; maybe select_point/area to toolbar1?"""
 
         toolbar_mode.addWidget(self.single_band_button)
         toolbar_mode.addWidget(self.fake_col_button)
+        toolbar_mode.addWidget(self.band_math_button)
+        toolbar_mode.addWidget(self.components_button)
+        toolbar_mode.addWidget(self.anomalies_button)
 
         toolbar_image_settings.addWidget(self.single_band_settings)
         toolbar_image_settings.addWidget(self.rgb_band_settings)
+        toolbar_image_settings.addWidget(self.component_settings)
+        toolbar_image_settings.addWidget(self.anomaly_settings)
 
         toolbar_tools.addWidget(self.label_wand)
         toolbar_tools.addWidget(self.button_magic)
         toolbar_tools.addWidget(mw_settings_widget)
 
+        toolbar_tools.addWidget(self.label_classes)
+        toolbar_tools.addWidget(self.classify_button)
+        toolbar_tools.addWidget(classes_settings)
+        toolbar_tools.addWidget(self.select_class)
+        toolbar_tools.addWidget(self.show_classes)
+
+        toolbar_tools.addWidget(self.label_library)
+        toolbar_tools.addWidget(self.match_library_button)
+        toolbar_tools.addWidget(library_settings)
+
         toolbar_tools.addWidget(self.label_spectral)
         toolbar_tools.addWidget(self.select_point)
         toolbar_tools.addWidget(self.select_area)
+        toolbar_tools.addWidget(self.hover_inspect)
+        toolbar_tools.addWidget(area_plot_settings)
 
         self.spectral_viewer = SpectralViewer(self)
         spectrum_graph.addWidget(self.spectral_viewer)
@@ -210,14 +405,43 @@ class MainWindow(QMainWindow):
 
         # File menu
         action_open = QAction("Open", self)
-        action_open.triggered.connect(self.open_click)
+        action_open.triggered.connect(lambda: self.open_click())
         action_open.setShortcut(QKeySequence.StandardKey.Open)
+        action_open_subset = QAction("Open part of image...", self)
+        action_open_subset.triggered.connect(lambda: self.open_click(subset=True))
+        action_export = QAction("Export spectra", self)
+        action_export.triggered.connect(self.export_click)
         action_exit = QAction("Exit", self)
         action_exit.triggered.connect(lambda: exit())
         action_exit.setShortcuts(QKeySequence.StandardKey.Quit)
         fileMenu.addAction(action_open)
+        fileMenu.addAction(action_open_subset)
+        fileMenu.addAction(action_export)
         fileMenu.addAction(action_exit)
 
+        # Options menu
+        optionsMenu = menuBar.addMenu("&Options")
+        action_processes = QAction("Compute in worker processes", self)
+        action_processes.setCheckable(True)
+        action_processes.toggled.connect(self.worker_processes_toggled)
+        optionsMenu.addAction(action_processes)
+
+        # Debug menu
+        debugMenu = menuBar.addMenu("&Debug")
+        action_trace = QAction("Record trace", self)
+        action_trace.setCheckable(True)
+        action_trace.setChecked(tracing.tracer.enabled)
+        action_trace.toggled.connect(self.trace_toggled)
+        action_timings = QAction("Show timings in status bar", self)
+        action_timings.setCheckable(True)
+        action_timings.toggled.connect(self.timings_toggled)
+        action_export_trace = QAction("Export trace", self)
+        action_export_trace.triggered.connect(self.export_trace_click)
+        debugMenu.addAction(action_trace)
+        debugMenu.addAction(action_timings)
+        debugMenu.addAction(action_export_trace)
+        self.action_trace = action_trace
+
     def setup_icon(self):
         icon = QIcon("style/icons/whaaale.ico")
         self.setWindowIcon(icon)
@@ -225,100 +449,505 @@ class MainWindow(QMainWindow):
     """Methods responsible for handling interaction with buttons etc."""
 
     def single_band_click(self):
-        print("clicked single band")
+        tracing.instant("clicked single band")
         if self.state != ApplicationState.NO_IMAGE:
             self.image_preview.clear_rubber_band()
+            self.image_preview.clear_overlay(self.SIMILAR_OVERLAY)
+            self.image_preview.clear_overlay(self.ANOMALY_OVERLAY)
             self.image_mode = ImageMode.MONO
             self.state = ApplicationState.IMAGE_LOADED
             self.rgb_band_settings.setVisible(False)
             self.single_band_settings.setVisible(True)
+            self.component_settings.setVisible(False)
+            self.anomaly_settings.setVisible(False)
             self.render_image()
 
     def fake_col_click(self):
-        print("clicked fake color")
+        tracing.instant("clicked fake color")
         if self.state != ApplicationState.NO_IMAGE:
             self.image_preview.clear_rubber_band()
+            self.image_preview.clear_overlay(self.SIMILAR_OVERLAY)
+            self.image_preview.clear_overlay(self.ANOMALY_OVERLAY)
             self.image_mode = ImageMode.RGB
             self.state = ApplicationState.IMAGE_LOADED
             self.rgb_band_settings.setVisible(True)
             self.single_band_settings.setVisible(False)
+            self.component_settings.setVisible(False)
+            self.anomaly_settings.setVisible(False)
+            self.render_image()
+
+    def band_math_click(self):
+        tracing.instant("clicked band math")
+        if self.state == ApplicationState.NO_IMAGE:
+            return
+        assert self.band_math is not None
+        expression, ok = QInputDialog.getText(
+            self,
+            "Whaaale - band math",
+            "Expression with bands by wavelength (R800) or index (B10),\n"
+            "e.g. (R800 - R670) / (R800 + R670)",
+            text=self.expression,
+        )
+        if not ok or not expression.strip():
+            return
+        try:
+            self.band_math.parse(expression)
+        except ValueError as err:
+            QMessageBox.warning(
+                self, "Whaaale - band math", "Invalid expression\n\n" + str(err)
+            )
+            return
+        band_math = self.band_math
+        backend = self.backend
+
+        def show(_):
+            if band_math is not self.band_math:
+                # Another image has been opened in the meantime
+                return
+            self.expression = expression
+            self.image_preview.clear_rubber_band()
+            self.image_preview.clear_overlay(self.SIMILAR_OVERLAY)
+            self.image_preview.clear_overlay(self.ANOMALY_OVERLAY)
+            self.image_mode = ImageMode.BAND_MATH
+            self.state = ApplicationState.IMAGE_LOADED
+            self.rgb_band_settings.setVisible(False)
+            self.single_band_settings.setVisible(False)
+            self.component_settings.setVisible(False)
+            self.anomaly_settings.setVisible(False)
+            self.render_image()
+
+        if backend is None:
+            # Evaluated when rendered
+            show(None)
+            return
+        self.task = run_in_background(
+            self,
+            "Evaluating expression",
+            lambda progress: band_math.evaluate(expression, progress, backend),
+            show,
+        )
+
+    def components_click(self):
+        tracing.instant("clicked components")
+        if self.state != ApplicationState.NO_IMAGE:
+            self.show_components(self.component_method)
+
+    def component_method_changed(self, idx: int):
+        tracing.instant("component method changed", method=idx)
+        if (
+            idx != -1
+            and self.state != ApplicationState.NO_IMAGE
+            and self.image_mode == ImageMode.COMPONENTS
+        ):
+            self.show_components(ComponentMethod(idx))
+
+    def show_components(self, method: ComponentMethod):
+        """Renders the composite of components, computes them in the background first if needed."""
+        assert self.components is not None
+        analysis = self.components
+
+        def show(_):
+            if analysis is not self.components:
+                # Another image has been opened in the meantime
+                return
+            self.component_method = method
+            self.image_preview.clear_rubber_band()
+            self.image_preview.clear_overlay(self.SIMILAR_OVERLAY)
+            self.image_preview.clear_overlay(self.ANOMALY_OVERLAY)
+            self.image_mode = ImageMode.COMPONENTS
+            self.state = ApplicationState.IMAGE_LOADED
+            self.rgb_band_settings.setVisible(False)
+            self.single_band_settings.setVisible(False)
+            self.component_settings.setVisible(True)
             self.render_image()
+            self.statusBar().showMessage(
+                analysis.transform(method, ignore_progress).describe()
+            )
+
+        def restore_method():
+            # Show the method of the displayed composite again
+            self.component_combo.blockSignals(True)
+            self.component_combo.setCurrentIndex(self.component_method.value)
+            self.component_combo.blockSignals(False)
+
+        if analysis.is_ready(method):
+            show(None)
+            return
+        self.task = run_in_background(
+            self,
+            "Computing components",
+            lambda progress: analysis.composite(method, progress),
+            show,
+            restore_method,
+        )
+
+    def anomalies_click(self):
+        tracing.instant("clicked anomalies")
+        if self.state != ApplicationState.NO_IMAGE:
+            self.show_anomalies(self.anomaly_method)
+
+    def anomaly_method_changed(self, idx: int):
+        tracing.instant("anomaly method changed", method=idx)
+        if (
+            idx != -1
+            and self.state != ApplicationState.NO_IMAGE
+            and self.image_mode == ImageMode.ANOMALY
+        ):
+            self.show_anomalies(AnomalyMethod(idx))
+
+    def show_anomalies(self, method: AnomalyMethod):
+        """Renders RX scores with the overlay of the most anomalous pixels, computes them in the background first if needed."""
+        assert self.anomalies is not None
+        detection = self.anomalies
+        backend = self.backend
+
+        def show(_):
+            if detection is not self.anomalies:
+                # Another image has been opened in the meantime
+                return
+            self.anomaly_method = method
+            self.image_preview.clear_rubber_band()
+            self.image_preview.clear_overlay(self.SIMILAR_OVERLAY)
+            self.image_mode = ImageMode.ANOMALY
+            self.state = ApplicationState.IMAGE_LOADED
+            self.rgb_band_settings.setVisible(False)
+            self.single_band_settings.setVisible(False)
+            self.component_settings.setVisible(False)
+            self.anomaly_settings.setVisible(True)
+            self.render_image()
+            self.show_anomaly_overlay()
+
+        def restore_method():
+            # Show the method of the displayed scores again
+            self.anomaly_combo.blockSignals(True)
+            self.anomaly_combo.setCurrentIndex(self.anomaly_method.value)
+            self.anomaly_combo.blockSignals(False)
+
+        if detection.is_ready(method):
+            show(None)
+            return
+        self.task = run_in_background(
+            self,
+            "Detecting anomalies",
+            lambda progress: detection.scores(method, progress, backend),
+            show,
+            restore_method,
+        )
+
+    def show_anomaly_overlay(self):
+        """Marks the most anomalous pixels, they become the selection, e.g. for exporting their spectra."""
+        if self.image_mode != ImageMode.ANOMALY or self.anomalies is None:
+            return
+        scores = self.anomalies.scores(self.anomaly_method, ignore_progress)
+        mask = scores.mask(self.anomaly_fraction)
+        self.selection_mask = mask
+        self.image_preview.set_overlay(self.ANOMALY_OVERLAY, mask)
+        self.statusBar().showMessage(
+            f"{np.count_nonzero(mask)} pixels with RX score above "
+            f"{scores.threshold(self.anomaly_fraction):.4g}"
+        )
 
     def magic_wand_click(self):
-        print("clicked magic wand")
+        tracing.instant("clicked magic wand")
         self.image_preview.clear_rubber_band()
         self.state = ApplicationState.SELECT_SIMILAR
 
+    def classify_click(self):
+        tracing.instant("clicked classify")
+        if self.state == ApplicationState.NO_IMAGE:
+            return
+        assert self.image is not None
+        image = self.image
+        n_classes = self.classes_input.value()
+        n_components = self.classes_components_input.value() or None
+        backend = self.backend
+
+        def classified(clustering: Clustering):
+            if image is not self.image:
+                # Another image has been opened in the meantime
+                return
+            self.clustering = clustering
+            self.show_classes.setChecked(True)
+            self.show_class_overlay()
+
+        self.task = run_in_background(
+            self,
+            "Classifying pixels",
+            lambda progress: cluster(
+                image, n_classes, n_components, progress, backend=backend
+            ),
+            classified,
+        )
+
+    def select_class_click(self):
+        tracing.instant("clicked select class")
+        if self.clustering is None:
+            QMessageBox.information(
+                self,
+                "Whaaale - select class",
+                "Classify the image to select classes.",
+            )
+            return
+        self.image_preview.clear_rubber_band()
+        self.state = ApplicationState.SELECT_CLASS
+
+    def show_classes_toggled(self, checked: bool):
+        tracing.instant("show classes", enabled=checked)
+        self.show_class_overlay()
+
+    def show_class_overlay(self):
+        if self.clustering is not None and self.show_classes.isChecked():
+            self.image_preview.set_class_overlay(
+                self.CLASSES_OVERLAY,
+                self.clustering.classes,
+                class_colors(len(self.clustering.counts)),
+            )
+        else:
+            self.image_preview.clear_overlay(self.CLASSES_OVERLAY)
+
+    def match_library_click(self):
+        tracing.instant("clicked match library")
+        if self.state == ApplicationState.NO_IMAGE:
+            return
+        assert self.image is not None
+        file_path, _ = QFileDialog.getOpenFileName(
+            self,
+            "Open spectral library",
+            "",
+            "Spectral libraries (*.csv *.txt *.sli *.hdr);;All files (*)",
+        )
+        if not file_path:
+            return
+        try:
+            library = SpectralLibrary.read(file_path)
+        except (OSError, ValueError) as err:
+            QMessageBox.warning(
+                self,
+                "Whaaale - match library",
+                "Reading spectral library failed\n\n" + str(err),
+            )
+            return
+        image = self.image
+        method = MatchMethod(self.match_method_combo.currentIndex())
+
+        def matched(library_match: LibraryMatch):
+            if image is not self.image:
+                # Another image has been opened in the meantime
+                return
+            self.library_match = library_match
+            self.image_preview.clear_rubber_band()
+            self.image_preview.clear_overlay(self.SIMILAR_OVERLAY)
+            self.image_preview.clear_overlay(self.ANOMALY_OVERLAY)
+            self.image_mode = ImageMode.LIBRARY_MATCH
+            self.state = ApplicationState.IMAGE_LOADED
+            self.rgb_band_settings.setVisible(False)
+            self.single_band_settings.setVisible(False)
+            self.component_settings.setVisible(False)
+            self.anomaly_settings.setVisible(False)
+            self.render_image()
+            self.statusBar().showMessage(
+                f"Matched {len(library.names)} library spectra, "
+                "select a point to show its best match"
+            )
+
+        self.task = run_in_background(
+            self,
+            "Matching library",
+            lambda progress: match_library(image, library, method, progress),
+            matched,
+        )
+
     def select_point_click(self):
-        print("clicked select point")
+        tracing.instant("clicked select point")
         self.image_preview.clear_rubber_band()
         self.state = ApplicationState.SELECT_PX
 
     def select_area_click(self):
-        print("clicked select area")
+        tracing.instant("clicked select area")
         self.image_preview.clear_rubber_band()
         self.state = ApplicationState.SELECT_AREA_FIRST
 
-    def open_click(self):
-        print("clicked open in menu bar")
-        img = self.loader.open_file()
-        if img is not None:
-            # Set NO_IMAGE to disable some event handlers
-            self.state = ApplicationState.NO_IMAGE
-            for combo in [
-                self.sb_combo,
-                self.rgb_combo_r,
-                self.rgb_combo_g,
-                self.rgb_combo_b,
-            ]:
-                combo.clear()
-                combo.addItems(img.labels)
-
-            rgb_idx = img.closest_rgb_idx()
-            if rgb_idx is not None:
-                self.image_mode = ImageMode.RGB
-                self.band_r, self.band_g, self.band_b = rgb_idx
-                self.rgb_combo_r.setCurrentIndex(self.band_r)
-                self.rgb_combo_g.setCurrentIndex(self.band_g)
-                self.rgb_combo_b.setCurrentIndex(self.band_b)
-                self.band_mono = 0
-                self.rgb_band_settings.setVisible(True)
-                self.single_band_settings.setVisible(False)
-            else:
-                self.image_mode = ImageMode.MONO
-                self.band_r, self.band_g, self.band_b = 0, 0, 0
-                self.band_mono = 0
-                self.rgb_band_settings.setVisible(False)
-                self.single_band_settings.setVisible(True)
+    def hover_inspect_toggled(self, checked: bool):
+        tracing.instant("hover inspect", enabled=checked)
+        self.image_preview.set_hover_handler(self.on_hover if checked else None)
+
+    def area_plot_mode_changed(self, idx: int):
+        tracing.instant("area plot mode changed", mode=idx)
+        if idx != -1:
+            self.spectral_viewer.set_area_mode(AreaPlotMode(idx))
+
+    def open_click(self, subset: bool = False):
+        tracing.instant("clicked open in menu bar", subset=subset)
+        self.loader.open_file(
+            self.image_loaded,
+            self.show_load_preview,
+            self.image_load_aborted,
+            self.refine_load_preview,
+            subset,
+        )
 
-            self.image_preview.clear_rubber_band()
-            self.spectral_viewer.clear()
-            self.spectral_viewer.update_labels(img.labels, img.labels_type)
-            self.image = img
-            self.state = ApplicationState.IMAGE_LOADED
-            self.similar_mask = None
+    @tracing.traced("show_preview")
+    def show_load_preview(self, preview: LoadPreview):
+        tracing.instant("showing preview")
+        # Disable tools until the full image is loaded
+        self.state = ApplicationState.NO_IMAGE
+        self.image_preview.clear_rubber_band()
+        self.image_preview.clear_overlays()
+        if preview.rgb:
+            self.render_bands(preview.image, ImageMode.RGB, 0, (0, 1, 2))
+        else:
+            self.render_bands(preview.image, ImageMode.MONO, 0, (0, 0, 0))
+        self.image_preview.scale_to(preview.width, preview.height)
+
+    def refine_load_preview(self, x: int, y: int, pixels: npt.NDArray[np.uint8]):
+        # Parts of the preview are replaced by full resolution pixels as they're read
+        self.image_preview.refine(x, y, pixels)
 
+    def image_load_aborted(self):
+        tracing.instant("image loading aborted")
+        # Restore the previous image in case preview of the new one has been shown
+        if self.image is not None:
+            self.state = ApplicationState.IMAGE_LOADED
             self.render_image()
+            if self.image_mode == ImageMode.SIMILAR and self.similar_mask is not None:
+                self.image_preview.set_overlay(self.SIMILAR_OVERLAY, self.similar_mask)
+            self.show_class_overlay()
+            self.show_anomaly_overlay()
+        else:
+            self.image_preview.clear()
+
+    @tracing.traced("image_loaded")
+    def image_loaded(self, img: HsImage):
+        tracing.instant("image loaded")
+        if img.storage_error > 0:
+            tracing.instant("compact storage", max_error=img.storage_error)
+            self.statusBar().showMessage(
+                f"Maximum error of compact storage: {img.storage_error:.3g}"
+            )
+        else:
+            self.statusBar().clearMessage()
+        # Set NO_IMAGE to disable some event handlers
+        self.state = ApplicationState.NO_IMAGE
+        for combo in [
+            self.sb_combo,
+            self.rgb_combo_r,
+            self.rgb_combo_g,
+            self.rgb_combo_b,
+        ]:
+            combo.clear()
+            combo.addItems(img.labels)
+
+        rgb_idx = img.closest_rgb_idx()
+        if rgb_idx is not None:
+            self.image_mode = ImageMode.RGB
+            self.band_r, self.band_g, self.band_b = rgb_idx
+            self.rgb_combo_r.setCurrentIndex(self.band_r)
+            self.rgb_combo_g.setCurrentIndex(self.band_g)
+            self.rgb_combo_b.setCurrentIndex(self.band_b)
+            self.band_mono = 0
+            self.rgb_band_settings.setVisible(True)
+            self.single_band_settings.setVisible(False)
+            self.component_settings.setVisible(False)
+            self.anomaly_settings.setVisible(False)
+        else:
+            self.image_mode = ImageMode.MONO
+            self.band_r, self.band_g, self.band_b = 0, 0, 0
+            self.band_mono = 0
+            self.rgb_band_settings.setVisible(False)
+            self.single_band_settings.setVisible(True)
+            self.component_settings.setVisible(False)
+            self.anomaly_settings.setVisible(False)
+
+        self.image_preview.clear_rubber_band()
+        self.image_preview.clear_overlays()
+        self.spectral_viewer.clear()
+        self.spectral_viewer.update_labels(img.labels, img.labels_type)
+        if self.backend is not None and self.image is not None:
+            self.backend.forget(self.image)
+        self.image = img
+        self.band_math = BandMath(img)
+        self.components = ComponentAnalysis(img)
+        self.state = ApplicationState.IMAGE_LOADED
+        self.similar_mask = None
+        self.selection_mask = None
+        self.clustering = None
+        self.library_match = None
+        self.anomalies = AnomalyDetection(img)
+
+        self.render_image()
+        if img.layout_pending:
+            # The image is usable meanwhile, cancelling only leaves accessors reading the single layout
+            self.task = run_in_background(
+                self, "Arranging bands", img.build_layout, lambda _: None
+            )
+
+    def worker_processes_toggled(self, checked: bool):
+        tracing.instant("worker processes", enabled=checked)
+        if checked and self.backend is None:
+            self.backend = ProcessBackend()
+            # Shared memory has to be freed also when exiting from the File menu
+            atexit.register(self.backend.close)
+        elif not checked and self.backend is not None:
+            backend = self.backend
+            self.backend = None
+            atexit.unregister(backend.close)
+            backend.close()
+
+    def trace_toggled(self, checked: bool):
+        tracing.tracer.enabled = checked
+
+    def timings_toggled(self, checked: bool):
+        if checked:
+            # Recording is needed to measure anything
+            self.action_trace.setChecked(True)
+            tracing.tracer.on_frame = (
+                lambda frame, duration: self.statusBar().showMessage(
+                    tracing.format_frame(frame, duration)
+                )
+            )
+        else:
+            tracing.tracer.on_frame = None
+            self.statusBar().clearMessage()
+
+    def export_trace_click(self):
+        file_path, _ = QFileDialog.getSaveFileName(
+            self, "Export trace", "", "Chrome trace (*.json)"
+        )
+        if not file_path:
+            return
+        try:
+            tracing.tracer.export(file_path)
+        except OSError as err:
+            QMessageBox.warning(
+                self, "Whaaale - export trace", "Exporting trace failed\n\n" + str(err)
+            )
+
+    def export_click(self):
+        tracing.instant("clicked export in menu bar")
+        if self.image is None or self.selection_mask is None:
+            QMessageBox.information(
+                self,
+                "Whaaale - export spectra",
+                "Select a pixel, an area or similar pixels to export their spectra.",
+            )
+            return
+        self.exporter.save_file(self.image, self.selection_mask)
 
     def mono_band_changed(self, idx: int):
-        print(
-            "Mono band changed to",
-            idx,
-            "ignoring"
-            if self.state == ApplicationState.NO_IMAGE or idx == -1
-            else "processing",
+        tracing.instant(
+            "mono band changed",
+            band=idx,
+            ignored=self.state == ApplicationState.NO_IMAGE or idx == -1,
         )
         if self.state != ApplicationState.NO_IMAGE or idx == -1:
             self.band_mono = idx
             self.render_image()
 
     def r_band_changed(self, idx: int):
-        print(
-            "Red band changed to",
-            idx,
-            "ignoring"
-            if self.state == ApplicationState.NO_IMAGE or idx == -1
-            else "processing",
+        tracing.instant(
+            "red band changed",
+            band=idx,
+            ignored=self.state == ApplicationState.NO_IMAGE or idx == -1,
         )
         if self.state != ApplicationState.NO_IMAGE or idx == -1:
             self.band_r = idx
@@ -326,12 +955,10 @@ class MainWindow(QMainWindow):
                 self.render_image()
 
     def g_band_changed(self, idx: int):
-        print(
-            "Green band changed to",
-            idx,
-            "ignoring"
-            if self.state == ApplicationState.NO_IMAGE or idx == -1
-            else "processing",
+        tracing.instant(
+            "green band changed",
+            band=idx,
+            ignored=self.state == ApplicationState.NO_IMAGE or idx == -1,
         )
         if self.state != ApplicationState.NO_IMAGE or idx == -1:
             self.band_g = idx
@@ -339,12 +966,10 @@ class MainWindow(QMainWindow):
                 self.render_image()
 
     def b_band_changed(self, idx: int):
-        print(
-            "Blue band changed to",
-            idx,
-            "ignoring"
-            if self.state == ApplicationState.NO_IMAGE or idx == -1
-            else "processing",
+        tracing.instant(
+            "blue band changed",
+            band=idx,
+            ignored=self.state == ApplicationState.NO_IMAGE or idx == -1,
         )
         if self.state != ApplicationState.NO_IMAGE or idx == -1:
             self.band_b = idx
@@ -356,7 +981,7 @@ class MainWindow(QMainWindow):
             self.ignore_threshold_change = False
             return
 
-        print("Threshold input changed to", new_val)
+        tracing.instant("threshold input changed", threshold=new_val)
         self.threshold = new_val
         slider_pos = 10 * (math.log10(new_val) + 6)
         self.ignore_threshold_change = True
@@ -367,92 +992,240 @@ class MainWindow(QMainWindow):
             self.ignore_threshold_change = False
             return
 
-        print("Threshold slider changed to", tick)
+        tracing.instant("threshold slider changed", tick=tick)
         val = pow(10, tick / 10 - 6)
         if self.threshold != val:
             self.threshold = val
             self.ignore_threshold_change = True
             self.input_magic_wand.setValue(val)
 
+    def anomaly_input_changed(self, new_val: float):
+        if self.anomaly_fraction == new_val / 100 or self.ignore_anomaly_change:
+            self.ignore_anomaly_change = False
+            return
+
+        tracing.instant("anomaly threshold input changed", percent=new_val)
+        self.anomaly_fraction = new_val / 100
+        slider_pos = 10 * (math.log10(new_val) + 3)
+        self.ignore_anomaly_change = True
+        self.slider_anomaly.setValue(int(slider_pos))
+        self.show_anomaly_overlay()
+
+    def anomaly_slider_changed(self, tick: int):
+        if self.ignore_anomaly_change:
+            self.ignore_anomaly_change = False
+            return
+
+        tracing.instant("anomaly threshold slider changed", tick=tick)
+        val = pow(10, tick / 10 - 3)
+        if self.anomaly_fraction != val / 100:
+            self.anomaly_fraction = val / 100
+            self.ignore_anomaly_change = True
+            self.input_anomaly.setValue(val)
+            self.show_anomaly_overlay()
+
     def on_mouse_down(self, coordinates: Coordinates):
-        print("mouse down at", coordinates)
+        tracing.instant("mouse down", coordinates=coordinates)
         if self.state == ApplicationState.SELECT_AREA_FIRST:
             self.start_position = coordinates
             self.state = ApplicationState.SELECT_AREA_SECOND
             self.image_preview.draw_rubber_band(coordinates)
 
+    @tracing.traced("mouse_up")
     def on_mouse_up(self, coordinates: Coordinates):
-        print("mouse up at", coordinates)
+        tracing.instant("mouse up", coordinates=coordinates)
+        if self.state == ApplicationState.NO_IMAGE:
+            return
         assert self.image is not None
 
         match self.state:
             case ApplicationState.SELECT_PX:
                 px = self.image.get_pixel(*coordinates)
                 self.spectral_viewer.from_pixel(px)
+                self.selection_mask = self.image.get_area_mask(coordinates, coordinates)
                 self.state = ApplicationState.IMAGE_LOADED
+                if (
+                    self.image_mode == ImageMode.LIBRARY_MATCH
+                    and self.library_match is not None
+                ):
+                    self.statusBar().showMessage(
+                        self.library_match.describe(*coordinates)
+                    )
             case ApplicationState.SELECT_AREA_SECOND:
                 self.image_preview.clear_rubber_band()
                 self.state = ApplicationState.IMAGE_LOADED
                 area = self.image.get_area(self.start_position, coordinates)
                 self.spectral_viewer.from_area(area)
+                self.selection_mask = self.image.get_area_mask(
+                    self.start_position, coordinates
+                )
             case ApplicationState.SELECT_SIMILAR:
                 self.state = ApplicationState.IMAGE_LOADED
-                self.similar_mask = self.image.get_similar(coordinates, self.threshold)
-                self.image_mode = ImageMode.SIMILAR
-                self.rgb_band_settings.setVisible(False)
-                self.single_band_settings.setVisible(True)
-                self.render_image()
+                image = self.image
+                backend = self.backend
+                if backend is None:
+                    self.show_similar(
+                        image, image.get_similar(coordinates, self.threshold)
+                    )
+                    return
+                threshold = self.threshold
+                self.task = run_in_background(
+                    self,
+                    "Selecting similar pixels",
+                    lambda progress: backend.similar(
+                        image, coordinates, threshold, progress
+                    ),
+                    lambda mask: self.show_similar(image, mask),
+                )
+            case ApplicationState.SELECT_CLASS:
+                self.state = ApplicationState.IMAGE_LOADED
+                assert self.clustering is not None
+                x, y = coordinates
+                idx = int(self.clustering.classes[y, x])
+                if idx == NO_CLASS:
+                    return
+                spectra = self.clustering.class_spectra(self.image, idx)
+                # Statistics of a class are shown like those of an area
+                self.spectral_viewer.from_area(spectra[:, np.newaxis])
+                self.selection_mask = self.clustering.classes == idx
+                self.statusBar().showMessage(
+                    f"Class {idx + 1}: {self.clustering.counts[idx]} pixels"
+                )
+
+    def show_similar(self, image: HsImage, similar_mask: npt.NDArray[np.bool_]):
+        if image is not self.image:
+            # Another image has been opened in the meantime
+            return
+        self.similar_mask = similar_mask
+        self.selection_mask = similar_mask
+        self.rgb_band_settings.setVisible(False)
+        self.single_band_settings.setVisible(True)
+        self.component_settings.setVisible(False)
+        self.anomaly_settings.setVisible(False)
+        self.image_preview.clear_overlay(self.ANOMALY_OVERLAY)
+        if self.image_mode != ImageMode.SIMILAR:
+            self.image_mode = ImageMode.SIMILAR
+            self.render_image()
+        # Only the overlay changes, the band image is reused
+        self.image_preview.set_overlay(self.SIMILAR_OVERLAY, similar_mask)
+
+    @tracing.traced("hover")
+    def on_hover(self, coordinates: Coordinates):
+        if self.image is None or self.state == ApplicationState.NO_IMAGE:
+            return
+        px = self.image.get_pixel(*coordinates)
+        self.spectral_viewer.update_pixel(px)
 
+    @tracing.traced("render_image")
     def render_image(self):
         assert self.image is not None
 
-        if self.image.data.dtype.kind == "f":
-            match self.image_mode:
-                case ImageMode.MONO:
+        self.render_bands(
+            self.image,
+            self.image_mode,
+            self.band_mono,
+            (self.band_r, self.band_g, self.band_b),
+        )
+
+    def render_bands(
+        self,
+        image: HsImage,
+        image_mode: ImageMode,
+        band_mono: int,
+        bands_rgb: tuple[int, int, int],
+    ):
+        if image_mode == ImageMode.BAND_MATH:
+            assert self.band_math is not None
+            # Virtual bands are always floating point
+            band = self.band_math.evaluate(self.expression)
+            self.image_preview.render_single_f(band.normalised())
+        elif image_mode == ImageMode.COMPONENTS:
+            assert self.components is not None
+            self.image_preview.render_rgb(
+                self.components.composite(self.component_method, ignore_progress)
+            )
+        elif image_mode == ImageMode.ANOMALY:
+            assert self.anomalies is not None
+            scores = self.anomalies.scores(self.anomaly_method, ignore_progress)
+            self.image_preview.render_single_f(scores.normalised())
+        elif image_mode == ImageMode.LIBRARY_MATCH:
+            assert self.library_match is not None
+            self.image_preview.render_rgb(self.render_library_match(self.library_match))
+        elif image.dtype.kind == "f":
+            match image_mode:
+                # The similarity mask is an overlay kept by the preview, only the band is rendered
+                case ImageMode.MONO | ImageMode.SIMILAR:
                     self.image_preview.render_single_f(
-                        self.image.get_band_normalised(self.band_mono)
+                        image.get_band_normalised(band_mono)
                     )
                 case ImageMode.RGB:
                     self.image_preview.render_rgb_f(
-                        self.image.get_RGB_bands_normalised(
-                            self.band_r, self.band_g, self.band_b
-                        )
-                    )
-                case ImageMode.SIMILAR:
-                    assert self.similar_mask is not None
-                    self.image_preview.render_similar_f(
-                        self.image.get_band_normalised(self.band_mono),
-                        self.similar_mask,
+                        image.get_RGB_bands_normalised(*bands_rgb)
                     )
         else:
-            match self.image_mode:
-                case ImageMode.MONO:
-                    data = self.image.get_band(self.band_mono)
-                    data = self.image.as_8bpp(data)
+            match image_mode:
+                case ImageMode.MONO | ImageMode.SIMILAR:
+                    data = image.get_band(band_mono)
+                    data = image.as_8bpp(data)
                     self.image_preview.render_single(data)
                 case ImageMode.RGB:
-                    data = self.image.get_RGB_bands(
-                        self.band_r, self.band_g, self.band_b
-                    )
-                    data = self.image.as_8bpp(data)
+                    data = image.get_RGB_bands(*bands_rgb)
+                    data = image.as_8bpp(data)
                     self.image_preview.render_rgb(data)
-                case ImageMode.SIMILAR:
-                    assert self.similar_mask is not None
-                    data = self.image.get_band(self.band_mono)
-                    data = self.image.as_8bpp(data)
-                    self.image_preview.render_similar(data, self.similar_mask)
+
+    @staticmethod
+    def render_library_match(
+        library_match: LibraryMatch,
+    ) -> npt.NDArray[np.uint8]:
+        """Colours pixels by their best match, brighter pixels are more similar to it."""
+        n = len(library_match.names)
+        palette = np.zeros((n + 1, 3), dtype=np.float32)
+        palette[:n] = [color.getRgb()[:3] for color in class_colors(n)]
+        # Pixels without a match use the last (black) colour
+        idx = np.where(library_match.best == NO_MATCH, n, library_match.best)
+        pixels = palette[idx]
+        pixels *= library_match.similarity()[..., np.newaxis]
+        return pixels.astype(np.uint8)
 
 
 def main():
+    # Worker processes of frozen builds start this executable, which has to run the worker instead
+    freeze_support()
+    if len(argv) > 1 and argv[1] == "render":
+        # Batch rendering doesn't need the window, nor most of the modules it uses
+        from cli.render import main as render_main
+
+        exit(render_main(argv[2:]))
+    if len(argv) > 1 and argv[1] == "serve":
+        from cli.serve import main as serve_main
+
+        exit(serve_main(argv[2:]))
+
     if os.name == "nt":
         if not "QT_QPA_PLATFORM" in os.environ:
             os.environ["QT_QPA_PLATFORM"] = "windows:darkmode=2"
         if not "QT_STYLE_OVERRIDE" in os.environ:
             os.environ["QT_STYLE_OVERRIDE"] = "fusion"
 
+    imported = perf_counter()
+    trace_path = os.environ.get(tracing.TRACE_ENV)
+    tracing.tracer.enabled = bool(trace_path)
     a = QApplication(argv)
     main_window = MainWindow()
     main_window.start()
+
+    def report_startup():
+        # Runs from the event loop, once the window has been shown
+        shown = perf_counter()
+        begin = int(STARTUP_BEGIN * 1e9)
+        tracing.tracer.complete("startup", begin, int(shown * 1e9))
+        tracing.tracer.complete("imports", begin, int(imported * 1e9))
+
+    if trace_path:
+        # Also runs when the application exits from the File menu
+        atexit.register(tracing.tracer.export, trace_path)
+
+    QTimer.singleShot(0, report_startup)
     a.exec()
 
 